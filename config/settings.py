@@ -2,14 +2,18 @@ import os
 from pathlib import Path
 from dotenv import load_dotenv
 
-print("Current working directory:", os.getcwd())  # debug
-
 dotenv_path = Path(__file__).parent.parent / ".env"
-print("dotenv_path", dotenv_path)
 load_dotenv(dotenv_path)
 
 API_KEY = os.getenv("API_KEY")
 LLM_MODEL = os.getenv("LLM_MODEL")
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY") or 4)
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_REFRESH = os.getenv("LLM_CACHE_REFRESH", "false").lower() == "true"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "tmp/llm_cache/llm_cache.sqlite3")
+LLM_CACHE_TTL_DAYS = float(os.getenv("LLM_CACHE_TTL_DAYS") or 0)
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES") or 0)
+LLM_BATCH_SUMMARIES = os.getenv("LLM_BATCH_SUMMARIES", "false").lower() == "true"
 TEXT_EMBEDDING_MODEL = os.getenv("TEXT_EMBEDDING_MODEL")
 CODE_EMBEDDING_MODEL = os.getenv("CODE_EMBEDDING_MODEL")
 TEXT_RERANK_MODEL = os.getenv("TEXT_RERANK_MODEL")
@@ -28,6 +32,41 @@ AWD_CHUNK_TYPE_WEIGHT_PATH = os.getenv("AWD_CHUNK_TYPE_WEIGHT_PATH")
 CH_CHUNK_TYPE_ABLATION_WEIGHT_PATH = os.getenv("CH_CHUNK_TYPE_ABLATION_WEIGHT_PATH")
 MH_CHUNK_TYPE_ABLATION_WEIGHT_PATH = os.getenv("MH_CHUNK_TYPE_ABLATION_WEIGHT_PATH")
 AWD_CHUNK_TYPE_ABLATION_WEIGHT_PATH = os.getenv("AWD_CHUNK_TYPE_ABLATION_WEIGHT_PATH")
-
-
-print(f"DATA_DIR loaded: {DATA_DIR}")
+CODE_EMBEDDING_BACKEND = os.getenv("CODE_EMBEDDING_BACKEND", "torch")
+CODE_EMBEDDING_ONNX_DIR = os.getenv("CODE_EMBEDDING_ONNX_DIR", "tmp/onnx/code_embedding")
+CODE_EMBEDDING_ONNX_QUANTIZED = os.getenv("CODE_EMBEDDING_ONNX_QUANTIZED", "false").lower() == "true"
+ONNX_INTRA_OP_THREADS = int(os.getenv("ONNX_INTRA_OP_THREADS") or 0) or None
+CODE_EMBEDDING_REDUCTION = os.getenv("CODE_EMBEDDING_REDUCTION", "none")
+CODE_EMBEDDING_DIM = int(os.getenv("CODE_EMBEDDING_DIM") or 0) or None
+TEXT_EMBEDDING_REDUCTION = os.getenv("TEXT_EMBEDDING_REDUCTION", "none")
+TEXT_EMBEDDING_DIM = int(os.getenv("TEXT_EMBEDDING_DIM") or 0) or None
+EMBEDDING_MAX_BATCH_TOKENS = int(os.getenv("EMBEDDING_MAX_BATCH_TOKENS") or 16384) or None
+EMBEDDING_SERVICE_ENABLED = os.getenv("EMBEDDING_SERVICE_ENABLED", "false").lower() == "true"
+EMBEDDING_SERVICE_SOCKET = os.getenv("EMBEDDING_SERVICE_SOCKET", "tmp/embedding_service.sock")
+EMBEDDING_SERVICE_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_SERVICE_BATCH_WINDOW_MS") or 10)
+EMBEDDING_SERVICE_MAX_BATCH_TEXTS = int(os.getenv("EMBEDDING_SERVICE_MAX_BATCH_TEXTS") or 256)
+AST_SERIALIZATION = os.getenv("AST_SERIALIZATION", "sexp")
+AST_MAX_DEPTH = int(os.getenv("AST_MAX_DEPTH") or 0) or None
+AST_FOLD_METHOD_BODIES = os.getenv("AST_FOLD_METHOD_BODIES", "false").lower() == "true"
+AST_ABBREVIATE_TYPES = os.getenv("AST_ABBREVIATE_TYPES", "true").lower() == "true"
+AST_PARSE_CACHE_SIZE = int(os.getenv("AST_PARSE_CACHE_SIZE") or 128)
+AST_SEXP_MAX_CHARS = int(os.getenv("AST_SEXP_MAX_CHARS") or 0) or None
+AST_SEXP_MAX_TOKENS = int(os.getenv("AST_SEXP_MAX_TOKENS") or 0) or None
+CHUNK_WORKERS = int(os.getenv("CHUNK_WORKERS") or 1)
+CHUNK_GROUP_ID_MODE = os.getenv("CHUNK_GROUP_ID_MODE", "manifest")
+CHUNK_ASYNC_LLM = os.getenv("CHUNK_ASYNC_LLM", "false").lower() == "true"
+CHUNK_ASYNC_CASES = int(os.getenv("CHUNK_ASYNC_CASES") or 8)
+CHUNK_INCREMENTAL = os.getenv("CHUNK_INCREMENTAL", "true").lower() == "true"
+CASE_CATALOG_ENABLED = os.getenv("CASE_CATALOG_ENABLED", "true").lower() == "true"
+CASE_CATALOG_PATH = os.getenv("CASE_CATALOG_PATH", "tmp/catalog/case_catalog.sqlite3")
+CHUNK_STORE_ENABLED = os.getenv("CHUNK_STORE_ENABLED", "false").lower() == "true"
+CHUNK_STORE_SHARD_BYTES = int(os.getenv("CHUNK_STORE_SHARD_BYTES") or 256 * 1024 * 1024)
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH") or 512)
+RERANK_MAX_BATCH_TOKENS = int(os.getenv("RERANK_MAX_BATCH_TOKENS") or 8192)
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE") or 32)
+RERANK_SCORING_MODE = os.getenv("RERANK_SCORING_MODE", "auto")
+RERANK_INSTRUCTION = os.getenv("RERANK_INSTRUCTION") or \
+    "Given a code anti-pattern case, judge whether the Document describes a similar anti-pattern case"
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "false").lower() == "true"
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES") or 20)
+RERANK_DEADLINE_MS = float(os.getenv("RERANK_DEADLINE_MS") or 2000)
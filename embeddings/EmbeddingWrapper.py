@@ -1,4 +1,8 @@
-from typing import List, Union
+from collections import OrderedDict
+from typing import List, Optional, Union
+
+# token 长度缓存的最大条数（常驻的 embedding 服务中不能无限增长）
+TOKEN_LENGTH_CACHE_SIZE = 100000
 
 
 class BaseEmbeddingWrapper:
@@ -7,48 +11,130 @@ class BaseEmbeddingWrapper:
     Subclasses only need to define `encode()` according to model behavior.
     """
 
-    def __init__(self, hf_model):
+    def __init__(self, hf_model, max_batch_tokens: Optional[int] = None):
         self.model = hf_model
-        if not hasattr(hf_model, "_client"):
-            raise RuntimeError(f"{hf_model.__class__.__name__} has no _client attribute")
-        self._client = hf_model._client
+        self._client = None
+        if hf_model is not None:
+            if not hasattr(hf_model, "_client"):
+                raise RuntimeError(f"{hf_model.__class__.__name__} has no _client attribute")
+            self._client = hf_model._client
+        self.max_batch_tokens = max_batch_tokens
+        self._token_lengths = OrderedDict()
 
-    def embed_documents(self, texts: List[str], batch_size: int = 16) -> List[List[float]]:
+    def _embed(self, texts: List[str], is_query: bool, batch_size: int = 16) -> List[List[float]]:
+        # 设置了 max_batch_tokens 时按 token 预算分 batch，否则按固定条数分 batch
+        if self.max_batch_tokens:
+            return self._embed_by_token_budget(texts, is_query)
         embeddings = []
         for i in range(0, len(texts), batch_size):
             batch_texts = texts[i:i + batch_size]
-            batch_emb = self.encode(batch_texts, is_query=False)
+            batch_emb = self.encode(batch_texts, is_query=is_query)
             if hasattr(batch_emb, "tolist"):
                 batch_emb = batch_emb.tolist()
             embeddings.extend(batch_emb)
         return embeddings
 
+    def embed_documents(self, texts: List[str], batch_size: int = 16) -> List[List[float]]:
+        return self._embed(texts, is_query=False, batch_size=batch_size)
+
+    @property
+    def handles_batching(self) -> bool:
+        """embed_documents 是否自行按 token 预算分 batch；否则调用方逐条 embedding"""
+        return bool(self.max_batch_tokens)
+
     def embed_query(self, text_or_texts: Union[str, List[str]]) -> Union[List[float], List[List[float]]]:
         is_single = isinstance(text_or_texts, str)
         texts = [text_or_texts] if is_single else text_or_texts
-        emb = self.encode(texts, is_query=True)
-        if hasattr(emb, "tolist"):
-            emb = emb.tolist()
+        emb = self._embed(texts, is_query=True)
         return emb[0] if is_single else emb
 
     def encode(self, texts: List[str], is_query: bool = False):
         """子类实现：定义模型 encode 逻辑"""
         raise NotImplementedError("Subclasses must implement encode()")
 
+    def get_encode_kwargs(self, texts: List[str]) -> dict:
+        """
+        sentence-transformers encode 的额外参数：按 token 预算分好的 batch 整体前向一次，
+        不再由 sentence-transformers 按默认 batch_size（32）二次切分；未设置预算时保持默认。
+        """
+        return {"batch_size": len(texts)} if self.max_batch_tokens else {}
+
+    def get_tokenizer(self):
+        return getattr(self, "tokenizer", None) or getattr(self._client, "tokenizer", None)
+
+    def get_max_seq_length(self) -> Optional[int]:
+        return getattr(self, "max_length", None) or getattr(self._client, "max_seq_length", None)
+
+    def token_length(self, text: str) -> int:
+        """带缓存的 token 长度（超过模型最大长度的部分会被截断，因此按最大长度计）"""
+        key = (len(text), hash(text))
+        length = self._token_lengths.get(key)
+        if length is None:
+            tokenizer = self.get_tokenizer()
+            if tokenizer is not None:
+                length = len(tokenizer.encode(text, truncation=False))
+            else:
+                # 没有 tokenizer 时按 4 字符 ≈ 1 token 估算
+                length = len(text) // 4 + 1
+            self._token_lengths[key] = length
+            if len(self._token_lengths) > TOKEN_LENGTH_CACHE_SIZE:
+                self._token_lengths.popitem(last=False)
+        else:
+            self._token_lengths.move_to_end(key)
+        max_seq_length = self.get_max_seq_length()
+        return min(length, max_seq_length) if max_seq_length else length
+
+    def build_token_budget_batches(self, texts: List[str]) -> List[List[int]]:
+        """
+        按 token 预算划分 batch：先按长度排序并分入 2 的幂长度桶，
+        桶内贪心装箱，使 batch 内 (最长序列长度 × 条数) 不超过 max_batch_tokens。
+        返回每个 batch 对应的原始下标列表。
+        """
+        lengths = [self.token_length(text) for text in texts]
+        order = sorted(range(len(texts)), key=lambda i: lengths[i])
+
+        batches = []
+        current, current_bucket = [], None
+        for i in order:
+            bucket = max(lengths[i], 1).bit_length()
+            # lengths 升序，当前元素即 batch 内最长序列
+            fits = (len(current) + 1) * lengths[i] <= self.max_batch_tokens
+            if current and (bucket != current_bucket or not fits):
+                batches.append(current)
+                current = []
+            current.append(i)
+            current_bucket = bucket
+        if current:
+            batches.append(current)
+        return batches
+
+    def _embed_by_token_budget(self, texts: List[str], is_query: bool = False) -> List[List[float]]:
+        embeddings = [None] * len(texts)
+        for batch_idxs in self.build_token_budget_batches(texts):
+            batch_emb = self.encode([texts[i] for i in batch_idxs], is_query=is_query)
+            if hasattr(batch_emb, "tolist"):
+                batch_emb = batch_emb.tolist()
+            # 按调用方传入的原始顺序放回
+            for i, emb in zip(batch_idxs, batch_emb):
+                embeddings[i] = emb
+        return embeddings
+
 
 class JinaCodeEmbeddingWrapper(BaseEmbeddingWrapper):
     """Wrapper for Jina models — supports task='code' and prompt_name='query'."""
 
     def encode(self, texts: List[str], is_query: bool = False):
+        kwargs = self.get_encode_kwargs(texts)
         if is_query:
-            return self._client.encode(texts, task="code", prompt_name="query")
-        return self._client.encode(texts, task="code")
+            return self._client.encode(texts, task="code", prompt_name="query", **kwargs)
+        return self._client.encode(texts, task="code", **kwargs)
 
 
 class QwenEmbeddingWrapper(BaseEmbeddingWrapper):
     """Wrapper for Qwen models — supports prompt_name='query', no task param."""
 
     def encode(self, texts: List[str], is_query: bool = False):
+        kwargs = self.get_encode_kwargs(texts)
         if is_query:
-            return self._client.encode(texts, prompt_name="query")
-        return self._client.encode(texts)
+            return self._client.encode(texts, prompt_name="query", **kwargs)
+        return self._client.encode(texts, **kwargs)
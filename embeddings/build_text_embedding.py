@@ -1,26 +1,45 @@
+from __future__ import annotations
+
 from pathlib import Path
-from typing import Union
-from transformers import AutoTokenizer
+from typing import TYPE_CHECKING, List, Union
 
 from config.settings import TEXT_EMBEDDING_MODEL
-from embeddings.EmbeddingWrapper import QwenEmbeddingWrapper
 from embeddings.embedding_utils import (
     load_chunks_from_json,
     build_documents,
-    init_embedding_model,
+    init_text_embedding_wrapper,
     store_to_chroma, get_max_token_length,
     check_documents_exceed_max_len, get_query_vectorstore_dir
 )
 from splitter.utils import split_documents_with_instruction_context
 
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
 
 def build_text_embedding(chunks_json_path: Union[str, Path], vectorstore_base_path, query: bool = False):
+    from transformers import AutoTokenizer
+
     chunks = load_chunks_from_json(Path(chunks_json_path))
-    documents = build_documents(chunks, content_key="llm_description")
-    embedding_model_raw = init_embedding_model(TEXT_EMBEDDING_MODEL)
-    embedding_model = QwenEmbeddingWrapper(embedding_model_raw)
+    embedding_model = init_text_embedding_wrapper()
     tokenizer = AutoTokenizer.from_pretrained(TEXT_EMBEDDING_MODEL, trust_remote_code=True)
     model_max_len = get_max_token_length(tokenizer)
+    documents = prepare_text_documents(chunks, tokenizer, model_max_len)
+    try:
+        store_to_chroma(documents, embedding_model, "TEXT", vectorstore_base_path=vectorstore_base_path, query=query)
+    except Exception as e:
+        print(f"[Error] build_text_embedding failed: {e}", flush=True)
+        raise
+    print("[✓] finish text_code_embedding", flush=True)
+
+    return
+
+
+def prepare_text_documents(chunks: dict, tokenizer, model_max_len: int) -> List[Document]:
+    """
+    构建 text embedding 的 documents，并按 instruct 格式拆分超过模型最大长度的 llm_description。
+    """
+    documents = build_documents(chunks, content_key="llm_description")
     match TEXT_EMBEDDING_MODEL:
         case m if "Qwen/Qwen3-Embedding-8B" in m:
             valid_documents, exceeding_documents = check_documents_exceed_max_len(documents, tokenizer, model_max_len)
@@ -30,11 +49,4 @@ def build_text_embedding(chunks_json_path: Union[str, Path], vectorstore_base_pa
             documents = valid_documents + exceeding_documents
         case _:
             pass
-    try:
-        store_to_chroma(documents, embedding_model, "TEXT", vectorstore_base_path=vectorstore_base_path, query=query)
-    except Exception as e:
-        print(f"[Error] build_text_embedding failed: {e}", flush=True)
-        raise
-    print("[✓] finish text_code_embedding", flush=True)
-
-    return
+    return documents
@@ -0,0 +1,270 @@
+import json
+import pickle
+import time
+from pathlib import Path
+from typing import List, Optional, Union
+
+import numpy as np
+
+from config.settings import CODE_EMBEDDING_DIM, TEXT_EMBEDDING_DIM, CODE_EMBEDDING_REDUCTION, \
+    TEXT_EMBEDDING_REDUCTION
+
+PCA_PROJECTION_FILE = "pca_projection.npz"
+FULL_INDEX_FILE = "faiss_index.full.idx"
+REPORT_FILE = "dim_reduction_report.json"
+
+EMBEDDING_DIMS = {"CODE": CODE_EMBEDDING_DIM, "TEXT": TEXT_EMBEDDING_DIM}
+EMBEDDING_REDUCTIONS = {"CODE": CODE_EMBEDDING_REDUCTION, "TEXT": TEXT_EMBEDDING_REDUCTION}
+
+
+def truncate_embeddings(embeddings: np.ndarray, dim: int) -> np.ndarray:
+    """
+    Matryoshka 截断：保留前 dim 维（Qwen3-Embedding / jina-embeddings-v4 均支持）后重新归一化。
+    截断后的模长随向量而变，不归一化时 L2 距离会混入模长差异。
+    """
+    truncated = embeddings[:, :dim].astype(np.float32)
+    truncated /= np.linalg.norm(truncated, axis=1, keepdims=True) + 1e-10
+    return np.ascontiguousarray(truncated)
+
+
+class PCAProjection:
+    """
+    在语料向量上拟合的 PCA 投影，随向量库保存，corpus 与 query 使用同一份投影。
+    CODE 使用 L2 距离打分，投影前中心化；TEXT 使用余弦相似度，不中心化以保持向量方向。
+    """
+
+    def __init__(self, mean: np.ndarray, components: np.ndarray, explained_variance_ratio: np.ndarray):
+        self.mean = mean.astype(np.float32)
+        self.components = components.astype(np.float32)
+        self.explained_variance_ratio = explained_variance_ratio
+
+    @property
+    def dim(self) -> int:
+        return self.components.shape[0]
+
+    @classmethod
+    def fit(cls, embeddings: np.ndarray, dim: int, center: bool = True) -> "PCAProjection":
+        embeddings = embeddings.astype(np.float64)
+        mean = embeddings.mean(axis=0) if center else np.zeros(embeddings.shape[1])
+        centered = embeddings - mean
+        # 协方差矩阵只有 d x d，语料条数再多也不会放大内存
+        cov = centered.T @ centered / max(len(centered) - 1, 1)
+        eigvals, eigvecs = np.linalg.eigh(cov)
+        order = np.argsort(eigvals)[::-1][:dim]
+        total = eigvals.sum()
+        ratio = eigvals[order] / total if total > 0 else np.zeros(len(order))
+        return cls(mean, eigvecs[:, order].T, ratio)
+
+    def transform(self, embeddings: np.ndarray) -> np.ndarray:
+        return np.ascontiguousarray((embeddings - self.mean) @ self.components.T, dtype=np.float32)
+
+    def save(self, path: Union[str, Path]):
+        np.savez(path, mean=self.mean, components=self.components,
+                 explained_variance_ratio=self.explained_variance_ratio)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "PCAProjection":
+        data = np.load(path)
+        return cls(data["mean"], data["components"], data["explained_variance_ratio"])
+
+
+def get_pca_projection_path(vectorstore_base_path: Union[str, Path], category: str) -> Path:
+    return Path(vectorstore_base_path) / category / PCA_PROJECTION_FILE
+
+
+def reduce_embeddings(embeddings: np.ndarray, category: str,
+                      vectorstore_base_path: Union[str, Path], query: bool = False) -> np.ndarray:
+    """
+    按配置对某一类别（CODE / TEXT）的向量降维，未配置时原样返回。
+    构建 corpus 和 query 向量时都经过这里，保证两侧维度一致。
+
+    :param query: 是否为 query 向量。PCA 投影尚未拟合时 corpus 先按全维写入（fit_pca_projection 随后统一降维），
+                  query 则直接报错：corpus 可能已经降维，全维 query 与之维度不一致
+    """
+    method = EMBEDDING_REDUCTIONS.get(category)
+    dim = EMBEDDING_DIMS.get(category)
+    if not method or method == "none":
+        return embeddings
+
+    if method == "matryoshka":
+        if not dim or dim >= embeddings.shape[1]:
+            return embeddings
+        return truncate_embeddings(embeddings, dim)
+
+    if method == "pca":
+        projection_path = get_pca_projection_path(vectorstore_base_path, category)
+        if not projection_path.exists():
+            if query:
+                raise FileNotFoundError(f"PCA projection missing: {projection_path}. "
+                                        f"Run fit_pca_projection on the corpus before embedding queries.")
+            print(f"[WARN] PCA projection missing: {projection_path}, keep full width. "
+                  f"Run fit_pca_projection after the corpus is built.")
+            return embeddings
+        return PCAProjection.load(projection_path).transform(embeddings)
+
+    raise ValueError(f"Unsupported embedding reduction: {method}")
+
+
+def load_category_vectors(vectorstore_base_path: Union[str, Path], category: str):
+    """
+    读取某一类别下所有 FAISS 向量库的全维向量（优先读取降维前备份的 faiss_index.full.idx）。
+
+    :return: (embeddings, metadatas, idx_paths)，metadatas 与 embeddings 一一对应
+    """
+    import faiss
+
+    category_path = Path(vectorstore_base_path) / category
+    all_embeddings, all_metadatas, idx_paths = [], [], []
+
+    for idx_path in sorted(category_path.rglob("faiss_index.idx")):
+        full_path = idx_path.parent / FULL_INDEX_FILE
+        index = faiss.read_index(str(full_path if full_path.exists() else idx_path))
+        with open(idx_path.parent / "metadata.pkl", "rb") as f:
+            metadatas = pickle.load(f)
+        if all_embeddings and index.d != all_embeddings[0].shape[1]:
+            print(f"[SKIP] {idx_path} dimension {index.d} != {all_embeddings[0].shape[1]}")
+            continue
+        all_embeddings.append(index.reconstruct_n(0, index.ntotal))
+        all_metadatas.extend(metadatas)
+        idx_paths.append(idx_path)
+
+    if not all_embeddings:
+        return np.zeros((0, 0), dtype=np.float32), [], []
+    return np.vstack(all_embeddings).astype(np.float32), all_metadatas, idx_paths
+
+
+def fit_pca_projection(vectorstore_base_path: Union[str, Path], category: str, dim: int,
+                       apply_to_stores: bool = True) -> PCAProjection:
+    """
+    在 vectorstore_base_path/{category} 下的全部向量上拟合 PCA 投影并保存，
+    可选地把已有向量库重写为降维后的版本（全维索引备份为 faiss_index.full.idx）。
+    """
+    embeddings, _, idx_paths = load_category_vectors(vectorstore_base_path, category)
+    if len(embeddings) == 0:
+        raise FileNotFoundError(f"No FAISS index found under {Path(vectorstore_base_path) / category}")
+
+    print(f"[i] Fitting PCA on {len(embeddings)} {category} vectors: {embeddings.shape[1]} -> {dim}")
+    projection = PCAProjection.fit(embeddings, dim, center=(category == "CODE"))
+    projection_path = get_pca_projection_path(vectorstore_base_path, category)
+    projection.save(projection_path)
+    print(f"[✓] PCA projection saved to {projection_path}, "
+          f"explained variance: {projection.explained_variance_ratio.sum():.4f}")
+
+    if apply_to_stores:
+        for idx_path in idx_paths:
+            apply_projection_to_store(idx_path.parent, projection)
+
+    return projection
+
+
+def apply_projection_to_store(store_dir: Union[str, Path], projection: PCAProjection):
+    import faiss
+
+    store_dir = Path(store_dir)
+    idx_path = store_dir / "faiss_index.idx"
+    full_path = store_dir / FULL_INDEX_FILE
+
+    index = faiss.read_index(str(idx_path))
+    if not full_path.exists():
+        faiss.write_index(index, str(full_path))
+    else:
+        index = faiss.read_index(str(full_path))
+
+    reduced = projection.transform(index.reconstruct_n(0, index.ntotal))
+    reduced_index = faiss.IndexFlatL2(projection.dim)
+    reduced_index.add(reduced)
+    faiss.write_index(reduced_index, str(idx_path))
+
+    meta_path = store_dir / "metadata.pkl"
+    with open(meta_path, "rb") as f:
+        metadatas = pickle.load(f)
+    for meta, emb in zip(metadatas, reduced):
+        if "embedding" in meta:
+            meta["embedding"] = emb
+    with open(meta_path, "wb") as f:
+        pickle.dump(metadatas, f)
+    print(f"[✓] Reduced store written: {store_dir}")
+
+
+def _topk_neighbors(embeddings: np.ndarray, k: int, metric: str) -> np.ndarray:
+    import faiss
+
+    if metric == "cosine":
+        embeddings = embeddings / (np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-10)
+        index = faiss.IndexFlatIP(embeddings.shape[1])
+    else:
+        index = faiss.IndexFlatL2(embeddings.shape[1])
+    index.add(np.ascontiguousarray(embeddings, dtype=np.float32))
+    # 多取一个再去掉自身
+    _, neighbors = index.search(np.ascontiguousarray(embeddings, dtype=np.float32), k + 1)
+    return neighbors[:, 1:]
+
+
+def evaluate_dimension_reduction(vectorstore_base_path: Union[str, Path], category: str, dims: List[int],
+                                 method: str = "matryoshka", top_k: int = 5,
+                                 output_path: Optional[Union[str, Path]] = None) -> dict:
+    """
+    以已有向量库为评估集，按 chunk_type 分组比较降维前后的 top_k 近邻重合率
+    （降维后的近邻中有多少也是全维向量的近邻，衡量与全维检索结果的一致程度，不是相对标注的检索召回率），
+    同时统计向量内存和检索耗时，结果保存为 dim_reduction_report.json。
+    """
+    embeddings, metadatas, _ = load_category_vectors(vectorstore_base_path, category)
+    if len(embeddings) == 0:
+        raise FileNotFoundError(f"No FAISS index found under {Path(vectorstore_base_path) / category}")
+    metric = "cosine" if category == "TEXT" else "l2"
+
+    chunk_type_rows = {}
+    for i, meta in enumerate(metadatas):
+        chunk_type_rows.setdefault(meta.get("chunk_type"), []).append(i)
+    chunk_type_rows = {ct: rows for ct, rows in chunk_type_rows.items() if ct and len(rows) > top_k}
+
+    def search_all(matrix):
+        start = time.perf_counter()
+        neighbors = {ct: _topk_neighbors(matrix[rows], top_k, metric) for ct, rows in chunk_type_rows.items()}
+        return neighbors, time.perf_counter() - start
+
+    full_neighbors, full_latency = search_all(embeddings)
+    report = {
+        "category": category,
+        "method": method,
+        "top_k": top_k,
+        "num_vectors": len(embeddings),
+        "full": {"dim": embeddings.shape[1], "memory_bytes": embeddings.nbytes, "latency_s": full_latency},
+        "reduced": [],
+    }
+
+    for dim in dims:
+        if method == "pca":
+            reduced = PCAProjection.fit(embeddings, dim, center=(category == "CODE")).transform(embeddings)
+        else:
+            reduced = truncate_embeddings(embeddings, dim)
+        reduced_neighbors, latency = search_all(reduced)
+
+        hits, total = 0, 0
+        for ct, full_nb in full_neighbors.items():
+            for full_row, reduced_row in zip(full_nb, reduced_neighbors[ct]):
+                hits += len(set(full_row.tolist()) & set(reduced_row.tolist()))
+                total += top_k
+        overlap = hits / total if total else None
+
+        report["reduced"].append({
+            "dim": dim,
+            "neighbor_overlap_at_k": overlap,
+            "memory_bytes": reduced.nbytes,
+            "memory_saving": 1 - reduced.nbytes / embeddings.nbytes,
+            "latency_s": latency,
+            "latency_saving": 1 - latency / full_latency if full_latency else None,
+        })
+        print(f"[i] {category} dim={dim}: neighbor overlap@{top_k}={overlap}, memory={reduced.nbytes} bytes, "
+              f"latency={latency:.4f}s")
+
+    output_path = Path(output_path) if output_path else Path(vectorstore_base_path) / category / REPORT_FILE
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"[✓] Dimension reduction report saved to {output_path}")
+    return report
+
+
+if __name__ == "__main__":
+    evaluate_dimension_reduction("tmp/vectorstore", "TEXT", [256, 512, 1024, 2048])
+    evaluate_dimension_reduction("tmp/vectorstore", "CODE", [128, 256, 512, 1024])
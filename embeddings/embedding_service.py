@@ -0,0 +1,236 @@
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from typing import List, Optional, Union
+
+import numpy as np
+
+from config.settings import EMBEDDING_SERVICE_SOCKET, EMBEDDING_SERVICE_BATCH_WINDOW_MS, \
+    EMBEDDING_SERVICE_MAX_BATCH_TEXTS
+from embeddings.EmbeddingWrapper import BaseEmbeddingWrapper
+
+# 协议：每条消息 = 4 字节大端长度 + 内容
+# 请求：JSON {"category": "CODE" | "TEXT", "texts": [...], "is_query": bool}
+# 响应：JSON 头 {"ok": true, "count": n, "dim": d} 后紧跟一条 n * d * 4 字节的 float32 原始 buffer；
+#       出错时只返回 {"ok": false, "error": "..."}
+_LENGTH = struct.Struct(">I")
+
+
+def _send_message(sock: socket.socket, payload: bytes):
+    sock.sendall(_LENGTH.pack(len(payload)) + payload)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(min(size - len(buf), 1 << 20))
+        if not chunk:
+            raise ConnectionError("embedding service connection closed")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def _recv_message(sock: socket.socket) -> bytes:
+    (size,) = _LENGTH.unpack(_recv_exact(sock, _LENGTH.size))
+    return _recv_exact(sock, size)
+
+
+class _MicroBatcher:
+    """
+    单个 (category, is_query) 的批处理线程：取到第一条请求后，在 batch_window 内继续收集其他调用方的请求，
+    合并成一次模型调用，再按请求拆分结果。
+    同一模型的 query / document 两个批处理线程共用 model_lock，模型与 HF fast tokenizer 上同一时间只有一次推理。
+    """
+
+    def __init__(self, model: BaseEmbeddingWrapper, is_query: bool, batch_window_s: float, max_batch_texts: int,
+                 model_lock: threading.Lock):
+        self.model = model
+        self.model_lock = model_lock
+        self.is_query = is_query
+        self.batch_window_s = batch_window_s
+        self.max_batch_texts = max_batch_texts
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, texts: List[str]) -> Future:
+        future = Future()
+        self.requests.put((texts, future))
+        return future
+
+    def _collect(self) -> list:
+        batch = [self.requests.get()]
+        num_texts = len(batch[0][0])
+        deadline = time.monotonic() + self.batch_window_s
+        while num_texts < self.max_batch_texts:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(item)
+            num_texts += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [text for item_texts, _ in batch for text in item_texts]
+            try:
+                with self.model_lock:
+                    # 合并后的 query 可能多达 max_batch_texts 条，embed_query 传入列表时同样按 token 预算分 batch
+                    if self.is_query:
+                        embeddings = self.model.embed_query(texts)
+                    else:
+                        embeddings = self.model.embed_documents(texts)
+                embeddings = np.asarray(embeddings, dtype=np.float32)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            offset = 0
+            for item_texts, future in batch:
+                future.set_result(embeddings[offset:offset + len(item_texts)])
+                offset += len(item_texts)
+
+
+class EmbeddingService(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    本地 embedding 服务：进程内只加载一次 CODE / TEXT 模型，通过 Unix socket 为多个调用方提供 embedding。
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path: Union[str, Path] = EMBEDDING_SERVICE_SOCKET, categories: Optional[List[str]] = None,
+                 batch_window_ms: float = EMBEDDING_SERVICE_BATCH_WINDOW_MS,
+                 max_batch_texts: int = EMBEDDING_SERVICE_MAX_BATCH_TEXTS, models: Optional[dict] = None):
+        from embeddings.embedding_utils import init_code_embedding_wrapper, init_text_embedding_wrapper
+
+        categories = categories or ["TEXT", "CODE"]
+        if models is None:
+            models = {}
+            for category in categories:
+                print(f"[i] Loading {category} embedding model ...")
+                models[category] = init_code_embedding_wrapper(use_service=False) if category == "CODE" \
+                    else init_text_embedding_wrapper(use_service=False)
+
+        self.batchers = {}
+        for category, model in models.items():
+            model_lock = threading.Lock()
+            for is_query in (False, True):
+                self.batchers[(category, is_query)] = _MicroBatcher(model, is_query, batch_window_ms / 1000,
+                                                                    max_batch_texts, model_lock)
+
+        socket_path = Path(socket_path)
+        socket_path.parent.mkdir(parents=True, exist_ok=True)
+        if socket_path.exists():
+            socket_path.unlink()
+        super().__init__(str(socket_path), _EmbeddingRequestHandler)
+        print(f"[✓] Embedding service listening on {socket_path}")
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class _EmbeddingRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        # 同一连接上可以连续发送多个请求
+        while True:
+            try:
+                message = _recv_message(self.request)
+            except ConnectionError:
+                return
+            try:
+                request = json.loads(message)
+                batcher = self.server.batchers.get((request["category"], bool(request.get("is_query"))))
+                if batcher is None:
+                    raise ValueError(f"Category not served: {request['category']}")
+                embeddings = batcher.submit(request["texts"]).result()
+                header = {"ok": True, "count": int(embeddings.shape[0]),
+                          "dim": int(embeddings.shape[1]) if embeddings.ndim == 2 else 0}
+                _send_message(self.request, json.dumps(header).encode("utf-8"))
+                _send_message(self.request, np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+            except Exception as e:
+                _send_message(self.request, json.dumps({"ok": False, "error": str(e)}).encode("utf-8"))
+
+
+class EmbeddingServiceClient(BaseEmbeddingWrapper):
+    """
+    embedding 服务的客户端，对外接口（embed_documents / embed_query）与其他 EmbeddingWrapper 一致。
+    """
+
+    def __init__(self, category: str, socket_path: Union[str, Path] = EMBEDDING_SERVICE_SOCKET):
+        super().__init__(None)
+        self.category = category
+        self.socket_path = str(socket_path)
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> socket.socket:
+        if self._sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+            self._sock = sock
+        return self._sock
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def encode(self, texts: List[str], is_query: bool = False):
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        request = json.dumps({"category": self.category, "texts": list(texts), "is_query": is_query})
+        with self._lock:
+            try:
+                sock = self._connect()
+                _send_message(sock, request.encode("utf-8"))
+                header = json.loads(_recv_message(sock))
+                if not header.get("ok"):
+                    raise RuntimeError(f"Embedding service error: {header.get('error')}")
+                buffer = _recv_message(sock)
+            except (ConnectionError, OSError):
+                self.close()
+                raise
+        return np.frombuffer(buffer, dtype=np.float32).reshape(header["count"], header["dim"])
+
+    @property
+    def handles_batching(self) -> bool:
+        return True
+
+    def embed_documents(self, texts: List[str], batch_size: int = 16) -> List[List[float]]:
+        # 分 batch 由服务端完成（跨调用方合并 + token 预算），这里整体发送
+        return self.encode(texts, is_query=False).tolist()
+
+    def embed_query(self, text_or_texts: Union[str, List[str]]) -> Union[List[float], List[List[float]]]:
+        is_single = isinstance(text_or_texts, str)
+        emb = self.encode([text_or_texts] if is_single else text_or_texts, is_query=True).tolist()
+        return emb[0] if is_single else emb
+
+
+def serve_embedding_service(socket_path: Union[str, Path] = EMBEDDING_SERVICE_SOCKET,
+                            categories: Optional[List[str]] = None):
+    server = EmbeddingService(socket_path, categories)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    serve_embedding_service()
@@ -1,15 +1,22 @@
+from __future__ import annotations
+
 import json
 import os
 import pickle
 from pathlib import Path
-from typing import List, Union
+from typing import TYPE_CHECKING, List, Union
 
 import numpy as np
-from langchain.schema import Document
-import faiss
-from langchain_huggingface import HuggingFaceEmbeddings
-from tqdm import tqdm
+
+from config.settings import CODE_EMBEDDING_MODEL, TEXT_EMBEDDING_MODEL, CODE_EMBEDDING_BACKEND, CODE_EMBEDDING_ONNX_DIR, \
+    CODE_EMBEDDING_ONNX_QUANTIZED, ONNX_INTRA_OP_THREADS, EMBEDDING_MAX_BATCH_TOKENS, EMBEDDING_SERVICE_ENABLED
+from embeddings.EmbeddingWrapper import JinaCodeEmbeddingWrapper, QwenEmbeddingWrapper
+from embeddings.dimension_reduction import reduce_embeddings
 from prompts.prompt_loader import load_prompt
+from utils.chunk_store import load_chunk_result
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
 
 PROMPT_FILE_MAP = {
     "parent_file_summary": "parent_file_summary.txt",
@@ -21,9 +28,8 @@ PROMPT_FILE_MAP = {
 
 
 def load_chunks_from_json(json_path: Path):
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return data
+    # json_path 也可以是 chunk store 引用（{store 目录}#{key}），一次 seek 读出该 case
+    return load_chunk_result(str(json_path))
 
 
 def build_documents(chunks_json: dict, content_key: str) -> List[Document]:
@@ -35,6 +41,8 @@ def build_documents(chunks_json: dict, content_key: str) -> List[Document]:
     :param chunks_json: load 后的整个 JSON 内容（包含顶层元数据和 chunks）
     :param content_key: 使用哪个字段作为向量内容，如 "ast_subtree" 或 "llm_description"
     """
+    from langchain.schema import Document
+
     all_documents = []
     case_metadata = {k: v for k, v in chunks_json.items() if k != "chunks"}
     chunks = chunks_json["chunks"]
@@ -53,6 +61,8 @@ def build_documents(chunks_json: dict, content_key: str) -> List[Document]:
 
 
 def init_embedding_model(model_name: str, device: str = "cpu", normalize: bool = False):
+    from langchain_huggingface import HuggingFaceEmbeddings
+
     model_kwargs = {"device": device, "trust_remote_code": True}
     return HuggingFaceEmbeddings(
         model_name=model_name,
@@ -61,6 +71,34 @@ def init_embedding_model(model_name: str, device: str = "cpu", normalize: bool =
     )
 
 
+def init_code_embedding_wrapper(use_service: bool = EMBEDDING_SERVICE_ENABLED):
+    """
+    按 CODE_EMBEDDING_BACKEND 初始化 code embedding 模型：
+    - torch: HuggingFaceEmbeddings + JinaCodeEmbeddingWrapper
+    - onnx: 已导出的 ONNX 模型 + OnnxJinaCodeEmbeddingWrapper
+    use_service 为 True 时不加载模型，返回连接本地 embedding 服务的客户端。
+    """
+    if use_service:
+        from embeddings.embedding_service import EmbeddingServiceClient
+        return EmbeddingServiceClient("CODE")
+    if CODE_EMBEDDING_BACKEND == "onnx":
+        from embeddings.onnx_embedding import OnnxJinaCodeEmbeddingWrapper
+        return OnnxJinaCodeEmbeddingWrapper(CODE_EMBEDDING_ONNX_DIR,
+                                            quantized=CODE_EMBEDDING_ONNX_QUANTIZED,
+                                            intra_op_threads=ONNX_INTRA_OP_THREADS,
+                                            max_batch_tokens=EMBEDDING_MAX_BATCH_TOKENS)
+    return JinaCodeEmbeddingWrapper(init_embedding_model(CODE_EMBEDDING_MODEL),
+                                    max_batch_tokens=EMBEDDING_MAX_BATCH_TOKENS)
+
+
+def init_text_embedding_wrapper(use_service: bool = EMBEDDING_SERVICE_ENABLED):
+    if use_service:
+        from embeddings.embedding_service import EmbeddingServiceClient
+        return EmbeddingServiceClient("TEXT")
+    return QwenEmbeddingWrapper(init_embedding_model(TEXT_EMBEDDING_MODEL),
+                                max_batch_tokens=EMBEDDING_MAX_BATCH_TOKENS)
+
+
 def store_to_chroma(documents: List[Document], embedding_model,
                     type: str,
                     vectorstore_base_path: str = "tmp/vectorstore",
@@ -85,28 +123,31 @@ def store_to_chroma(documents: List[Document], embedding_model,
         print("[i] No documents to store.")
         return None, None
 
-    # === 路径逻辑修改区 ===
-    if query:
-        # 固定路径结构: query/vectorstore/CODE 或 TEXT
-        folder_path = os.path.join("query", "vectorstore", type)
-    else:
-        # 原有逻辑: 根据 metadata 创建层级路径
-        first_meta = documents[0].metadata
-        folder_path = os.path.join(
-            vectorstore_base_path,
-            type,
-            first_meta["antipattern_type"],
-            first_meta["project_name"],
-            first_meta["commit_number"],
-            str(first_meta["id"])
-        )
-    os.makedirs(folder_path, exist_ok=True)
-    index_path = os.path.join(folder_path, "faiss_index.idx")
-    metadata_path = os.path.join(folder_path, "metadata.pkl")
+    embed_documents_into_metadata(documents, embedding_model, batch_size=batch_size, query=query)
+    return write_faiss_store(documents, type, vectorstore_base_path=vectorstore_base_path,
+                             batch_size=batch_size, query=query)
+
+
+def embed_documents_into_metadata(documents: List[Document], embedding_model,
+                                  batch_size: int = 2, query: bool = False):
+    """
+    生成 embeddings 并保存在每个 document 的 metadata["embedding"] 中。
+    """
+    from tqdm import tqdm
 
     print(f"[i] Generating embeddings for {len(documents)} documents...")
 
-    # 生成 embeddings 并保存在 metadata
+    if not query:
+        if getattr(embedding_model, "handles_batching", False):
+            # 整体交给 embed_documents，由其按 token 预算分 batch 并按原顺序返回
+            embeddings = embedding_model.embed_documents([doc.page_content for doc in documents])
+        else:
+            # 没有 token 预算时逐条 embedding，避免固定条数的 batch 按最长文本 padding
+            embeddings = [embedding_model.embed_documents([doc.page_content])[0] for doc in documents]
+        for doc, emb in zip(documents, embeddings):
+            doc.metadata["embedding"] = np.array(emb, dtype=np.float32)
+        return documents
+
     for i in range(0, len(documents), batch_size):
         batch_docs = documents[i:i + batch_size]
         batch_texts = [doc.page_content for doc in batch_docs]
@@ -114,18 +155,55 @@ def store_to_chroma(documents: List[Document], embedding_model,
         for j, text in enumerate(tqdm(batch_texts,
                                       desc=f"Embedding batch {i // batch_size + 1}/{(len(documents) + batch_size - 1) // batch_size}",
                                       leave=False)):
-            if query:
-                # embed_query 对单个字符串，返回 list[float]
-                emb = embedding_model.embed_query(text)
-            else:
-                # embed_documents 要传入列表，返回 List[List[float]]
-                emb = embedding_model.embed_documents([text])[0]
+            # embed_query 对单个字符串，返回 list[float]
+            emb = embedding_model.embed_query(text)
             batch_docs[j].metadata["embedding"] = np.array(emb, dtype=np.float32)
 
+    return documents
+
+
+def get_vectorstore_folder(documents: List[Document], type: str, vectorstore_base_path: str,
+                           query: bool = False) -> str:
+    # === 路径逻辑修改区 ===
+    if query:
+        # 固定路径结构: query/vectorstore/CODE 或 TEXT
+        return os.path.join("query", "vectorstore", type)
+    # 原有逻辑: 根据 metadata 创建层级路径
+    first_meta = documents[0].metadata
+    return os.path.join(
+        vectorstore_base_path,
+        type,
+        first_meta["antipattern_type"],
+        first_meta["project_name"],
+        first_meta["commit_number"],
+        str(first_meta["id"])
+    )
+
+
+def write_faiss_store(documents: List[Document], type: str,
+                      vectorstore_base_path: str = "tmp/vectorstore",
+                      batch_size: int = 2,
+                      query: bool = False):
+    """
+    将已带有 metadata["embedding"] 的 documents 写入 FAISS 索引 + metadata.pkl。
+    """
+    import faiss
+    from tqdm import tqdm
+
+    folder_path = get_vectorstore_folder(documents, type, vectorstore_base_path, query)
+    os.makedirs(folder_path, exist_ok=True)
+    index_path = os.path.join(folder_path, "faiss_index.idx")
+    metadata_path = os.path.join(folder_path, "metadata.pkl")
+
+    # 按配置降维（query 与 corpus 使用同一 vectorstore_base_path 下的投影）
+    embeddings = np.array([doc.metadata["embedding"] for doc in documents], dtype=np.float32)
+    embeddings = reduce_embeddings(embeddings, type, vectorstore_base_path, query=query)
+    for doc, emb in zip(documents, embeddings):
+        doc.metadata["embedding"] = emb
+
     # 构建 FAISS 索引
-    dim = len(documents[0].metadata["embedding"])
+    dim = embeddings.shape[1]
     index = faiss.IndexFlatL2(dim)
-    embeddings = np.array([doc.metadata["embedding"] for doc in documents], dtype=np.float32)
 
     # 批量插入 FAISS
     print("[i] Adding embeddings to FAISS index...")
@@ -168,6 +246,8 @@ def get_query_vectorstore_dir(chunks_json_path: str | Path, vectorstore_type: st
 
 
 def add_prompts_to_documents_qwen3(documents: List[Document], prompt_dir: Union[Path, str]) -> List[Document]:
+    from langchain.schema import Document
+
     new_documents = []
 
     for doc in documents:
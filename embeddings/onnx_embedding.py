@@ -0,0 +1,188 @@
+import json
+import os
+import time
+from pathlib import Path
+from typing import List, Optional, Union
+
+import numpy as np
+
+from embeddings.EmbeddingWrapper import BaseEmbeddingWrapper
+
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_QUANTIZED_MODEL_FILE = "model.int8.onnx"
+ONNX_CONFIG_FILE = "onnx_config.json"
+
+
+def export_onnx_model(model_name: str, output_dir: Union[str, Path], task: Optional[str] = "code",
+                      quantize: bool = False, opset: int = 17) -> Path:
+    """
+    将 sentence-transformers 模型（含 pooling / normalize）整体导出为 ONNX，只需执行一次。
+
+    :param model_name: HuggingFace 模型名，如 jinaai/jina-embeddings-v4
+    :param output_dir: 导出目录，保存 model.onnx、tokenizer 以及 onnx_config.json
+    :param task: jina 模型的 task 参数（LoRA adapter），非 jina 模型传 None
+    :param quantize: 是否额外生成动态 int8 量化模型 model.int8.onnx
+    :param opset: ONNX opset 版本
+    :return: 导出目录
+    """
+    import torch
+    from embeddings.embedding_utils import init_embedding_model
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    st_model = init_embedding_model(model_name)._client
+    st_model.eval()
+    forward_kwargs = {"task": task} if task else {}
+
+    class _SentenceEmbeddingModule(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.st_model = st_model
+
+        def forward(self, input_ids, attention_mask):
+            features = {"input_ids": input_ids, "attention_mask": attention_mask}
+            return self.st_model(features, **forward_kwargs)["sentence_embedding"]
+
+    dummy = st_model.tokenizer(["public class A {}"], return_tensors="pt")
+    model_path = output_dir / ONNX_MODEL_FILE
+    print(f"[i] Exporting {model_name} to {model_path} ...")
+    with torch.no_grad():
+        torch.onnx.export(
+            _SentenceEmbeddingModule(),
+            (dummy["input_ids"], dummy["attention_mask"]),
+            str(model_path),
+            input_names=["input_ids", "attention_mask"],
+            output_names=["sentence_embedding"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "sentence_embedding": {0: "batch"},
+            },
+            opset_version=opset,
+        )
+    st_model.tokenizer.save_pretrained(str(output_dir))
+
+    config = {
+        "model_name": model_name,
+        "task": task,
+        "prompts": dict(st_model.prompts or {}),
+        "default_prompt_name": st_model.default_prompt_name,
+        "max_seq_length": st_model.max_seq_length,
+        "quantized": False,
+    }
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantized_path = output_dir / ONNX_QUANTIZED_MODEL_FILE
+        print(f"[i] Quantizing to {quantized_path} (dynamic int8) ...")
+        quantize_dynamic(
+            str(model_path),
+            str(quantized_path),
+            weight_type=QuantType.QInt8,
+            use_external_data_format=model_path.stat().st_size > 2 * 1024 ** 3,
+        )
+        config["quantized"] = True
+
+    with open(output_dir / ONNX_CONFIG_FILE, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+    print(f"[✓] ONNX model exported to {output_dir}")
+    return output_dir
+
+
+class OnnxJinaCodeEmbeddingWrapper(BaseEmbeddingWrapper):
+    """
+    ONNX Runtime 版本的 JinaCodeEmbeddingWrapper，对外接口（embed_documents / embed_query）保持一致。
+    模型需先通过 export_onnx_model 导出。
+    """
+
+    def __init__(self, onnx_dir: Union[str, Path], quantized: bool = False, intra_op_threads: Optional[int] = None,
+                 max_batch_tokens: Optional[int] = None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        onnx_dir = Path(onnx_dir)
+        with open(onnx_dir / ONNX_CONFIG_FILE, "r", encoding="utf-8") as f:
+            self.config = json.load(f)
+
+        model_file = ONNX_QUANTIZED_MODEL_FILE if quantized else ONNX_MODEL_FILE
+        if not (onnx_dir / model_file).exists():
+            raise FileNotFoundError(f"ONNX model not found: {onnx_dir / model_file}, run export_onnx_model first")
+
+        sess_options = ort.SessionOptions()
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        sess_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        sess_options.intra_op_num_threads = intra_op_threads or os.cpu_count() or 1
+        sess_options.inter_op_num_threads = 1
+
+        super().__init__(None, max_batch_tokens=max_batch_tokens)
+        self.session = ort.InferenceSession(str(onnx_dir / model_file), sess_options,
+                                            providers=["CPUExecutionProvider"])
+        self.tokenizer = AutoTokenizer.from_pretrained(str(onnx_dir), trust_remote_code=True)
+        self.max_length = self.config.get("max_seq_length")
+
+    def _apply_prompt(self, texts: List[str], is_query: bool) -> List[str]:
+        # 与 sentence-transformers 的 prompt_name 行为一致：query 用 "query" prompt，文档用默认 prompt
+        prompts = self.config.get("prompts", {})
+        prompt_name = "query" if is_query else self.config.get("default_prompt_name")
+        prompt = prompts.get(prompt_name, "") if prompt_name else ""
+        return [prompt + text for text in texts]
+
+    def encode(self, texts: List[str], is_query: bool = False):
+        inputs = self.tokenizer(
+            self._apply_prompt(texts, is_query),
+            padding=True,
+            truncation=self.max_length is not None,
+            max_length=self.max_length,
+            return_tensors="np",
+        )
+        outputs = self.session.run(
+            ["sentence_embedding"],
+            {"input_ids": inputs["input_ids"].astype(np.int64),
+             "attention_mask": inputs["attention_mask"].astype(np.int64)},
+        )
+        return outputs[0].astype(np.float32)
+
+
+def compare_onnx_with_torch(texts: List[str], onnx_dir: Union[str, Path], model_name: str,
+                            quantized: bool = False, intra_op_threads: Optional[int] = None) -> dict:
+    """
+    对比 ONNX 与 PyTorch 后端：逐条 cosine 一致性 + docs/sec 吞吐。
+    """
+    from embeddings.EmbeddingWrapper import JinaCodeEmbeddingWrapper
+    from embeddings.embedding_utils import init_embedding_model
+
+    torch_model = JinaCodeEmbeddingWrapper(init_embedding_model(model_name))
+    onnx_model = OnnxJinaCodeEmbeddingWrapper(onnx_dir, quantized=quantized, intra_op_threads=intra_op_threads)
+
+    def run(model):
+        start = time.perf_counter()
+        emb = np.array(model.embed_documents(texts), dtype=np.float32)
+        return emb, len(texts) / (time.perf_counter() - start)
+
+    torch_emb, torch_dps = run(torch_model)
+    onnx_emb, onnx_dps = run(onnx_model)
+
+    torch_norm = torch_emb / (np.linalg.norm(torch_emb, axis=1, keepdims=True) + 1e-10)
+    onnx_norm = onnx_emb / (np.linalg.norm(onnx_emb, axis=1, keepdims=True) + 1e-10)
+    cosines = np.sum(torch_norm * onnx_norm, axis=1)
+
+    report = {
+        "num_texts": len(texts),
+        "quantized": quantized,
+        "mean_cosine": float(cosines.mean()),
+        "min_cosine": float(cosines.min()),
+        "torch_docs_per_sec": torch_dps,
+        "onnx_docs_per_sec": onnx_dps,
+        "speedup": onnx_dps / torch_dps if torch_dps else None,
+    }
+    print(f"[i] ONNX vs torch: {report}")
+    return report
+
+
+if __name__ == "__main__":
+    from config.settings import CODE_EMBEDDING_MODEL, CODE_EMBEDDING_ONNX_DIR
+
+    export_onnx_model(CODE_EMBEDDING_MODEL, CODE_EMBEDDING_ONNX_DIR, quantize=True)
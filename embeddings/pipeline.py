@@ -0,0 +1,154 @@
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Union
+
+from config.settings import CODE_EMBEDDING_MODEL, TEXT_EMBEDDING_MODEL
+from embeddings.build_code_embedding import prepare_code_documents
+from embeddings.build_text_embedding import prepare_text_documents
+from embeddings.embedding_utils import (
+    load_chunks_from_json,
+    get_max_token_length,
+    init_code_embedding_wrapper,
+    init_text_embedding_wrapper,
+    embed_documents_into_metadata,
+    get_vectorstore_folder,
+    write_faiss_store,
+)
+
+_SENTINEL = object()
+
+CATEGORY_MODEL_NAMES = {"CODE": CODE_EMBEDDING_MODEL, "TEXT": TEXT_EMBEDDING_MODEL}
+CATEGORY_PREPARERS = {"CODE": prepare_code_documents, "TEXT": prepare_text_documents}
+
+
+def run_pipelined_embedding(json_paths: Iterable[Union[str, Path]], vectorstore_base_path: str,
+                            categories: List[str], num_readers: int = 2, queue_size: int = 4,
+                            on_store_done: Optional[Callable] = None) -> dict:
+    """
+    流水线方式对多个 chunk JSON 构建向量库：
+    - reader 线程：读取 JSON、构建 documents、token 长度检查与拆分
+    - 主线程（模型）：只负责 embedding 推理，始终从有界队列中取下一批已准备好的 documents
+    - writer 线程：构建并写入 FAISS 索引 + metadata
+    模型在整个过程中只加载一次。
+
+    :param json_paths: chunk JSON 文件路径（或 chunk store 引用）；可以是列表，也可以是由上游阶段边产出边消费的迭代器
+    :param vectorstore_base_path: 向量库根路径
+    :param categories: 需要构建的类别，如 ["TEXT", "CODE"]
+    :param num_readers: reader 线程数
+    :param queue_size: 各级队列的最大长度（背压）
+    :param on_store_done: 每个 (json_path, category) 处理完成后在 writer / 主线程中回调 on_store_done(json_path, category, store_dir)，
+                          没有 documents 时 store_dir 为 None
+    :return: 运行统计
+    """
+    from transformers import AutoTokenizer
+
+    models = {}
+    for category in categories:
+        models[category] = init_code_embedding_wrapper() if category == "CODE" else init_text_embedding_wrapper()
+
+    # reader 线程共享同一个迭代器；上游还未产出时 next() 阻塞，reader 随之等待
+    path_iter = iter(json_paths)
+    path_lock = threading.Lock()
+    num_files = [0]
+    prepared_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    errors = []
+    local = threading.local()
+
+    def get_tokenizer(category):
+        # HF fast tokenizer 在多线程间共享时可能出现 "Already borrowed"，因此每个线程各自加载
+        if not hasattr(local, "tokenizers"):
+            local.tokenizers = {}
+        if category not in local.tokenizers:
+            tokenizer = AutoTokenizer.from_pretrained(CATEGORY_MODEL_NAMES[category], trust_remote_code=True)
+            local.tokenizers[category] = (tokenizer, get_max_token_length(tokenizer))
+        return local.tokenizers[category]
+
+    def reader():
+        while not errors:
+            with path_lock:
+                json_path = next(path_iter, _SENTINEL)
+                if json_path is _SENTINEL:
+                    break
+                num_files[0] += 1
+            json_path = Path(json_path)
+            try:
+                chunks = load_chunks_from_json(json_path)
+                for category in categories:
+                    tokenizer, model_max_len = get_tokenizer(category)
+                    documents = CATEGORY_PREPARERS[category](chunks, tokenizer, model_max_len)
+                    prepared_queue.put((json_path, category, documents))
+            except Exception as e:
+                print(f"[Error] prepare {json_path} failed: {e}", flush=True)
+                errors.append(e)
+        prepared_queue.put(_SENTINEL)
+
+    def writer():
+        while True:
+            item = write_queue.get()
+            if item is _SENTINEL:
+                break
+            json_path, category, documents = item
+            try:
+                write_faiss_store(documents, category, vectorstore_base_path=vectorstore_base_path)
+                if on_store_done is not None:
+                    on_store_done(json_path, category,
+                                  get_vectorstore_folder(documents, category, vectorstore_base_path))
+            except Exception as e:
+                print(f"[Error] write {category} store for {json_path} failed: {e}", flush=True)
+                errors.append(e)
+
+    readers = [threading.Thread(target=reader, name=f"embedding-reader-{i}", daemon=True)
+               for i in range(num_readers)]
+    writer_thread = threading.Thread(target=writer, name="embedding-writer", daemon=True)
+    for t in readers:
+        t.start()
+    writer_thread.start()
+
+    start_time = time.perf_counter()
+    busy_time = 0.0
+    finished_readers = 0
+    num_stores = 0
+    while finished_readers < num_readers:
+        item = prepared_queue.get()
+        if item is _SENTINEL:
+            finished_readers += 1
+            continue
+        json_path, category, documents = item
+        if errors:
+            continue
+        if not documents:
+            if on_store_done is not None:
+                on_store_done(json_path, category, None)
+            continue
+        infer_start = time.perf_counter()
+        try:
+            embed_documents_into_metadata(documents, models[category])
+        except Exception as e:
+            print(f"[Error] embedding {category} for {json_path} failed: {e}", flush=True)
+            errors.append(e)
+            continue
+        busy_time += time.perf_counter() - infer_start
+        write_queue.put((json_path, category, documents))
+        num_stores += 1
+
+    write_queue.put(_SENTINEL)
+    writer_thread.join()
+    for t in readers:
+        t.join()
+
+    elapsed = time.perf_counter() - start_time
+    stats = {
+        "num_files": num_files[0],
+        "num_stores": num_stores,
+        "elapsed_s": elapsed,
+        "model_busy_s": busy_time,
+        "model_utilization": busy_time / elapsed if elapsed > 0 else 0.0,
+    }
+    print(f"[i] Pipelined embedding stats: {stats}")
+
+    if errors:
+        raise errors[0]
+    return stats
@@ -1,18 +1,26 @@
 import os
+import threading
+from functools import lru_cache
 from pathlib import Path
 from typing import Union
-from embeddings.build_code_embedding import build_code_embedding
-from embeddings.build_text_embedding import build_text_embedding
-from config.settings import ANTIPATTERN_TYPE
+
+import numpy as np
+
+from embeddings.build_code_embedding import build_code_embedding, prepare_code_documents
+from embeddings.build_text_embedding import build_text_embedding, prepare_text_documents
+from embeddings.dimension_reduction import reduce_embeddings
+from embeddings.embedding_utils import get_max_token_length, init_code_embedding_wrapper, init_text_embedding_wrapper
+from embeddings.pipeline import run_pipelined_embedding
+from config.settings import ANTIPATTERN_TYPE, CODE_EMBEDDING_MODEL, TEXT_EMBEDDING_MODEL
+from utils.chunk_store import chunk_output_exists, get_chunk_store, get_chunk_store_root
 from utils.utils import exist_chunk_json, iter_case_paths
 
 antipattern_type = ANTIPATTERN_TYPE
 
 
 def run_embedding_pipeline(chunks_json_path: Union[str, Path], query: bool = False, ablation: bool = False):
-    chunks_json_path = Path(chunks_json_path)
     vectorstore_base_path = "tmp_ablation/vectorstore"
-    if not chunks_json_path.exists():
+    if not chunk_output_exists(str(chunks_json_path)):
         raise FileNotFoundError(f"Chunk JSON file does not exist: {chunks_json_path}")
     if not ablation:
         vectorstore_base_path = "tmp/vectorstore"
@@ -26,15 +34,62 @@ def run_embedding_pipeline(chunks_json_path: Union[str, Path], query: bool = Fal
     return path
 
 
-def embedding_all_chunks(base_dir, antipattern_type=None, mode="ast", ablation=False):
+@lru_cache(maxsize=None)
+def get_query_embedding_resources(category: str):
+    """
+    in-memory query 使用的模型、tokenizer 只加载一次，供后续所有 query 复用。
+    返回的锁用于串行化同一模型上的推理（HF fast tokenizer 不支持多线程同时调用）。
+    """
+    from transformers import AutoTokenizer
+
+    model_name = CODE_EMBEDDING_MODEL if category == "CODE" else TEXT_EMBEDDING_MODEL
+    model = init_code_embedding_wrapper() if category == "CODE" else init_text_embedding_wrapper()
+    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+    return model, tokenizer, get_max_token_length(tokenizer), threading.Lock()
+
+
+def run_embedding_in_memory(chunks: dict, ablation: bool = False) -> dict:
+    """
+    对内存中的 query 分块结果做 embedding，不落盘。
+
+    :param chunks: build_chunks(..., persist=False) 返回的分块结果
+    :param ablation: 是否消融（只构建 CODE）
+    :return: {category: {"embeddings": np.ndarray, "metadatas": list[dict]}}
+    """
+    vectorstore_base_path = "tmp_ablation/vectorstore" if ablation else "tmp/vectorstore"
+    categories = ["CODE"] if ablation else ["TEXT", "CODE"]
+    preparers = {"CODE": prepare_code_documents, "TEXT": prepare_text_documents}
+
+    query_stores = {}
+    for category in categories:
+        model, tokenizer, model_max_len, lock = get_query_embedding_resources(category)
+        with lock:
+            documents = preparers[category](chunks, tokenizer, model_max_len)
+            if not documents:
+                continue
+            embeddings = model.embed_query([doc.page_content for doc in documents])
+        embeddings = np.array(embeddings, dtype=np.float32)
+        # 与构建 query 向量库时一致：按 corpus 的配置降维
+        embeddings = reduce_embeddings(embeddings, category, vectorstore_base_path, query=True)
+        metadatas = [doc.metadata for doc in documents]
+        for meta, emb in zip(metadatas, embeddings):
+            meta["embedding"] = emb
+        query_stores[category] = {"embeddings": embeddings, "metadatas": metadatas}
+        print(f"[✓] In-memory {category} query embeddings: {embeddings.shape}")
+
+    return query_stores
+
+
+def embedding_all_chunks(base_dir, antipattern_type=None, mode="ast", ablation=False, pipelined=True):
     """
-    遍历 base_dir 下所有 JSON 文件（包括子目录），并对每个 JSON 文件执行 embedding pipeline。
+    遍历 base_dir 下所有 JSON 文件（包括子目录）以及 chunk store 中的记录，并对每个 case 执行 embedding pipeline。
 
     Args:
         base_dir: 根目录，递归查找 JSON 文件。
         antipattern_type: 可选参数，如果传入，可用于日志或过滤（这里暂不做过滤）。
         mode: 模式参数，传给 pipeline（可扩展）。
         :param ablation: 是否消融
+        :param pipelined: 是否使用流水线（读取/预处理、推理、写入并行，模型只加载一次）
     """
     base_dir = os.path.join(base_dir, antipattern_type)
     json_files = []
@@ -43,8 +98,26 @@ def embedding_all_chunks(base_dir, antipattern_type=None, mode="ast", ablation=F
             if file.endswith(".json"):
                 json_files.append(os.path.join(root, file))
 
+    # chunk store 中的记录按 shard / offset 顺序排在后面，读取时顺序访问；
+    # 同一 case 同时有 JSON 文件与 store 记录时（如 import_chunk_jsons 保留了原文件）以 store 为准
+    store_root = get_chunk_store_root(base_dir)
+    if store_root.is_dir():
+        store = get_chunk_store(store_root)
+        index = store.load_index()
+        store_refs = store.iter_refs(index)
+        print(f"[i] Found {len(store_refs)} records in chunk store {store_root}")
+        json_files = [path for path in json_files
+                      if not (os.path.dirname(path) == base_dir and Path(path).stem in index)]
+        json_files.extend(store_refs)
+
     print(f"[i] Found {len(json_files)} JSON files in {base_dir}")
 
+    if pipelined:
+        vectorstore_base_path = "tmp_ablation/vectorstore" if ablation else "tmp/vectorstore"
+        categories = ["CODE"] if ablation else ["TEXT", "CODE"]
+        run_pipelined_embedding(json_files, vectorstore_base_path, categories)
+        return "✅ EMBEDDING OVER"
+
     for json_path in json_files:
         run_embedding_pipeline(json_path, ablation=ablation)
 
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from config.settings import LLM_CACHE_PATH, LLM_CACHE_TTL_DAYS, LLM_CACHE_MAX_ENTRIES
+
+# 每写入多少条检查一次 TTL / 容量淘汰
+_PRUNE_EVERY = 200
+
+
+def make_cache_key(model: str, system_prompt: str, rendered_prompt: str, params: Optional[dict] = None) -> str:
+    """(模型, system prompt, 渲染后的 user prompt, 生成参数) 的 sha256"""
+    payload = json.dumps([model, system_prompt, rendered_prompt, params or {}], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    基于 SQLite 的 LLM 响应缓存，多线程 / 多进程共享同一个文件（WAL 模式）。
+    - ttl_days: 条目写入超过该天数后视为过期，0 表示不过期
+    - max_entries: 超过该条数时按最近访问时间淘汰，0 表示不限
+    """
+
+    def __init__(self, path=LLM_CACHE_PATH, ttl_days: float = LLM_CACHE_TTL_DAYS,
+                 max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.path = Path(path)
+        self.ttl_s = ttl_days * 86400 if ttl_days else None
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0, "writes": 0}
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._writes_since_prune = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        # fork 出的子进程不能复用父进程的连接
+        if self._conn is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, created_at REAL, accessed_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed ON llm_cache(accessed_at)")
+            conn.commit()
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl_s and now - row[1] > self.ttl_s):
+                self.stats["misses"] += 1
+                return None
+            conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+            self.stats["hits"] += 1
+            return row[0]
+
+    def put(self, key: str, model: str, response: str):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?, ?)", (key, model, response, now, now))
+            conn.commit()
+            self.stats["writes"] += 1
+            self._writes_since_prune += 1
+            if self._writes_since_prune >= _PRUNE_EVERY:
+                self._prune(conn)
+
+    def _prune(self, conn: sqlite3.Connection) -> int:
+        removed = 0
+        if self.ttl_s:
+            removed += conn.execute("DELETE FROM llm_cache WHERE created_at < ?",
+                                    (time.time() - self.ttl_s,)).rowcount
+        if self.max_entries:
+            (count,) = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+            if count > self.max_entries:
+                removed += conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN "
+                    "(SELECT key FROM llm_cache ORDER BY accessed_at LIMIT ?)",
+                    (count - self.max_entries,),
+                ).rowcount
+        conn.commit()
+        self._writes_since_prune = 0
+        return removed
+
+    def prune(self) -> int:
+        """立即执行 TTL / 容量淘汰，返回删除的条数"""
+        with self._lock:
+            return self._prune(self._connect())
+
+    def invalidate(self, key: Optional[str] = None, model: Optional[str] = None) -> int:
+        """删除指定 key、指定模型的全部条目，或（都不传时）清空缓存"""
+        with self._lock:
+            conn = self._connect()
+            if key is not None:
+                removed = conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,)).rowcount
+            elif model is not None:
+                removed = conn.execute("DELETE FROM llm_cache WHERE model = ?", (model,)).rowcount
+            else:
+                removed = conn.execute("DELETE FROM llm_cache").rowcount
+            conn.commit()
+            return removed
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            (size,) = self._connect().execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+            return {**self.stats, "size": size}
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats.update(hits=0, misses=0, writes=0)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_llm_cache() -> LLMResponseCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMResponseCache()
+        return _cache
+
+
+def get_llm_cache_stats() -> dict:
+    return get_llm_cache().get_stats()
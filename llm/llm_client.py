@@ -1,25 +1,113 @@
+from __future__ import annotations
+
+import asyncio
 import time
+import weakref
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+from config.settings import LLM_MODEL, LLM_MAX_CONCURRENCY, LLM_CACHE_ENABLED, LLM_CACHE_REFRESH
+from llm.llm_cache import get_llm_cache, make_cache_key
+
+if TYPE_CHECKING:
+    from langchain_ollama.chat_models import ChatOllama
+    from langchain_core.prompts import PromptTemplate
+
+# 传给 ChatOllama 的生成参数（temperature 等），同时作为缓存 key 的一部分
+LLM_PARAMS = {}
+
+# 每个事件循环一个全局信号量，限制同时进行的 LLM 请求数
+_llm_semaphores = weakref.WeakKeyDictionary()
+# 每个事件循环一份异步 chain（ChatOllama 内部的 httpx.AsyncClient 连接池绑定在创建它的事件循环上）
+_async_chains = weakref.WeakKeyDictionary()
+
+
+@lru_cache(maxsize=None)
+def get_output_parser():
+    # langchain 在第一次调用 LLM 时才导入
+    from langchain_core.output_parsers import StrOutputParser
+    return StrOutputParser()
+
+
+@lru_cache(maxsize=64)
+def get_prompt_template(user_prompt_template: str) -> PromptTemplate:
+    from langchain_core.prompts import PromptTemplate
+    return PromptTemplate.from_template(user_prompt_template)
+
+
+def _new_chat_model(system_prompt_template: str) -> ChatOllama:
+    from langchain_ollama.chat_models import ChatOllama
+    return ChatOllama(model=LLM_MODEL, system=system_prompt_template, **LLM_PARAMS)
+
+
+@lru_cache(maxsize=64)
+def get_chat_model(system_prompt_template: str) -> ChatOllama:
+    """按 system prompt 复用 ChatOllama 客户端，其内部的 httpx 客户端保持连接池"""
+    return _new_chat_model(system_prompt_template)
+
+
+@lru_cache(maxsize=64)
+def get_chain(system_prompt_template: str, user_prompt_template: str):
+    """同一对 (system, user) prompt 只组装一次 chain"""
+    return get_prompt_template(user_prompt_template) | get_chat_model(system_prompt_template) | get_output_parser()
+
 
-from langchain_ollama.chat_models import ChatOllama
-from langchain_core.prompts import PromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from config.settings import LLM_MODEL
+def _get_async_chain(system_prompt_template: str, user_prompt_template: str):
+    chains = _async_chains.setdefault(asyncio.get_running_loop(), {})
+    key = (system_prompt_template, user_prompt_template)
+    chain = chains.get(key)
+    if chain is None:
+        llm = _new_chat_model(system_prompt_template)
+        chain = get_prompt_template(user_prompt_template) | llm | get_output_parser()
+        chains[key] = chain
+    return chain
 
-parser = StrOutputParser()
 
+def clear_llm_registry():
+    """修改 LLM_PARAMS 等配置后调用，丢弃已缓存的客户端与 chain"""
+    get_prompt_template.cache_clear()
+    get_chat_model.cache_clear()
+    get_chain.cache_clear()
+    _async_chains.clear()
 
-def run_llm(system_prompt_template: str, user_prompt_template: str, variables: dict) -> str:
+
+def _get_llm_semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    semaphore = _llm_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+        _llm_semaphores[loop] = semaphore
+    return semaphore
+
+
+def _lookup_cache(prompt: PromptTemplate, system_prompt_template: str, variables: dict,
+                  use_cache: bool, refresh: bool):
+    """返回 (cache_key, 命中的响应)；不使用缓存时 cache_key 为 None"""
+    if not use_cache:
+        return None, None
+    key = make_cache_key(LLM_MODEL, system_prompt_template, prompt.format(**variables), LLM_PARAMS)
+    if refresh:
+        return key, None
+    return key, get_llm_cache().get(key)
+
+
+def run_llm(system_prompt_template: str, user_prompt_template: str, variables: dict,
+            use_cache: bool = LLM_CACHE_ENABLED, refresh: bool = LLM_CACHE_REFRESH) -> str:
     """
     通用大模型调用接口，支持失败重试 + 运行时间统计。
+    use_cache 为 True 时先查 LLM 响应缓存；refresh 为 True 时跳过查找、重新调用并覆盖缓存条目。
     """
     print("talk with llm")
 
     start_time = time.perf_counter()
 
-    prompt = PromptTemplate.from_template(user_prompt_template)
-    llm = ChatOllama(model=LLM_MODEL, system=system_prompt_template)
+    prompt = get_prompt_template(user_prompt_template)
+    cache_key, cached = _lookup_cache(prompt, system_prompt_template, variables, use_cache, refresh)
+    if cached is not None:
+        print("[i] LLM cache hit")
+        return cached
 
-    chain = prompt | llm | parser
+    chain = get_chain(system_prompt_template, user_prompt_template)
 
     max_retries = 3
     for attempt in range(1, max_retries + 1):
@@ -36,4 +124,40 @@ def run_llm(system_prompt_template: str, user_prompt_template: str, variables: d
     elapsed = time.perf_counter() - start_time
     print(f"run_llm elapsed time: {elapsed:.3f}s")
 
+    if cache_key is not None:
+        get_llm_cache().put(cache_key, LLM_MODEL, output)
+    return output
+
+
+async def arun_llm(system_prompt_template: str, user_prompt_template: str, variables: dict,
+                   use_cache: bool = LLM_CACHE_ENABLED, refresh: bool = LLM_CACHE_REFRESH) -> str:
+    """
+    run_llm 的异步版本，同时进行的请求数受 LLM_MAX_CONCURRENCY 限制（缓存命中不占用并发名额）。
+    """
+    prompt = get_prompt_template(user_prompt_template)
+    cache_key, cached = _lookup_cache(prompt, system_prompt_template, variables, use_cache, refresh)
+    if cached is not None:
+        return cached
+
+    async with _get_llm_semaphore():
+        start_time = time.perf_counter()
+
+        chain = _get_async_chain(system_prompt_template, user_prompt_template)
+
+        max_retries = 3
+        for attempt in range(1, max_retries + 1):
+            try:
+                output = await chain.ainvoke(variables)
+                break
+            except Exception as e:
+                print(f"Attempt {attempt} failed: {e}")
+                if attempt == max_retries:
+                    raise
+                await asyncio.sleep(1)
+
+        elapsed = time.perf_counter() - start_time
+        print(f"arun_llm elapsed time: {elapsed:.3f}s")
+
+    if cache_key is not None:
+        get_llm_cache().put(cache_key, LLM_MODEL, output)
     return output
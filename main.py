@@ -33,6 +33,10 @@ if __name__ == "__main__":
     # vectorstore_path = "/Users/moncheri/Downloads/main/重构/反模式修复数据集构建/RefactorRAG/Anti-PatternRAG/tmp/vectorstore"
     base_dir = "/Users/moncheri/Downloads/main/重构/反模式修复数据集构建/RefactorRAG/Anti-PatternRAG/tmp/merged_match_scores"
 
+    # # 流水线方式：分块、embedding、登记评分三个阶段重叠执行（等价于下面 CH 的三步）
+    # from pipeline.stage_runner import run_stage_pipeline
+    # run_stage_pipeline(Path(DATA_DIR), "CH")
+
     # # 非消融
     # # main()
     # # 进行 CH chunk
@@ -0,0 +1,264 @@
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import List, Optional
+
+from config.settings import CHUNK_WORKERS, CHUNK_GROUP_ID_MODE, CHUNK_INCREMENTAL
+from embeddings.pipeline import run_pipelined_embedding
+from retriever.init_vectprstpre import add_merged_candidate, score_candidate_pair, save_pair_scores
+from retriever.runner import batch_process_query, get_chunk_type_weight_path
+from splitter.chunk_manifest import ChunkManifest
+from splitter.runner import assign_group_ids, check_group_id_mode, select_cases_to_build, build_case
+from splitter.strategy_registry import load_splitter_by_mode
+from utils.chunk_store import is_store_ref, load_chunk_result
+
+_SENTINEL = object()
+
+
+class IncrementalPairScorer:
+    """
+    增量的 all-pairs 评分：每登记一个 case，就与已登记的全部 case 双向打分并保存，
+    输出与 match_merged_chunks_faiss / match_merged_chunks_faiss_ablation 相同（tmp/merged_match_scores/...）。
+    最后一个 case 登记完成时全部 case 对已评分完毕。
+    """
+
+    def __init__(self, vectorstore_base_path, antipattern_type, categories: List[str], base_output_dir):
+        self.vectorstore_base_path = Path(vectorstore_base_path)
+        self.antipattern_type = antipattern_type
+        # 与 match_merged_chunks_faiss 相同的类别顺序（CODE 在前），保存的得分 JSON 键顺序一致
+        self.categories = tuple(category for category in ("CODE", "TEXT") if category in categories)
+        self.base_output_dir = Path(base_output_dir)
+        self.candidates = {}
+        self.group_ids = {}
+        self.folder_paths = {}
+        self.num_pairs = 0
+
+    def register(self, store_dirs: dict) -> int:
+        """
+        :param store_dirs: 一个 case 的 {category: 向量库目录}
+        :return: 本次新增评分的 case 对数
+        """
+        rel_path_str = None
+        for category, store_dir in store_dirs.items():
+            category_base_path = self.vectorstore_base_path / category
+            rel_path_str = add_merged_candidate(self.candidates, category, category_base_path,
+                                                Path(store_dir) / "faiss_index.idx", self.antipattern_type,
+                                                self.group_ids, self.folder_paths) or rel_path_str
+        if rel_path_str is None:
+            return 0
+
+        new_cand = self.candidates[rel_path_str]
+        num_pairs = 0
+        for other_path, other_cand in self.candidates.items():
+            if other_path == rel_path_str:
+                continue
+            for query_cand, candidate_cand in ((new_cand, other_cand), (other_cand, new_cand)):
+                combined_results = score_candidate_pair(query_cand, candidate_cand, self.group_ids,
+                                                        self.folder_paths, self.categories)
+                save_pair_scores(combined_results, query_cand, candidate_cand, self.folder_paths,
+                                 self.base_output_dir)
+                num_pairs += 1
+        self.num_pairs += num_pairs
+        return num_pairs
+
+
+def get_existing_store_dirs(chunk_output: str, vectorstore_base_path, categories: List[str]) -> Optional[dict]:
+    """
+    已是最新的 case 在上次运行中写出的向量库 {category: 目录}（路径规则同 get_vectorstore_folder）；
+    任一类别缺失，或向量库比 chunk JSON 旧时返回 None，需重新 embedding。
+    """
+    result = load_chunk_result(chunk_output)
+    chunk_mtime = None if is_store_ref(chunk_output) else Path(chunk_output).stat().st_mtime
+    store_dirs = {}
+    for category in categories:
+        store_dir = Path(vectorstore_base_path, category, result["antipattern_type"], result["project_name"],
+                         result["commit_number"], str(result["id"]))
+        index_path = store_dir / "faiss_index.idx"
+        if not index_path.exists() or (chunk_mtime is not None and index_path.stat().st_mtime < chunk_mtime):
+            return None
+        store_dirs[category] = str(store_dir)
+    return store_dirs
+
+
+def _iter_queue(q: queue.Queue):
+    while True:
+        item = q.get()
+        if item is _SENTINEL:
+            return
+        yield item
+
+
+def _drain_queue(q: queue.Queue, producer: threading.Thread):
+    """取走 q 中剩余的元素，直到收到 _SENTINEL 或生产者线程已结束（_SENTINEL 可能已被下游取走）"""
+    while True:
+        try:
+            item = q.get(timeout=0.1)
+        except queue.Empty:
+            if not producer.is_alive():
+                return
+            continue
+        if item is _SENTINEL:
+            return
+
+
+def run_stage_pipeline(base_dir, antipattern_type, mode: str = "ast", ablation: bool = False,
+                       chunk_workers: int = CHUNK_WORKERS, group_id_mode: str = CHUNK_GROUP_ID_MODE,
+                       incremental: bool = CHUNK_INCREMENTAL, queue_size: int = 4, num_readers: int = 2,
+                       top_k: int = 5) -> dict:
+    """
+    分块 → embedding → 登记 / 评分 三个阶段流水线执行，替代 main.py 中
+    chunk_all_cases → embedding_all_chunks → batch_process_vectorstore_query 的逐阶段全量屏障：
+    - chunk 阶段：独立线程驱动进程池（chunk_workers），在途 case 数有上限，结果放入有界队列
+    - embedding 阶段：主线程运行 run_pipelined_embedding（模型只加载一次），边接收分块结果边推理
+    - 登记 / 评分阶段：一个 case 的全部类别向量库写完后立即与已登记的 case 双向打分
+    各阶段之间的队列都有上限（queue_size），下游慢时上游随之阻塞。全部 case 完成后再按叶子目录聚合 top_k。
+    总耗时接近最慢的一个阶段，而不是各阶段之和。
+
+    :return: 各阶段统计与 batch_process_query 的聚合结果
+    """
+    vectorstore_base_path = "tmp_ablation/vectorstore" if ablation else "tmp/vectorstore"
+    scores_dir = Path("tmp_ablation/merged_match_scores" if ablation else "tmp/merged_match_scores")
+    categories = ["CODE"] if ablation else ["TEXT", "CODE"]
+
+    check_group_id_mode(group_id_mode, chunk_workers)
+    assigned = assign_group_ids(base_dir, antipattern_type, group_id_mode)
+    manifest = None
+    todo, reused, fingerprints = assigned, [], {}
+    if incremental:
+        manifest = ChunkManifest(antipattern_type, mode)
+        todo, reused, fingerprints = select_cases_to_build(manifest, assigned, base_dir, antipattern_type)
+    print(f"[i] Stage pipeline: {len(assigned)} cases, {len(todo)} to chunk, chunk_workers={chunk_workers}, "
+          f"queue_size={queue_size}")
+
+    chunk_queue = queue.Queue(maxsize=queue_size)
+    ready_queue = queue.Queue(maxsize=queue_size)
+    errors = []
+    stats = {"chunked": 0, "chunk_failed": 0, "reused": len(reused), "reused_stores": 0, "embedded": 0,
+             "registered": 0, "chunk_s": 0.0, "score_s": 0.0}
+
+    def chunk_stage():
+        # 已是最新的 case：向量库也已存在时直接登记评分，否则进入 embedding；
+        # 其余 case 提交到进程池，在途数不超过 chunk_workers + queue_size
+        start = time.perf_counter()
+        results = []
+        try:
+            for case_path, group_id, path in reused:
+                store_dirs = get_existing_store_dirs(path, vectorstore_base_path, categories)
+                if store_dirs:
+                    stats["reused_stores"] += 1
+                    ready_queue.put(store_dirs)
+                else:
+                    chunk_queue.put(path)
+            if chunk_workers <= 1:
+                build_chunks = load_splitter_by_mode(mode)
+                for case_path, group_id in todo:
+                    if errors:
+                        break
+                    _, path = build_chunks(case_path, antipattern_type, group_id)
+                    results.append((case_path, group_id, str(path) if path else None))
+                    stats["chunked"] += 1
+                    if path:
+                        chunk_queue.put(str(path))
+            else:
+                with ProcessPoolExecutor(max_workers=chunk_workers) as executor:
+                    pending = {}
+                    todo_iter = iter(todo)
+                    while True:
+                        while not errors and len(pending) < chunk_workers + queue_size:
+                            item = next(todo_iter, None)
+                            if item is None:
+                                break
+                            case_path, group_id = item
+                            pending[executor.submit(build_case, mode, case_path, antipattern_type, group_id)] = item
+                        if not pending:
+                            break
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            case_path, group_id = pending.pop(future)
+                            try:
+                                path, _ = future.result()
+                            except Exception as e:
+                                print(f"[Error] chunk {case_path} failed: {e}", flush=True)
+                                stats["chunk_failed"] += 1
+                                continue
+                            results.append((case_path, group_id, path))
+                            stats["chunked"] += 1
+                            if path:
+                                chunk_queue.put(path)
+        except Exception as e:
+            print(f"[Error] chunk stage failed: {e}", flush=True)
+            errors.append(e)
+        finally:
+            if manifest is not None:
+                for case_path, group_id, path in results:
+                    case_key, fingerprint, files = fingerprints[case_path]
+                    manifest.update(case_key, fingerprint, files, group_id, path)
+                manifest.save()
+            stats["chunk_s"] = time.perf_counter() - start
+            chunk_queue.put(_SENTINEL)
+
+    scorer = IncrementalPairScorer(vectorstore_base_path, antipattern_type, categories, scores_dir)
+
+    def score_stage():
+        while True:
+            item = ready_queue.get()
+            if item is _SENTINEL:
+                return
+            if errors:
+                continue
+            start = time.perf_counter()
+            try:
+                num_pairs = scorer.register(item)
+                stats["registered"] += 1
+                print(f"[✓] Registered {sorted(item.values())[0]}, {num_pairs} new pairs scored", flush=True)
+            except Exception as e:
+                print(f"[Error] score stage failed: {e}", flush=True)
+                errors.append(e)
+            stats["score_s"] += time.perf_counter() - start
+
+    # 一个 case 的全部类别都处理完后才进入评分阶段
+    done_categories = defaultdict(dict)
+    done_lock = threading.Lock()
+
+    def on_store_done(json_path, category, store_dir):
+        with done_lock:
+            case_stores = done_categories[str(json_path)]
+            case_stores[category] = store_dir
+            if len(case_stores) < len(categories):
+                return
+            del done_categories[str(json_path)]
+            stats["embedded"] += 1
+        store_dirs = {category: store_dir for category, store_dir in case_stores.items() if store_dir}
+        if store_dirs:
+            ready_queue.put(store_dirs)
+
+    chunk_thread = threading.Thread(target=chunk_stage, name="stage-chunk", daemon=True)
+    score_thread = threading.Thread(target=score_stage, name="stage-score", daemon=True)
+    start_time = time.perf_counter()
+    chunk_thread.start()
+    score_thread.start()
+    try:
+        stats["embedding"] = run_pipelined_embedding(_iter_queue(chunk_queue), vectorstore_base_path, categories,
+                                                     num_readers=num_readers, queue_size=queue_size,
+                                                     on_store_done=on_store_done)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        # embedding 中止（或 reader 因错误提前退出）后继续取走分块结果，避免 chunk 线程阻塞在有界队列上
+        _drain_queue(chunk_queue, chunk_thread)
+        chunk_thread.join()
+        ready_queue.put(_SENTINEL)
+        score_thread.join()
+
+    stats["pairs"] = scorer.num_pairs
+    stats["elapsed_s"] = time.perf_counter() - start_time
+    print(f"[i] Stage pipeline stats: {stats}")
+    if errors:
+        raise errors[0]
+
+    stats["results"] = batch_process_query(scores_dir, get_chunk_type_weight_path(antipattern_type, ablation),
+                                           antipattern_type, top_k)
+    return stats
@@ -1,12 +1,29 @@
 import os
+from functools import lru_cache
 
 
-def load_prompt(name: str) -> str:
-    path = os.path.join("prompts", f"{name}.txt")
+@lru_cache(maxsize=256)
+def _read_prompt_file(path: str) -> str:
     with open(path, "r", encoding="utf-8") as f:
         return f.read()
 
 
+def load_prompt(name: str) -> str:
+    # prompt 文件在运行期间不会变化，按绝对路径缓存，每个文件只读一次
+    path = os.path.abspath(os.path.join("prompts", f"{name}.txt"))
+    return _read_prompt_file(path)
+
+
+def load_split_prompt(name: str) -> tuple[str, str]:
+    """load_prompt + split_prompt，返回 (system_prompt, user_prompt)，结果同样被缓存"""
+    return _split_prompt_cached(load_prompt(name))
+
+
+@lru_cache(maxsize=256)
+def _split_prompt_cached(prompt_template: str) -> tuple[str, str]:
+    return split_prompt(prompt_template)
+
+
 def split_prompt(prompt_template: str) -> tuple[str, str]:
     """
     拆分包含 ### SYSTEM 和 ### USER 的 prompt_template 字符串，
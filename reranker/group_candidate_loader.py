@@ -1,31 +1,155 @@
 import json
+import threading
 from pathlib import Path
-from typing import Optional
+from typing import Iterable, Optional, Tuple, Union
 
+from utils.chunk_store import get_chunk_store, get_chunk_store_root
 
-def load_group_chunks_by_type(group_id: str, chunk_type: str, embedding_base_dir: Path) -> Optional[str]:
+# rerank 使用的 chunk 文本字段，按顺序取第一个非空的（LLM 描述优先，其次 AST）
+RERANK_CONTENT_KEYS = ("llm_description", "ast_subtree")
+
+
+def get_chunk_texts_by_type(chunk_result: dict, content_keys=RERANK_CONTENT_KEYS) -> dict:
+    """一个 case 的分块结果 → {chunk_type: 同类型 chunk 文本按顺序拼接}"""
+    parts = {}
+    for chunk in chunk_result.get("chunks", []):
+        chunk_type = chunk.get("chunk_type")
+        text = next((chunk[key] for key in content_keys if chunk.get(key)), None)
+        if chunk_type and text:
+            parts.setdefault(chunk_type, []).append(text)
+    return {chunk_type: "\n".join(texts) for chunk_type, texts in parts.items()}
+
+
+class GroupChunkIndex:
+    """
+    (chunk_type, group_id) → chunk 文本 的内存索引。
+    每个 chunk_type 的 {embedding_base_dir}/{chunk_type}/content.json 只在第一次用到时解析一次，
+    文件 size / mtime 变化后重新加载。group_id 统一按 str 比较（得分文件中的 group_id 来自 JSON key）。
+    同一 group_id 出现多次时与原先的线性查找一致，取第一条。
     """
-    给定 group_id 和 chunk_type，加载该 chunk_type 下的 chunk 文本
 
-    Returns:
-        对应的 chunk 文本 or None
+    def __init__(self, embedding_base_dir: Union[str, Path]):
+        self.embedding_base_dir = Path(embedding_base_dir)
+        self._lock = threading.Lock()
+        self._by_type = {}  # chunk_type -> (文件签名, {group_id: text})
+
+    def _load_type(self, chunk_type: str) -> dict:
+        content_file = self.embedding_base_dir / chunk_type / "content.json"
+        try:
+            stat = content_file.stat()
+        except FileNotFoundError:
+            return {}
+        signature = (stat.st_size, stat.st_mtime_ns)
+
+        with self._lock:
+            cached = self._by_type.get(chunk_type)
+            if cached and cached[0] == signature:
+                return cached[1]
+
+            try:
+                with open(content_file, "r", encoding="utf-8") as f:
+                    docs = json.load(f)
+            except Exception as e:
+                print(f"[ERROR] Load failed: {e}")
+                return {}
+
+            texts = {}
+            for doc in docs:
+                group_id = doc.get("metadata", {}).get("group_id")
+                if group_id is not None:
+                    texts.setdefault(str(group_id), doc.get("page_content", ""))
+            self._by_type[chunk_type] = (signature, texts)
+            return texts
+
+    def get(self, chunk_type: str, group_id) -> Optional[str]:
+        return self._load_type(chunk_type).get(str(group_id))
+
+    def get_many(self, keys: Iterable[Tuple[str, str]]) -> dict:
+        """
+        批量查询，每个 chunk_type 的内容文件最多解析一次
+
+        Args:
+            keys: (chunk_type, group_id) 列表
+
+        Returns:
+            {(chunk_type, group_id): text}，找不到的 key 不出现在结果中
+        """
+        results = {}
+        for chunk_type, group_id in keys:
+            text = self._load_type(chunk_type).get(str(group_id))
+            if text is not None:
+                results[(chunk_type, group_id)] = text
+        return results
+
+
+class ChunkResultGroupIndex(GroupChunkIndex):
+    """
+    直接由分块结果（chunk_dir 下的 chunk JSON 与 chunk store）构建的 (chunk_type, group_id) → 文本 索引，
+    不需要额外的 content.json。第一次查询时读取全部分块结果，之后常驻内存；候选库重建后调用 refresh()。
     """
-    chunk_dir = embedding_base_dir / chunk_type
-    content_file = chunk_dir / "content.json"
 
-    if not content_file.exists():
-        return None
+    def __init__(self, chunk_dir: Union[str, Path], content_keys=RERANK_CONTENT_KEYS):
+        super().__init__(chunk_dir)
+        self.content_keys = content_keys
+        self._loaded = False
+
+    def _iter_chunk_results(self):
+        # store 记录在前：同一 group_id 以先出现的为准，与 embedding_all_chunks 一样以 store 为准
+        for _, result in get_chunk_store(get_chunk_store_root(self.embedding_base_dir)).iter_records():
+            yield result
+        for json_path in sorted(self.embedding_base_dir.glob("*.json")):
+            try:
+                with open(json_path, "r", encoding="utf-8") as f:
+                    yield json.load(f)
+            except Exception as e:
+                print(f"[ERROR] Load failed: {json_path}: {e}")
+
+    def _load_type(self, chunk_type: str) -> dict:
+        with self._lock:
+            if not self._loaded:
+                by_type = {}
+                for result in self._iter_chunk_results():
+                    group_id = result.get("group_id")
+                    if group_id is None or group_id < 0:
+                        continue
+                    for ct, text in get_chunk_texts_by_type(result, self.content_keys).items():
+                        by_type.setdefault(ct, {}).setdefault(str(group_id), text)
+                self._by_type = {ct: (None, texts) for ct, texts in by_type.items()}
+                self._loaded = True
+            cached = self._by_type.get(chunk_type)
+            return cached[1] if cached else {}
+
+    def refresh(self):
+        with self._lock:
+            self._by_type = {}
+            self._loaded = False
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
 
-    try:
-        with open(content_file, "r", encoding="utf-8") as f:
-            docs = json.load(f)
-    except Exception as e:
-        print(f"[ERROR] Load failed: {e}")
-        return None
+def get_group_chunk_index(embedding_base_dir: Union[str, Path]) -> GroupChunkIndex:
+    key = str(Path(embedding_base_dir).resolve())
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = GroupChunkIndex(embedding_base_dir)
+        return _indexes[key]
 
-    for doc in docs:
-        metadata = doc.get("metadata", {})
-        if metadata.get("group_id") == group_id:
-            return doc.get("page_content", "")
 
-    return None
+def get_chunk_result_index(chunk_dir: Union[str, Path]) -> ChunkResultGroupIndex:
+    key = "chunks:" + str(Path(chunk_dir).resolve())
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = ChunkResultGroupIndex(chunk_dir)
+        return _indexes[key]
+
+
+def load_group_chunks_by_type(group_id: str, chunk_type: str, embedding_base_dir: Path) -> Optional[str]:
+    """
+    给定 group_id 和 chunk_type，加载该 chunk_type 下的 chunk 文本（经由 GroupChunkIndex，内容文件只解析一次）
+
+    Returns:
+        对应的 chunk 文本 or None
+    """
+    return get_group_chunk_index(embedding_base_dir).get(chunk_type, group_id)
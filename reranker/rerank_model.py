@@ -1,42 +1,246 @@
-from typing import List, Tuple
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
-import torch
+import threading
+from functools import lru_cache
+from typing import Callable, List, Optional, Tuple
+
+from config.settings import RERANK_MAX_LENGTH, RERANK_MAX_BATCH_TOKENS, RERANK_BATCH_SIZE, RERANK_SCORING_MODE, \
+    RERANK_INSTRUCTION
+
+
+class CrossEncoderReranker:
+    """
+    常驻内存的 cross-encoder：模型、tokenizer 只加载一次（见 get_cross_encoder_reranker），供后续所有 query 复用。
+
+    score() 对任意数量的 (query, text) 对打分：先整体 tokenize（不 padding）得到各对的长度，
+    按长度排序后贪心装箱成 batch（batch 内 最长序列长度 × 条数 不超过 max_batch_tokens，条数不超过 batch_size），
+    每个 batch 只 padding 到自身的最长序列，分数按输入顺序返回。
+    """
+
+    def __init__(self, model_name: str, device: Optional[str] = None, max_length: int = RERANK_MAX_LENGTH,
+                 max_batch_tokens: int = RERANK_MAX_BATCH_TOKENS, batch_size: int = RERANK_BATCH_SIZE):
+        import torch
+        from transformers import AutoTokenizer
+
+        self.model_name = model_name
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.max_length = max_length
+        self.max_batch_tokens = max_batch_tokens
+        self.batch_size = batch_size
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = self._load_model(model_name).to(self.device)
+        self.model.eval()
+        # HF fast tokenizer 与同一模型上的推理不支持多线程同时调用
+        self._lock = threading.Lock()
+
+    def _load_model(self, model_name: str):
+        from transformers import AutoModelForSequenceClassification
+
+        model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        if model.config.pad_token_id is None:
+            # decoder 类模型按 pad_token_id 定位每条序列的最后一个 token
+            model.config.pad_token_id = self.tokenizer.pad_token_id
+        return model
+
+    @staticmethod
+    def format_pair(query: str, text: str) -> str:
+        return f"{query} [SEP] {text}"
+
+    def build_batches(self, lengths: List[int]) -> List[List[int]]:
+        """按长度升序贪心装箱，返回每个 batch 对应的原始下标列表"""
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        batches, current = [], []
+        for i in order:
+            # lengths 升序，当前元素即 batch 内最长序列
+            fits = (len(current) + 1) * lengths[i] <= self.max_batch_tokens and len(current) < self.batch_size
+            if current and not fits:
+                batches.append(current)
+                current = []
+            current.append(i)
+        if current:
+            batches.append(current)
+        return batches
+
+    def score(self, pairs: List[Tuple[str, str]],
+              should_stop: Optional[Callable[[], bool]] = None) -> Optional[List[float]]:
+        """
+        Args:
+            pairs: List of (query, candidate_text)
+            should_stop: 每个 batch 之前调用，返回 True 时放弃剩余 batch（用于截止时间）
+
+        Returns:
+            每一对的得分，与 pairs 顺序一致；被 should_stop 中止时返回 None
+        """
+        if not pairs:
+            return []
+        import torch
+
+        with self._lock:
+            encoded = self.tokenizer([self.format_pair(query, text) for query, text in pairs],
+                                     truncation=True, max_length=self.max_length)
+            input_ids = encoded["input_ids"]
+            scores = [0.0] * len(pairs)
+            for batch_idxs in self.build_batches([len(ids) for ids in input_ids]):
+                if should_stop is not None and should_stop():
+                    return None
+                features = [{key: encoded[key][i] for key in encoded.keys()} for i in batch_idxs]
+                inputs = self.tokenizer.pad(features, padding=True, return_tensors="pt").to(self.device)
+                with torch.no_grad():
+                    logits = self.model(**inputs).logits
+                batch_scores = logits[:, 0] if logits.dim() > 1 else logits
+                for i, batch_score in zip(batch_idxs, batch_scores.float().cpu().tolist()):
+                    scores[i] = batch_score
+        return scores
+
+    def rerank(self, query: str, candidates: List[Tuple[str, str]]) -> List[Tuple[str, float]]:
+        """对 (group_id, text) 候选打分，按得分降序返回 (group_id, score)"""
+        scores = self.score([(query, text) for _, text in candidates])
+        return sorted(zip([gid for gid, _ in candidates], scores), key=lambda x: x[1], reverse=True)
+
+
+class Qwen3PrefixReranker(CrossEncoderReranker):
+    """
+    Qwen3-Reranker 是 causal LM，按其训练格式打分：
+        system 指令 + "<Instruct>: ... <Query>: {query} <Document>:" + " {document}" + assistant 前缀
+    取最后一个位置上 "yes" / "no" 两个 token 的 logits，得分为 P(yes)。
+
+    同一 query 的公共前缀（system 指令、Instruct、Query）只编码一次，其 KV cache 在该 query 的所有候选间共享；
+    每个候选只需编码 " {document}" + 固定后缀，推理成本只随候选长度增长，与 query 长度无关。
+    候选按长度排序装箱（与 CrossEncoderReranker 相同），batch 内右侧 padding，
+    padding 位于真实 token 之后，在因果注意力下不影响真实 token 的输出。
+    """
+
+    PREFIX = "<|im_start|>system\nJudge whether the Document meets the requirements based on the Query and " \
+             "the Instruct provided. Note that the answer can only be \"yes\" or \"no\".<|im_end|>\n" \
+             "<|im_start|>user\n"
+    SUFFIX = "<|im_end|>\n<|im_start|>assistant\n<think>\n\n</think>\n\n"
+
+    def __init__(self, model_name: str, device: Optional[str] = None, instruction: str = RERANK_INSTRUCTION,
+                 **kwargs):
+        super().__init__(model_name, device, **kwargs)
+        self.instruction = instruction
+        self.suffix_ids = self.tokenizer.encode(self.SUFFIX, add_special_tokens=False)
+        self.yes_token_id = self.tokenizer.convert_tokens_to_ids("yes")
+        self.no_token_id = self.tokenizer.convert_tokens_to_ids("no")
+
+    def _load_model(self, model_name: str):
+        from transformers import AutoModelForCausalLM
+
+        return AutoModelForCausalLM.from_pretrained(model_name)
+
+    def encode_prefix_ids(self, query: str) -> List[int]:
+        """公共前缀的 token；query 部分最多占 max_length 的一半，为候选留出长度"""
+        head = self.tokenizer.encode(f"{self.PREFIX}<Instruct>: {self.instruction}\n<Query>:",
+                                     add_special_tokens=False)
+        tail = self.tokenizer.encode("\n<Document>:", add_special_tokens=False)
+        query_ids = self.tokenizer.encode(" " + query, add_special_tokens=False)
+        return head + query_ids[:max(self.max_length // 2 - len(head) - len(tail), 1)] + tail
+
+    def encode_prefix(self, query: str):
+        """编码公共前缀，返回 (前缀长度, 逐层 (key, value) 的 KV cache，batch 维为 1)"""
+        import torch
+
+        prefix_ids = self.encode_prefix_ids(query)
+        with torch.no_grad():
+            outputs = self.model(input_ids=torch.tensor([prefix_ids], device=self.device), use_cache=True)
+        past = outputs.past_key_values
+        legacy = past.to_legacy_cache() if hasattr(past, "to_legacy_cache") else past
+        return len(prefix_ids), legacy
+
+    def _expand_cache(self, legacy_cache, batch_size: int):
+        # expand 不复制显存；模型在 cache 上 torch.cat 新 token 时生成新张量，前缀 cache 可在 batch 间复用
+        expanded = tuple((k.expand(batch_size, -1, -1, -1), v.expand(batch_size, -1, -1, -1))
+                         for k, v in legacy_cache)
+        try:
+            from transformers import DynamicCache
+        except ImportError:
+            return expanded
+        return DynamicCache.from_legacy_cache(expanded)
+
+    def _score_query(self, query: str, texts: List[str], should_stop) -> Optional[List[float]]:
+        import torch
+
+        prefix_len, prefix_cache = self.encode_prefix(query)
+        max_doc_len = max(self.max_length - prefix_len - len(self.suffix_ids), 1)
+        candidate_ids = [self.tokenizer.encode(" " + text, add_special_tokens=False)[:max_doc_len] + self.suffix_ids
+                         for text in texts]
+        pad_id = self.tokenizer.pad_token_id
+
+        scores = [0.0] * len(texts)
+        for batch_idxs in self.build_batches([len(ids) for ids in candidate_ids]):
+            if should_stop is not None and should_stop():
+                return None
+            lengths = [len(candidate_ids[i]) for i in batch_idxs]
+            width = max(lengths)
+            input_ids = torch.tensor([candidate_ids[i] + [pad_id] * (width - len(candidate_ids[i]))
+                                      for i in batch_idxs], device=self.device)
+            attention_mask = torch.tensor([[1] * (prefix_len + n) + [0] * (width - n) for n in lengths],
+                                          device=self.device)
+            with torch.no_grad():
+                logits = self.model(input_ids=input_ids, attention_mask=attention_mask,
+                                    past_key_values=self._expand_cache(prefix_cache, len(batch_idxs)),
+                                    use_cache=True).logits
+            last = torch.tensor([n - 1 for n in lengths], device=self.device)
+            last_logits = logits[torch.arange(len(batch_idxs), device=self.device), last]
+            yes_no = torch.stack([last_logits[:, self.no_token_id], last_logits[:, self.yes_token_id]], dim=1)
+            batch_scores = torch.log_softmax(yes_no.float(), dim=1)[:, 1].exp()
+            for i, batch_score in zip(batch_idxs, batch_scores.cpu().tolist()):
+                scores[i] = batch_score
+        return scores
+
+    def score(self, pairs: List[Tuple[str, str]],
+              should_stop: Optional[Callable[[], bool]] = None) -> Optional[List[float]]:
+        """与 CrossEncoderReranker.score 相同；pairs 按 query 分组，每个 query 的前缀只编码一次"""
+        if not pairs:
+            return []
+        by_query = {}
+        for i, (query, _) in enumerate(pairs):
+            by_query.setdefault(query, []).append(i)
+
+        scores = [0.0] * len(pairs)
+        with self._lock:
+            for query, idxs in by_query.items():
+                query_scores = self._score_query(query, [pairs[i][1] for i in idxs], should_stop)
+                if query_scores is None:
+                    return None
+                for i, query_score in zip(idxs, query_scores):
+                    scores[i] = query_score
+        return scores
+
+
+def use_prefix_scoring(model_name: str, scoring_mode: str = RERANK_SCORING_MODE) -> bool:
+    """auto：Qwen3-Reranker 系列（causal LM，没有训练过的分类头）使用前缀共享打分，其余模型按 cross-encoder 打分"""
+    if scoring_mode == "auto":
+        return "qwen3-reranker" in model_name.lower()
+    return scoring_mode == "prefix"
+
+
+@lru_cache(maxsize=None)
+def get_cross_encoder_reranker(model_name: str = "Qwen/Qwen3-Reranker-8B",
+                               device: Optional[str] = None) -> CrossEncoderReranker:
+    """同一 (model_name, device) 的 reranker 只加载一次；打分方式由 RERANK_SCORING_MODE 决定"""
+    if use_prefix_scoring(model_name):
+        return Qwen3PrefixReranker(model_name, device)
+    return CrossEncoderReranker(model_name, device)
 
 
 def rerank_with_cross_encoder(
     query: str,
     candidates: List[Tuple[str, str]],
     model_name: str = "Qwen/Qwen3-Reranker-8B",
-    device: str = "cuda" if torch.cuda.is_available() else "cpu"
+    device: Optional[str] = None
 ) -> List[Tuple[str, float]]:
     """
-    用 CrossEncoder 模型对 query + candidate_text 进行打分排序
+    用 CrossEncoder 模型对 query + candidate_text 进行打分排序（模型常驻，见 get_cross_encoder_reranker）
 
     Args:
         query: 原始查询
         candidates: List of (group_id, merged_text)
         model_name: reranker 模型名称（默认 Qwen）
-        device: cuda or cpu
+        device: cuda or cpu，为空时自动选择
 
     Returns:
         List of (group_id, score) sorted by score desc
     """
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModelForSequenceClassification.from_pretrained(model_name).to(device)
-
-    inputs = tokenizer(
-        [f"{query} [SEP] {text}" for _, text in candidates],
-        padding=True,
-        truncation=True,
-        return_tensors="pt",
-        max_length=512,
-    ).to(device)
-
-    with torch.no_grad():
-        outputs = model(**inputs)
-        scores = outputs.logits.squeeze(-1).tolist()
-
-    if isinstance(scores, float):
-        scores = [scores]
-
-    return sorted(zip([gid for gid, _ in candidates], scores), key=lambda x: x[1], reverse=True)
+    return get_cross_encoder_reranker(model_name, device).rerank(query, candidates)
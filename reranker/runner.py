@@ -1,9 +1,12 @@
 from pathlib import Path
 from collections import defaultdict
 import json
+import threading
+import time
 
-from reranker.group_candidate_loader import load_group_chunks_by_type
-from reranker.rerank_model import rerank_with_cross_encoder
+from config.settings import RERANK_CANDIDATES, RERANK_DEADLINE_MS, TEXT_RERANK_MODEL
+from reranker.group_candidate_loader import get_chunk_result_index, get_chunk_texts_by_type, get_group_chunk_index
+from reranker.rerank_model import get_cross_encoder_reranker
 
 
 def rerank_and_aggregate(
@@ -33,8 +36,8 @@ def rerank_and_aggregate(
     with open(weight_file, "r", encoding="utf-8") as f:
         chunk_weights = json.load(f)
 
-    rerank_scores_by_group = defaultdict(float)
-
+    # 2. 收集所有 chunk_type 的候选，整体交给常驻的 reranker 一次打分
+    selected = []  # (chunk_type, group_id, chunk_type 权重)
     for score_file in score_files:
         chunk_type = score_file.stem  # e.g., parent_method
         weight = chunk_weights.get(chunk_type, 0.1)
@@ -42,25 +45,144 @@ def rerank_and_aggregate(
         with open(score_file, "r", encoding="utf-8") as f:
             match_scores = json.load(f)
 
-        # 2. 提取 top-N 组做 rerank（避免每个 chunk_type 太多）
+        # 提取 top-N 组做 rerank（避免每个 chunk_type 太多）
         sorted_group_ids = sorted(match_scores.items(), key=lambda x: x[1], reverse=True)
-        top_group_ids = [gid for gid, _ in sorted_group_ids[:top_k * 2]]
+        selected.extend((chunk_type, gid, weight) for gid, _ in sorted_group_ids[:top_k * 2])
 
-        # 3. 加载文本并进行 rerank
-        candidates = []
-        for group_id in top_group_ids:
-            chunk = load_group_chunks_by_type(group_id, chunk_type, embedding_base_dir)
-            if chunk:
-                candidates.append((group_id, chunk))
+    # 3. 通过 group_id 索引一次取出全部候选文本
+    texts = get_group_chunk_index(embedding_base_dir).get_many((chunk_type, gid) for chunk_type, gid, _ in selected)
+    pairs = [(gid, weight, texts[(chunk_type, gid)]) for chunk_type, gid, weight in selected
+             if texts.get((chunk_type, gid))]
 
-        if not candidates:
-            continue
+    if not pairs:
+        return []
 
-        reranked = rerank_with_cross_encoder(query, candidates, model_name=rerank_model)
+    reranker = get_cross_encoder_reranker(rerank_model)
+    scores = reranker.score([(query, text) for _, _, text in pairs])
 
-        # 4. 按 chunk_type 权重叠加得分
-        for group_id, score in reranked:
-            rerank_scores_by_group[group_id] += score * weight
+    # 4. 按 chunk_type 权重叠加得分
+    rerank_scores_by_group = defaultdict(float)
+    for (group_id, weight, _), score in zip(pairs, scores):
+        rerank_scores_by_group[group_id] += score * weight
 
     final_sorted = sorted(rerank_scores_by_group.items(), key=lambda x: x[1], reverse=True)
     return final_sorted[:top_k]
+
+
+def compare_rankings(dense_ids: list, rerank_ids: list, top_k: int, relevant_ids=None) -> dict:
+    """
+    dense 与 rerank 两种排序的差异：top_k 重合率、被 rerank 提入 top_k 的 group；
+    给出 relevant_ids（已知正确的 group）时再比较两者的 hit@k 与 MRR。
+    """
+    dense_top, rerank_top = [str(g) for g in dense_ids[:top_k]], [str(g) for g in rerank_ids[:top_k]]
+    delta = {
+        "overlap_at_k": len(set(dense_top) & set(rerank_top)) / max(len(dense_top), 1),
+        "promoted": [g for g in rerank_top if g not in dense_top],
+        "top1_changed": dense_top[:1] != rerank_top[:1],
+    }
+    if relevant_ids:
+        relevant = {str(g) for g in relevant_ids}
+
+        def mrr(ranked):
+            return next((1 / (rank + 1) for rank, g in enumerate(ranked) if g in relevant), 0.0)
+
+        delta["hit_at_k"] = {"dense": float(bool(relevant & set(dense_top))),
+                             "rerank": float(bool(relevant & set(rerank_top)))}
+        delta["mrr"] = {"dense": mrr([str(g) for g in dense_ids]), "rerank": mrr([str(g) for g in rerank_ids])}
+        delta["mrr_delta"] = delta["mrr"]["rerank"] - delta["mrr"]["dense"]
+    return delta
+
+
+def rerank_dense_results(
+    query_chunks: dict,
+    dense_results: list,
+    chunk_dir: Path,
+    weight_file: Path,
+    top_k: int = 5,
+    max_candidates: int = RERANK_CANDIDATES,
+    deadline_ms: float = RERANK_DEADLINE_MS,
+    rerank_model: str = TEXT_RERANK_MODEL,
+    relevant_ids=None,
+) -> tuple[list, dict]:
+    """
+    第二阶段 rerank：对 dense 聚合结果的前 max_candidates 个 group，按 chunk_type 把 query 文本与候选文本配对，
+    交给常驻的 cross-encoder 一次打分，再按 chunk_type 权重聚合。
+    打分在后台线程中进行，超过 deadline_ms 仍未完成时放弃（剩余 batch 不再计算），直接返回 dense 顺序。
+    首次调用包含模型加载时间，对延迟敏感的服务应在启动时先调用 get_cross_encoder_reranker 预热。
+
+    Args:
+        query_chunks: query 的分块结果（load_query_chunks 返回的 chunks）
+        dense_results: aggregate_topk_from_* 返回的 (group_id, score, folder_path)，按得分降序
+        chunk_dir: 候选库的分块结果目录（如 tmp/chunks/CH），用于按 group_id 取候选文本
+        relevant_ids: 已知正确的 group_id（评测用），给出时报告中包含 hit@k / MRR 的变化
+
+    Returns:
+        (top_k 个 (group_id, score, folder_path), 报告)
+    """
+    start = time.perf_counter()
+    candidates = dense_results[:max_candidates]
+    report = {"reranked": False, "timed_out": False, "num_candidates": len(candidates), "num_pairs": 0,
+              "deadline_ms": deadline_ms}
+
+    # 1. 按 chunk_type 配对 query 文本与候选文本；失败时同样回退到 dense 顺序
+    outcome = {}
+    pairs = []
+    try:
+        with open(weight_file, "r", encoding="utf-8") as f:
+            chunk_weights = json.load(f)
+        query_texts = get_chunk_texts_by_type(query_chunks)
+        texts = get_chunk_result_index(chunk_dir).get_many(
+            (chunk_type, group_id) for group_id, _, _ in candidates for chunk_type in query_texts)
+        pairs = [(group_id, chunk_weights.get(chunk_type, 0.1), query_texts[chunk_type], texts[(chunk_type, group_id)])
+                 for group_id, _, _ in candidates for chunk_type in query_texts if (chunk_type, group_id) in texts]
+    except Exception as e:
+        outcome["error"] = e
+    report["num_pairs"] = len(pairs)
+
+    # 2. 后台线程打分，主线程最多等到截止时间
+    done = threading.Event()
+    stop = threading.Event()
+
+    def score_pairs():
+        try:
+            reranker = get_cross_encoder_reranker(rerank_model or "Qwen/Qwen3-Reranker-8B")
+            outcome["scores"] = reranker.score([(query, text) for _, _, query, text in pairs],
+                                               should_stop=stop.is_set)
+        except Exception as e:
+            outcome["error"] = e
+        finally:
+            done.set()
+
+    if pairs:
+        threading.Thread(target=score_pairs, name="rerank", daemon=True).start()
+        remaining = deadline_ms / 1000 - (time.perf_counter() - start)
+        if not done.wait(max(remaining, 0)):
+            stop.set()
+            report["timed_out"] = True
+
+    scores = None if report["timed_out"] else outcome.get("scores")
+    if "error" in outcome:
+        print(f"[WARN] Rerank failed, fallback to dense order: {outcome['error']}")
+        report["error"] = str(outcome["error"])
+
+    # 3. 按 chunk_type 权重聚合；没有得分（超时 / 失败 / 无候选文本）时保持 dense 顺序
+    results = dense_results[:top_k]
+    if scores is not None:
+        rerank_scores_by_group = defaultdict(float)
+        for (group_id, weight, _, _), score in zip(pairs, scores):
+            rerank_scores_by_group[group_id] += score * weight
+        folder_paths = {group_id: path for group_id, _, path in candidates}
+        reranked = sorted(rerank_scores_by_group.items(), key=lambda x: x[1], reverse=True)
+        # 没有任何可配对文本的候选排在已打分的候选之后，保持 dense 相对顺序
+        reranked_ids = [group_id for group_id, _ in reranked]
+        reranked_ids += [group_id for group_id, _, _ in candidates if group_id not in rerank_scores_by_group]
+        results = [(group_id, rerank_scores_by_group.get(group_id, 0.0), folder_paths[group_id])
+                   for group_id in reranked_ids[:top_k]]
+        report["reranked"] = True
+        report["quality_delta"] = compare_rankings([g for g, _, _ in candidates], reranked_ids, top_k, relevant_ids)
+
+    report["elapsed_ms"] = (time.perf_counter() - start) * 1000
+    status = "reranked" if report["reranked"] else "dense order kept"
+    print(f"[i] Rerank stage: {status}, {report['num_pairs']} pairs, {report['elapsed_ms']:.1f} ms "
+          f"(deadline {deadline_ms:.0f} ms)")
+    return results, report
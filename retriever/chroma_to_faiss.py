@@ -0,0 +1,248 @@
+import json
+import pickle
+import resource
+import sqlite3
+from pathlib import Path
+from typing import Iterator, Optional, Tuple, Union
+
+import numpy as np
+
+from retriever.retriever_utils import collect_all_chroma_paths
+
+CHROMA_SQLITE_FILE = "chroma.sqlite3"
+CHROMA_DOCUMENT_KEY = "chroma:document"
+
+# embeddings_queue.operation: 0=ADD 1=UPDATE 2=UPSERT 3=DELETE
+OPERATION_UPDATE = 1
+OPERATION_DELETE = 3
+
+
+def _list_collections(conn: sqlite3.Connection):
+    return conn.execute("SELECT id, name FROM collections").fetchall()
+
+
+def _count_collection_records(conn: sqlite3.Connection, collection_id: str) -> int:
+    """metadata segment 中记录的条数，用于判断 embeddings_queue 是否仍保留了全部向量"""
+    row = conn.execute(
+        "SELECT COUNT(*) FROM embeddings e JOIN segments s ON e.segment_id = s.id "
+        "WHERE s.collection = ? AND s.scope = 'METADATA'",
+        (collection_id,),
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def _queue_filter(collection_id: str) -> Tuple[str, tuple]:
+    # 同一 id 只取最后一次写入；topic 形如 persistent://{tenant}/{database}/{collection_id}
+    topic_like = f"%{collection_id}"
+    where = (
+        "topic LIKE ? AND seq_id IN ("
+        "SELECT MAX(seq_id) FROM embeddings_queue WHERE topic LIKE ? GROUP BY id)"
+    )
+    return where, (topic_like, topic_like)
+
+
+def _can_read_from_queue(conn: sqlite3.Connection, collection_id: str) -> bool:
+    """
+    embeddings_queue 中保留了该 collection 的全部有效向量时才直接读取：
+    - 新版本 Chroma 会在向量写入 HNSW 后清理 queue
+    - UPDATE 只记录变化的字段，无法从单条记录还原完整 metadata
+    """
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    if "embeddings_queue" not in tables:
+        return False
+    where, params = _queue_filter(collection_id)
+    live, updates = conn.execute(
+        f"SELECT SUM(operation != {OPERATION_DELETE}), SUM(operation = {OPERATION_UPDATE}) "
+        f"FROM embeddings_queue WHERE {where}",
+        params,
+    ).fetchone()
+    return bool(live) and not updates and live == _count_collection_records(conn, collection_id)
+
+
+def iter_queue_pages(conn: sqlite3.Connection, collection_id: str, page_size: int = 1000) -> Iterator[tuple]:
+    """
+    按 seq_id 分页读取 embeddings_queue 中的向量和 metadata，每次只持有一页数据。
+
+    :return: 逐页产出 (documents, metadatas, embeddings)
+    """
+    where, params = _queue_filter(collection_id)
+    last_seq_id = -1
+    while True:
+        rows = conn.execute(
+            f"SELECT seq_id, vector, encoding, metadata FROM embeddings_queue "
+            f"WHERE {where} AND operation != {OPERATION_DELETE} AND seq_id > ? ORDER BY seq_id LIMIT ?",
+            (*params, last_seq_id, page_size),
+        ).fetchall()
+        if not rows:
+            break
+
+        documents, metadatas, embeddings = [], [], []
+        for seq_id, vector, encoding, metadata_json in rows:
+            if encoding and encoding.upper() != "FLOAT32":
+                raise ValueError(f"Unsupported Chroma vector encoding: {encoding}")
+            metadata = json.loads(metadata_json) if metadata_json else {}
+            documents.append(metadata.pop(CHROMA_DOCUMENT_KEY, None))
+            metadatas.append(metadata)
+            embeddings.append(np.frombuffer(vector, dtype=np.float32))
+        last_seq_id = rows[-1][0]
+        yield documents, metadatas, np.vstack(embeddings)
+
+
+def iter_client_pages(chroma_dir: Union[str, Path], collection_name: str, page_size: int = 1000) -> Iterator[tuple]:
+    """
+    兜底方式：通过 chromadb 客户端分页 get（不传 embedding_function，不加载模型）。
+    """
+    import chromadb
+
+    client = chromadb.PersistentClient(path=str(chroma_dir))
+    collection = client.get_collection(collection_name, embedding_function=None)
+    offset = 0
+    while True:
+        data = collection.get(include=["documents", "metadatas", "embeddings"], limit=page_size, offset=offset)
+        if not data["ids"]:
+            break
+        yield data["documents"], data["metadatas"], np.asarray(data["embeddings"], dtype=np.float32)
+        offset += len(data["ids"])
+
+
+def iter_chroma_pages(chroma_dir: Union[str, Path], page_size: int = 1000) -> Iterator[tuple]:
+    """
+    逐页读取一个 Chroma 持久化目录中所有 collection 的已存向量，优先直接读 SQLite。
+    """
+    sqlite_path = Path(chroma_dir) / CHROMA_SQLITE_FILE
+    if not sqlite_path.exists():
+        print(f"[SKIP] {sqlite_path} not found")
+        return
+
+    conn = sqlite3.connect(f"file:{sqlite_path}?mode=ro", uri=True)
+    try:
+        for collection_id, collection_name in _list_collections(conn):
+            if _can_read_from_queue(conn, collection_id):
+                yield from iter_queue_pages(conn, collection_id, page_size)
+            else:
+                print(f"[i] {chroma_dir}/{collection_name}: embeddings_queue incomplete, fall back to chromadb client")
+                yield from iter_client_pages(chroma_dir, collection_name, page_size)
+    finally:
+        conn.close()
+
+
+# 每条向量写入其所属 case 的 FAISS 向量库，与 write_faiss_store 的目录结构一致：
+# {target_root}/{category}/{antipattern_type}/{project_name}/{commit_number}/{id}
+CASE_METADATA_KEYS = ("antipattern_type", "project_name", "commit_number", "id")
+
+
+def get_case_store_dir(category_root: Path, metadata: dict) -> Optional[Path]:
+    if any(metadata.get(key) in (None, "") for key in CASE_METADATA_KEYS):
+        return None
+    return category_root.joinpath(*(str(metadata[key]) for key in CASE_METADATA_KEYS))
+
+
+class CaseFaissWriter:
+    """
+    按 case 缓冲向量，写出与 write_faiss_store 相同布局的 FAISS 向量库（faiss_index.idx + metadata.pkl），
+    score_query_against_candidates / match_merged_chunks_faiss 可直接读取。
+
+    缓冲的向量总字节数超过 max_buffer_bytes 时全部写出，内存占用与向量维度相关、与语料规模无关。
+    同一 case 的向量可能分散在多页 / 多个 Chroma 库中：本次运行中第一次写出时覆盖旧的向量库，之后追加，
+    case 内的行顺序与读取顺序一致。
+    """
+
+    def __init__(self, target_root: Union[str, Path], category: str, max_buffer_bytes: int = 256 * 1024 * 1024):
+        self.category_root = Path(target_root) / category
+        self.max_buffer_bytes = max_buffer_bytes
+        self.buffers = {}  # case 目录 -> {"embeddings": [...], "metadatas": [...]}
+        self.buffered_bytes = 0
+        self.written = set()
+        self.total = 0
+
+    def add(self, embedding: np.ndarray, metadata: dict) -> bool:
+        store_dir = get_case_store_dir(self.category_root, metadata)
+        if store_dir is None:
+            return False
+        buffer = self.buffers.setdefault(store_dir, {"embeddings": [], "metadatas": []})
+        buffer["embeddings"].append(embedding)
+        buffer["metadatas"].append(metadata)
+        self.buffered_bytes += embedding.nbytes
+        if self.buffered_bytes >= self.max_buffer_bytes:
+            self.flush()
+        return True
+
+    def _write_case(self, store_dir: Path, embeddings: np.ndarray, metadatas: list):
+        import faiss
+
+        index_path = store_dir / "faiss_index.idx"
+        metadata_path = store_dir / "metadata.pkl"
+        if store_dir in self.written:
+            index = faiss.read_index(str(index_path))
+            if index.d != embeddings.shape[1]:
+                raise ValueError(f"Dimension mismatch in {store_dir}: index d={index.d}, "
+                                 f"new vectors d={embeddings.shape[1]}")
+            with open(metadata_path, "rb") as f:
+                metadatas = pickle.load(f) + metadatas
+        else:
+            store_dir.mkdir(parents=True, exist_ok=True)
+            index = faiss.IndexFlatL2(embeddings.shape[1])
+        index.add(embeddings)
+        faiss.write_index(index, str(index_path))
+        with open(metadata_path, "wb") as f:
+            pickle.dump(metadatas, f)
+        self.written.add(store_dir)
+
+    def flush(self):
+        for store_dir, buffer in self.buffers.items():
+            embeddings = np.ascontiguousarray(np.vstack(buffer["embeddings"]), dtype=np.float32)
+            self._write_case(store_dir, embeddings, buffer["metadatas"])
+            self.total += len(embeddings)
+        if self.buffers:
+            print(f"[SAVE] {self.buffered_bytes / 1024 / 1024:.1f} MB of vectors -> "
+                  f"{len(self.buffers)} case stores under {self.category_root}")
+        self.buffers = {}
+        self.buffered_bytes = 0
+
+    def close(self):
+        self.flush()
+
+
+def merge_chroma_to_faiss(source_root: Union[str, Path], target_root: Optional[Union[str, Path]] = None,
+                          page_size: int = 1000, max_buffer_bytes: int = 256 * 1024 * 1024) -> dict:
+    """
+    Chroma → FAISS 的迁移：不初始化 embedding 模型，直接分页读取 Chroma 中已存的向量，
+    按 case 写入 {target_root}/{CODE|TEXT}/{antipattern_type}/{project_name}/{commit_number}/{id} 的 FAISS 向量库，
+    即 write_faiss_store 的布局，matcher 不需要任何改动即可使用。
+    进程内存只与 page_size / max_buffer_bytes 有关，与语料规模无关。
+
+    :param source_root: 含有 CODE / TEXT Chroma 向量库的根目录
+    :param target_root: 输出目录，默认 source_root 同级的 merged_faiss_vectorstore
+    :return: 各类别写入的向量条数
+    """
+    source_root = Path(source_root)
+    target_root = Path(target_root) if target_root else source_root.parent / "merged_faiss_vectorstore"
+
+    code_paths, text_paths = collect_all_chroma_paths(source_root)
+    chroma_paths = {"CODE": code_paths, "TEXT": text_paths}
+
+    stats = {}
+    for category, paths in chroma_paths.items():
+        print(f"\n[PROCESSING] Category: {category}  Total found: {len(paths)}")
+        writer = CaseFaissWriter(target_root, category, max_buffer_bytes)
+
+        for chroma_dir in paths:
+            print(f"[LOAD] {chroma_dir}")
+            for documents, metadatas, embeddings in iter_chroma_pages(chroma_dir, page_size):
+                for doc, meta, emb in zip(documents, metadatas, embeddings):
+                    if not meta.get("chunk_type"):
+                        print("[WARN] Missing chunk_type in metadata. Skipping.")
+                        continue
+                    if not writer.add(np.array(emb), {**meta, "page_content": doc}):
+                        print(f"[WARN] Missing one of {CASE_METADATA_KEYS} in metadata. Skipping.")
+
+        writer.close()
+        stats[category] = writer.total
+
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"[✓] Merged into {target_root}: {stats}, peak RSS {peak_rss_mb:.1f} MB")
+    return stats
+
+
+if __name__ == "__main__":
+    merge_chroma_to_faiss("tmp/vectorstore/CH")
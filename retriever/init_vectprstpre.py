@@ -4,8 +4,6 @@ from collections import defaultdict
 from pathlib import Path
 from typing import List, Tuple
 
-import faiss
-from langchain_community.vectorstores import Chroma
 import numpy as np
 from unicodedata import category
 
@@ -19,6 +17,8 @@ def merge_vectorstore_by_chunk_type(source_root: str, target_root: str = None):
     # eg: source_root = /Users/moncheri/Downloads/main/重构/反模式修复数据集构建/RefactorRAG/Anti-PatternRAG/vectorstore/CH
     # eg: target_root = /Users/moncheri/Downloads/main/重构/反模式修复数据集构建/RefactorRAG/Anti-PatternRAG/vectorstore/merged_vectorstore
 
+    from langchain_community.vectorstores import Chroma
+
     source_root = Path(source_root)
     if target_root is None:
         target_root = source_root.parent / "merged_vectorstore"
@@ -64,6 +64,8 @@ def merge_vectorstore_by_chunk_type(source_root: str, target_root: str = None):
 
 
 def load_faiss_index_and_metadata(idx_path: Path):
+    import faiss
+
     index = faiss.read_index(str(idx_path))
     meta_path = idx_path.parent / "metadata.pkl"
     with open(meta_path, "rb") as f:
@@ -81,17 +83,14 @@ def cosine_similarity(vec1, vec2):
     return np.dot(v1, v2)
 
 
-def match_query_to_candidate_chunks_faiss(query_dir: str, merged_dir: str):
-    query_dir = Path(query_dir)
-    merged_dir = Path(merged_dir)
-    score_files = []
-
-    all_scores = defaultdict(lambda: {"CODE": defaultdict(list), "TEXT": defaultdict(list)})
-    group_ids = {}
-    folder_paths = {}  # 新增 dict 存储 folder_path
-
+def load_query_stores(query_dir: Path) -> dict:
+    """
+    读取 query/vectorstore/{CODE,TEXT} 下的 query 向量，转换为与 in-memory query 相同的结构：
+    {category: {"embeddings": np.ndarray, "metadatas": list[dict]}}
+    """
+    query_stores = {}
     for category in ["CODE", "TEXT"]:
-        query_category_path = query_dir / category
+        query_category_path = Path(query_dir) / category
         query_idx_path = query_category_path / "faiss_index.idx"
         query_meta_path = query_category_path / "metadata.pkl"
         if not query_idx_path.exists() or not query_meta_path.exists():
@@ -99,6 +98,33 @@ def match_query_to_candidate_chunks_faiss(query_dir: str, merged_dir: str):
             continue
 
         query_index, query_metadata = load_faiss_index_and_metadata(query_idx_path)
+        query_stores[category] = {
+            "embeddings": query_index.reconstruct_n(0, query_index.ntotal),
+            "metadatas": query_metadata,
+        }
+    return query_stores
+
+
+def score_query_against_candidates(query_stores: dict, merged_dir: str) -> dict:
+    """
+    将 query 向量（内存中）与 merged_dir 下的 candidate chunks 按 chunk_type 逐一打分。
+
+    :param query_stores: {category: {"embeddings": np.ndarray, "metadatas": list[dict]}}
+    :param merged_dir: 候选向量库根目录
+    :return: {candidate 相对路径: {"group_id", "folder_path", "CODE": {...}, "TEXT": {...}}}
+    """
+    merged_dir = Path(merged_dir)
+
+    all_scores = defaultdict(lambda: {"CODE": defaultdict(list), "TEXT": defaultdict(list)})
+    group_ids = {}
+    folder_paths = {}  # 新增 dict 存储 folder_path
+
+    for category in ["CODE", "TEXT"]:
+        if category not in query_stores:
+            print(f"[SKIP] Missing query embeddings for category: {category}")
+            continue
+        query_embeddings = query_stores[category]["embeddings"]
+        query_metadata = query_stores[category]["metadatas"]
 
         chunk_type_to_query_idxs = defaultdict(list)
         for i, meta in enumerate(query_metadata):
@@ -118,7 +144,6 @@ def match_query_to_candidate_chunks_faiss(query_dir: str, merged_dir: str):
 
         for candidate_idx_path in candidate_idx_files:
             candidate_dir = candidate_idx_path.parent
-            candidate_meta_path = candidate_dir / "metadata.pkl"
 
             candidate_index, candidate_metadata = load_faiss_index_and_metadata(candidate_idx_path)
 
@@ -157,7 +182,7 @@ def match_query_to_candidate_chunks_faiss(query_dir: str, merged_dir: str):
                 folder_paths[rel_path_str] = str(folder_path).replace("\\", "/")  # 兼容windows路径
 
             print(
-                f"\n[MATCH] Category={category}, CandidateDir={candidate_dir}, QueryVectors={query_index.ntotal}")
+                f"\n[MATCH] Category={category}, CandidateDir={candidate_dir}, QueryVectors={len(query_embeddings)}")
 
             all_chunk_types = set(chunk_type_to_query_idxs.keys()) & set(chunk_type_to_candidate_idxs.keys())
 
@@ -170,7 +195,7 @@ def match_query_to_candidate_chunks_faiss(query_dir: str, merged_dir: str):
                         f"[WARN] chunk_type {ct} query idxs({len(query_idxs)}) != candidate idxs({len(candidate_idxs)})")
 
                 for qi, ci in zip(query_idxs, candidate_idxs):
-                    query_vec = query_index.reconstruct(qi)
+                    query_vec = query_embeddings[qi]
                     candidate_vec = candidate_index.reconstruct(ci)
 
                     if category == "TEXT":
@@ -182,22 +207,16 @@ def match_query_to_candidate_chunks_faiss(query_dir: str, merged_dir: str):
 
                     score = float(score)
 
-                    candidate_meta = candidate_metadata[ci]
                     all_scores[rel_path_str][category][f"query_{qi}"].append({
                         "chunk_type": ct,
                         "score": score
                     })
 
-    merged_scores_dir = query_dir / "merged_match_scores"
-    merged_scores_dir.mkdir(parents=True, exist_ok=True)
-
+    results = {}
     for rel_path_str, category_scores in all_scores.items():
-        group_id = group_ids.get(rel_path_str)
-        folder_path = folder_paths.get(rel_path_str, "")
-
         combined_results = {
-            "group_id": group_id,
-            "folder_path": folder_path,  # 新加字段
+            "group_id": group_ids.get(rel_path_str),
+            "folder_path": folder_paths.get(rel_path_str, ""),  # 新加字段
             "CODE": {},
             "TEXT": {}
         }
@@ -206,163 +225,199 @@ def match_query_to_candidate_chunks_faiss(query_dir: str, merged_dir: str):
             cat_scores = category_scores.get(cat, {})
             for qk, matches in cat_scores.items():
                 combined_results[cat][qk] = matches
+        results[rel_path_str] = combined_results
+
+    return results
+
+
+def save_match_results(match_results: dict, merged_scores_dir: Path) -> Path:
+    merged_scores_dir = Path(merged_scores_dir)
+    merged_scores_dir.mkdir(parents=True, exist_ok=True)
 
+    for rel_path_str, combined_results in match_results.items():
         output_file = merged_scores_dir / f"{rel_path_str.replace('/', '_')}.json"
 
         with open(output_file, "w", encoding="utf-8") as f:
             json.dump(combined_results, f, indent=2, ensure_ascii=False)
 
         print(f"[SAVE] Combined match scores saved to: {output_file}")
-        score_files.append(output_file)
 
     return merged_scores_dir
 
 
-def match_merged_chunks_faiss(merged_dir: str, antipattern_type: str):
-    merged_dir = Path(merged_dir)
-    score_files = []
-
-    group_ids = {}
-    folder_paths = {}
+def match_query_to_candidate_chunks_faiss(query_dir: str, merged_dir: str):
+    query_dir = Path(query_dir)
+    match_results = score_query_against_candidates(load_query_stores(query_dir), merged_dir)
+    return save_match_results(match_results, query_dir / "merged_match_scores")
+
+
+def add_merged_candidate(candidates: dict, category: str, category_base_path: Path, candidate_idx_path: Path,
+                         antipattern_type: str, group_ids: dict, folder_paths: dict):
+    """
+    读取一个候选 case 在某类别下的 FAISS 向量库，按 rel_path_str 合并登记到 candidates（同一 case 的 CODE / TEXT 合在一条记录中），
+    同时记录其 group_id 与 folder_path。
+
+    :return: rel_path_str；不属于 antipattern_type 时返回 None
+    """
+    candidate_dir = candidate_idx_path.parent
+    try:
+        relative_candidate_path = candidate_dir.relative_to(category_base_path)
+    except Exception as e:
+        print(f"[ERROR] candidate_dir.relative_to failed: {candidate_dir} with {e}")
+        relative_candidate_path = candidate_dir.name
+
+    rel_path_str = str(relative_candidate_path)
+
+    top_level = rel_path_str.split("/", 1)[0]
+    if top_level != antipattern_type:
+        return None
+
+    candidate_index, candidate_metadata = load_faiss_index_and_metadata(candidate_idx_path)
+
+    chunk_type_to_candidate_idxs = defaultdict(list)
+    for i, meta in enumerate(candidate_metadata):
+        ct = meta.get("chunk_type")
+        if not ct:
+            print(f"[WARN] candidate metadata idx={i} missing chunk_type, skip")
+            continue
+        chunk_type_to_candidate_idxs[ct].append(i)
+
+    if rel_path_str not in group_ids:
+        if candidate_metadata and "group_id" in candidate_metadata[0]:
+            group_ids[rel_path_str] = candidate_metadata[0]["group_id"]
+        else:
+            group_ids[rel_path_str] = None
+
+    if rel_path_str not in folder_paths and candidate_metadata:
+        meta0 = candidate_metadata[0]
+        folder_path = Path(meta0.get("antipattern_type", "")) / meta0.get("project_name", "") / \
+            meta0.get("commit_number", "") / meta0.get("id", "")
+        folder_paths[rel_path_str] = str(folder_path).replace("\\", "/")
+
+    # candidates 中已有此 rel_path_str 时只更新此类别的 index 和 chunk_type 索引
+    exist = candidates.get(rel_path_str)
+    if exist:
+        exist["index_" + category] = candidate_index
+        exist["chunk_type_to_candidate_idxs_" + category] = chunk_type_to_candidate_idxs
+    else:
+        candidates[rel_path_str] = {
+            "rel_path_str": rel_path_str,
+            "candidate_dir": candidate_dir,
+            "metadata": candidate_metadata,
+            "index_" + category: candidate_index,
+            "chunk_type_to_candidate_idxs_" + category: chunk_type_to_candidate_idxs
+        }
+    return rel_path_str
 
-    base_output_dir = Path("tmp/merged_match_scores")
 
-    # 先收集所有 candidates，不分 CODE 和 TEXT
-    candidates = []
+def score_candidate_pair(query_cand: dict, candidate_cand: dict, group_ids: dict, folder_paths: dict,
+                         categories: Tuple[str, ...] = ("CODE", "TEXT")) -> dict:
+    """以 query_cand 为查询、candidate_cand 为候选，按 chunk_type 逐一打分"""
+    print(f"\n[MATCH] Query={query_cand['candidate_dir']}, Candidate={candidate_cand['candidate_dir']}")
 
-    for category in ["CODE", "TEXT"]:
-        category_base_path = merged_dir / category
-        print(f"category_base_path: {category_base_path}")
-        if not category_base_path.exists():
-            print(f"[WARN] Category base path missing: {category}")
-            continue
+    combined_results = {
+        "group_id": group_ids.get(candidate_cand["rel_path_str"]),
+        "folder_path": folder_paths.get(candidate_cand["rel_path_str"], ""),
+    }
+    combined_results.update({category: {} for category in categories})
 
-        candidate_idx_files = list(category_base_path.rglob("faiss_index.idx"))
-        print(f"[INFO] Found {len(candidate_idx_files)} candidate idx files for category {category}")
+    for category in categories:
+        query_index = query_cand.get("index_" + category)
+        candidate_index = candidate_cand.get("index_" + category)
+        chunk_type_to_query_idxs = query_cand.get("chunk_type_to_candidate_idxs_" + category, defaultdict(list))
+        chunk_type_to_candidate_idxs = candidate_cand.get("chunk_type_to_candidate_idxs_" + category, defaultdict(list))
 
-        for candidate_idx_path in candidate_idx_files:
-            candidate_dir = candidate_idx_path.parent
-            candidate_index, candidate_metadata = load_faiss_index_and_metadata(candidate_idx_path)
+        if not query_index or not candidate_index:
+            # 有可能某类别缺失，跳过该类别
+            continue
 
-            chunk_type_to_candidate_idxs = defaultdict(list)
-            for i, meta in enumerate(candidate_metadata):
-                ct = meta.get("chunk_type")
-                if not ct:
-                    print(f"[WARN] candidate metadata idx={i} missing chunk_type, skip")
-                    continue
-                chunk_type_to_candidate_idxs[ct].append(i)
+        all_chunk_types = set(chunk_type_to_query_idxs.keys()) & set(chunk_type_to_candidate_idxs.keys())
 
-            try:
-                relative_candidate_path = candidate_dir.relative_to(category_base_path)
-            except Exception as e:
-                print(f"[ERROR] candidate_dir.relative_to failed: {candidate_dir} with {e}")
-                relative_candidate_path = candidate_dir.name
+        for ct in all_chunk_types:
+            query_idxs = chunk_type_to_query_idxs[ct]
+            candidate_idxs = chunk_type_to_candidate_idxs[ct]
 
-            rel_path_str = str(relative_candidate_path)
+            if len(query_idxs) != len(candidate_idxs):
+                print(f"[WARN] chunk_type {ct} query idxs({len(query_idxs)}) != candidate idxs({len(candidate_idxs)})")
 
-            top_level = rel_path_str.split("/", 1)[0]
-            if top_level != antipattern_type:
-                continue
+            for qi, ci in zip(query_idxs, candidate_idxs):
+                query_vec = query_index.reconstruct(qi)
+                candidate_vec = candidate_index.reconstruct(ci)
 
-            if rel_path_str not in group_ids:
-                if candidate_metadata and "group_id" in candidate_metadata[0]:
-                    group_ids[rel_path_str] = candidate_metadata[0]["group_id"]
+                if category == "TEXT":
+                    sim = cosine_similarity(query_vec, candidate_vec)
+                    score = (sim + 1) / 2
                 else:
-                    group_ids[rel_path_str] = None
+                    dist = l2_distance(query_vec, candidate_vec)
+                    score = 1 / (1 + dist)
 
-            if rel_path_str not in folder_paths and candidate_metadata:
-                meta0 = candidate_metadata[0]
-                antipattern_type = meta0.get("antipattern_type", "")
-                project_name = meta0.get("project_name", "")
-                commit_number = meta0.get("commit_number", "")
-                id_ = meta0.get("id", "")
-                folder_path = Path(antipattern_type) / project_name / commit_number / id_
-                folder_paths[rel_path_str] = str(folder_path).replace("\\", "/")
+                score = float(score)
 
-            # 找 candidates 中是否已经有此 rel_path_str 记录，没有就创建新字典，存多个类别信息
-            exist = next((c for c in candidates if c["rel_path_str"] == rel_path_str), None)
-            if exist:
-                # 如果已经有此候选，更新此类别的index和chunk_type索引
-                exist["index_" + category] = candidate_index
-                exist["chunk_type_to_candidate_idxs_" + category] = chunk_type_to_candidate_idxs
-            else:
-                candidates.append({
-                    "rel_path_str": rel_path_str,
-                    "candidate_dir": candidate_dir,
-                    "metadata": candidate_metadata,
-                    "index_" + category: candidate_index,
-                    "chunk_type_to_candidate_idxs_" + category: chunk_type_to_candidate_idxs
-                })
+                key = f"query_{qi}"
+                if key not in combined_results[category]:
+                    combined_results[category][key] = []
 
-    # 现在 candidates 里每条记录都有 CODE 和 TEXT 对应的索引和 chunk_type 索引
-    for i, query_cand in enumerate(candidates):
-        for j, candidate_cand in enumerate(candidates):
-            if i == j:
-                continue  # 跳过自己匹配自己
+                combined_results[category][key].append({
+                    "chunk_type": ct,
+                    "score": score
+                })
 
-            print(f"\n[MATCH] Query={query_cand['candidate_dir']}, Candidate={candidate_cand['candidate_dir']}")
+    return combined_results
 
-            combined_results = {
-                "group_id": group_ids.get(candidate_cand["rel_path_str"]),
-                "folder_path": folder_paths.get(candidate_cand["rel_path_str"], ""),
-                "CODE": {},
-                "TEXT": {}
-            }
 
-            for category in ["CODE", "TEXT"]:
-                query_index = query_cand.get("index_" + category)
-                candidate_index = candidate_cand.get("index_" + category)
-                chunk_type_to_query_idxs = query_cand.get("chunk_type_to_candidate_idxs_" + category, defaultdict(list))
-                chunk_type_to_candidate_idxs = candidate_cand.get("chunk_type_to_candidate_idxs_" + category, defaultdict(list))
+def save_pair_scores(combined_results: dict, query_cand: dict, candidate_cand: dict, folder_paths: dict,
+                     base_output_dir: Path) -> Path:
+    """保存到 {base_output_dir}/{query folder_path}/{candidate rel_path}.json"""
+    folder_path = folder_paths.get(query_cand["rel_path_str"], "")
+    output_dir = base_output_dir / folder_path
+    output_dir.mkdir(parents=True, exist_ok=True)
 
-                if not query_index or not candidate_index:
-                    # 有可能某类别缺失，跳过该类别
-                    continue
+    candidate_name = candidate_cand["rel_path_str"].replace("/", "_")
+    output_file = output_dir / f"{candidate_name}.json"
 
-                all_chunk_types = set(chunk_type_to_query_idxs.keys()) & set(chunk_type_to_candidate_idxs.keys())
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(combined_results, f, indent=2, ensure_ascii=False)
 
-                for ct in all_chunk_types:
-                    query_idxs = chunk_type_to_query_idxs[ct]
-                    candidate_idxs = chunk_type_to_candidate_idxs[ct]
+    print(f"[SAVE] Match scores saved to: {output_file}")
+    return output_file
 
-                    if len(query_idxs) != len(candidate_idxs):
-                        print(f"[WARN] chunk_type {ct} query idxs({len(query_idxs)}) != candidate idxs({len(candidate_idxs)})")
 
-                    for qi, ci in zip(query_idxs, candidate_idxs):
-                        query_vec = query_index.reconstruct(qi)
-                        candidate_vec = candidate_index.reconstruct(ci)
+def match_merged_chunks_faiss(merged_dir: str, antipattern_type: str):
+    merged_dir = Path(merged_dir)
+    score_files = []
 
-                        if category == "TEXT":
-                            sim = cosine_similarity(query_vec, candidate_vec)
-                            score = (sim + 1) / 2
-                        else:
-                            dist = l2_distance(query_vec, candidate_vec)
-                            score = 1 / (1 + dist)
+    group_ids = {}
+    folder_paths = {}
 
-                        score = float(score)
+    base_output_dir = Path("tmp/merged_match_scores")
 
-                        key = f"query_{qi}"
-                        if key not in combined_results[category]:
-                            combined_results[category][key] = []
+    # 先收集所有 candidates，不分 CODE 和 TEXT（按 rel_path_str 合并，保持发现顺序）
+    candidates = {}
 
-                        combined_results[category][key].append({
-                            "chunk_type": ct,
-                            "score": score
-                        })
+    for category in ["CODE", "TEXT"]:
+        category_base_path = merged_dir / category
+        print(f"category_base_path: {category_base_path}")
+        if not category_base_path.exists():
+            print(f"[WARN] Category base path missing: {category}")
+            continue
 
-            # 存文件
-            folder_path = folder_paths.get(query_cand["rel_path_str"], "")
-            output_dir = base_output_dir / folder_path
-            output_dir.mkdir(parents=True, exist_ok=True)
+        candidate_idx_files = list(category_base_path.rglob("faiss_index.idx"))
+        print(f"[INFO] Found {len(candidate_idx_files)} candidate idx files for category {category}")
 
-            candidate_name = candidate_cand["rel_path_str"].replace("/", "_")
-            output_file = output_dir / f"{candidate_name}.json"
+        for candidate_idx_path in candidate_idx_files:
+            add_merged_candidate(candidates, category, category_base_path, candidate_idx_path, antipattern_type,
+                                 group_ids, folder_paths)
 
-            with open(output_file, "w", encoding="utf-8") as f:
-                json.dump(combined_results, f, indent=2, ensure_ascii=False)
+    # 现在 candidates 里每条记录都有 CODE 和 TEXT 对应的索引和 chunk_type 索引
+    candidates = list(candidates.values())
+    for i, query_cand in enumerate(candidates):
+        for j, candidate_cand in enumerate(candidates):
+            if i == j:
+                continue  # 跳过自己匹配自己
 
-            print(f"[SAVE] Match scores saved to: {output_file}")
-            score_files.append(output_file)
+            combined_results = score_candidate_pair(query_cand, candidate_cand, group_ids, folder_paths)
+            score_files.append(save_pair_scores(combined_results, query_cand, candidate_cand, folder_paths,
+                                                base_output_dir))
 
     return base_output_dir
 
@@ -1,18 +1,24 @@
 from config.settings import ANTIPATTERN_TYPE
-from embeddings.runner import run_embedding_pipeline
+from embeddings.runner import run_embedding_pipeline, run_embedding_in_memory
 from splitter.strategy_registry import load_splitter_by_mode
 
 antipattern_type = ANTIPATTERN_TYPE
 
 
 # 完成 query 的 chunk 分块
-def load_query_chunks(case_path: str, antipattern_type: str, mode="ast"):
+def load_query_chunks(case_path: str, antipattern_type: str, mode="ast", persist: bool = True):
     print("enter load_query_chunks")
+    if not persist and mode != "ast":
+        # 只有 ast 模式的 build_chunks 支持不落盘，其余 splitter 没有 persist 参数
+        raise ValueError(f"persist=False is only supported for mode='ast', got mode={mode!r}")
     group_id = -1
     build_chunks = load_splitter_by_mode(mode)
     print("enter build_chunks = load_splitter_by_mode(mode)")
     print(f"build_chunks : {build_chunks}")
-    chunks, query_chunk_path = build_chunks(case_path, antipattern_type, group_id)
+    if not persist:
+        chunks, query_chunk_path = build_chunks(case_path, antipattern_type, group_id, persist=False)
+    else:
+        chunks, query_chunk_path = build_chunks(case_path, antipattern_type, group_id)
     return chunks, query_chunk_path
 
 
@@ -20,3 +26,8 @@ def load_query_chunks(case_path: str, antipattern_type: str, mode="ast"):
 def load_query_embeddings(chunk_path: str, query: bool):
     query_embedding_path = run_embedding_pipeline(chunk_path, query)
     return query_embedding_path
+
+
+# 在内存中完成 query 的 chunks 的 embedding
+def load_query_embeddings_in_memory(chunks: dict, ablation: bool = False):
+    return run_embedding_in_memory(chunks, ablation)
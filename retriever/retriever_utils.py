@@ -2,9 +2,10 @@ import json
 import uuid
 from collections import defaultdict
 from pathlib import Path
-from typing import Union, List, Tuple, Dict, Any
+from typing import Union, List, Tuple, Dict, Any, Iterable
 
-from langchain_community.vectorstores import Chroma
+from config.settings import CASE_CATALOG_ENABLED
+from utils.case_catalog import get_case_catalog
 
 
 def collect_all_chroma_paths(base_dir: Union[str, Path]):
@@ -20,6 +21,8 @@ def collect_all_chroma_paths(base_dir: Union[str, Path]):
 
 
 def save_vectorstore(target_path: Path, data: dict, embedding_model):
+    from langchain_community.vectorstores import Chroma
+
     print(f"[SAVE] Writing to: {target_path}")
     if not target_path.exists():
         target_path.mkdir(parents=True, exist_ok=True)
@@ -53,6 +56,28 @@ def add_embeddings(db, docs, embeddings, metadatas):
 
 
 def aggregate_topk_from_merged_match_scores(merged_scores_dir: Path, weight_file: Path, top_k: int = 5) -> List[Tuple[str, float, str]]:
+    merged_scores_dir = Path(merged_scores_dir)
+    json_files = list(merged_scores_dir.glob("*.json"))
+
+    def iter_match_results():
+        for json_file in json_files:
+            try:
+                with open(json_file, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except Exception as e:
+                print(f"[ERROR] Failed to load {json_file}: {e}")
+                continue
+            yield data
+
+    return aggregate_topk_from_match_results(iter_match_results(), weight_file, top_k)
+
+
+def aggregate_topk_from_match_results(match_results: Iterable[dict], weight_file: Path,
+                                      top_k: int = 5) -> List[Tuple[str, float, str]]:
+    """
+    按 chunk_type 权重聚合每个 candidate 的匹配得分，返回得分最高的 top_k 个 (group_id, score, folder_path)。
+    match_results 既可以来自 merged_match_scores/*.json，也可以是 in-memory query 直接返回的结果。
+    """
     scores_by_group = defaultdict(float)
     group_to_path = {}
 
@@ -60,22 +85,12 @@ def aggregate_topk_from_merged_match_scores(merged_scores_dir: Path, weight_file
     with open(weight_file, "r", encoding="utf-8") as f:
         chunk_weights = json.load(f)
 
-    merged_scores_dir = Path(merged_scores_dir)
-    json_files = list(merged_scores_dir.glob("*.json"))
-
-    for json_file in json_files:
-        try:
-            with open(json_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        except Exception as e:
-            print(f"[ERROR] Failed to load {json_file}: {e}")
-            continue
-
+    for data in match_results:
         group_id = data.get("group_id")
         folder_path = data.get("folder_path", "")
 
         if group_id is None:
-            print(f"[WARN] No group_id in {json_file}, skip")
+            print("[WARN] No group_id in match result, skip")
             continue
 
         # 记录 group_id -> folder_path，优先第一个出现的路径
@@ -125,28 +140,45 @@ def read_and_save_files_in_paths(
         - "path": str
         - "files": dict, key=relative filepath (str), value=file content (str)
     """
+    data = read_files_in_paths(results)
+
     output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
+    output_file = output_dir / output_filename
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+
+    print(f"[INFO] Aggregated results saved to {output_file}")
+    return data
+
 
+def read_files_in_paths(results: List[Tuple[str, float, str]]) -> Dict[str, Dict[str, Any]]:
+    """
+    遍历每个结果中的path，读取该目录下所有文件内容，只返回不落盘。
+    """
     data = {}
+    catalog = get_case_catalog() if CASE_CATALOG_ENABLED else None
 
     for group_id, score, path_str in results:
-        base_path = Path(path_str)
+        # folder_path 不含 {other} 一级，catalog 只用于定位真实的 case 目录；
+        # catalog 只登记分块所需的输入文件，返回内容仍需遍历整个目录（after*/、static_after/ 等修复代码）
+        case_path = catalog.resolve_case_path(path_str) if catalog else None
+        base_path = Path(case_path or path_str)
         if not base_path.exists() or not base_path.is_dir():
             print(f"[WARN] Path does not exist or is not a directory: {path_str}")
             continue
+        rel_paths = sorted(p.relative_to(base_path).as_posix() for p in base_path.rglob("*") if p.is_file())
 
         files_content = {}
 
-        for file_path in base_path.rglob("*"):
-            if file_path.is_file():
-                try:
-                    rel_path = file_path.relative_to(base_path).as_posix()
-                    with open(file_path, "r", encoding="utf-8") as f:
-                        content = f.read()
-                    files_content[rel_path] = content
-                except Exception as e:
-                    print(f"[ERROR] Failed to read file {file_path}: {e}")
+        for rel_path in rel_paths:
+            file_path = base_path / rel_path
+            try:
+                with open(file_path, "r", encoding="utf-8") as f:
+                    content = f.read()
+                files_content[rel_path] = content
+            except Exception as e:
+                print(f"[ERROR] Failed to read file {file_path}: {e}")
 
         data[group_id] = {
             "score": score,
@@ -154,11 +186,6 @@ def read_and_save_files_in_paths(
             "files": files_content
         }
 
-    output_file = output_dir / output_filename
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
-
-    print(f"[INFO] Aggregated results saved to {output_file}")
     return data
 
 
@@ -1,17 +1,25 @@
+import json
 import os
+import pickle
+import uuid
 from pathlib import Path
+from typing import Union
 
 from config.settings import ANTIPATTERN_TYPE, CH_CHUNK_TYPE_WEIGHT_PATH, MH_CHUNK_TYPE_WEIGHT_PATH, \
     AWD_CHUNK_TYPE_WEIGHT_PATH, CH_CHUNK_TYPE_ABLATION_WEIGHT_PATH, MH_CHUNK_TYPE_ABLATION_WEIGHT_PATH, \
-    AWD_CHUNK_TYPE_ABLATION_WEIGHT_PATH
+    AWD_CHUNK_TYPE_ABLATION_WEIGHT_PATH, CHUNKS_DATA_DIR, RERANK_ENABLED, RERANK_CANDIDATES, RERANK_DEADLINE_MS
 from retriever.init_vectprstpre import match_query_to_candidate_chunks_faiss, match_merged_chunks_faiss, \
-    match_merged_chunks_faiss_ablation
-from retriever.query_matcher import load_query_chunks, load_query_embeddings
+    match_merged_chunks_faiss_ablation, score_query_against_candidates, save_match_results
+from retriever.query_matcher import load_query_chunks, load_query_embeddings, load_query_embeddings_in_memory
 from retriever.retriever_utils import aggregate_topk_from_merged_match_scores, read_and_save_files_in_paths, \
-    read_and_aggregated_results_in_paths
+    read_and_aggregated_results_in_paths, aggregate_topk_from_match_results, read_files_in_paths
+from utils.chunk_store import load_chunk_result
+from utils.utils import write_json_atomic
 
 
-def run_query_matching_pipeline(merge_vectorstore_dir: str, query_data_dir: str, top_k: int = 5):
+def run_query_matching_pipeline(merge_vectorstore_dir: str, query_data_dir: str, top_k: int = 5,
+                                rerank: bool = RERANK_ENABLED, rerank_candidates: int = RERANK_CANDIDATES,
+                                rerank_deadline_ms: float = RERANK_DEADLINE_MS, relevant_ids=None):
     """
     1. 从 query_project_dir 中提取文本/代码块
     2 对其进行 chunk → embedding → 存储为临时 query_vectorstore
@@ -20,14 +28,17 @@ def run_query_matching_pipeline(merge_vectorstore_dir: str, query_data_dir: str,
     5 聚合相似度结果，按 group_id 打分
     6 每个 chunk_type 保存一个 match_scores.json 到 query vectorstore 的路径下
     7 根据不同的得分策略来得到最相似的 top_k 个结果
+    8 （可选）对 dense 结果的前 rerank_candidates 个 group 用 cross-encoder rerank，超过 rerank_deadline_ms 时保留 dense 顺序
     :param merge_vectorstore_dir: 向量知识库存储路径
     :param query_data_dir: 待检索数据存储路径
     :param top_k: 检索到的最相关数目
+    :param rerank: 是否启用第二阶段 rerank（默认 RERANK_ENABLED）
+    :param relevant_ids: 已知正确的 group_id（评测用），rerank 报告中会比较 dense / rerank 的 hit@k 与 MRR
     :return:
     """
     print("run run_query_matching_pipeline")
     # 1. 从 query_project_dir 中提取文本/代码块
-    _, query_chunk_path = load_query_chunks(query_data_dir, ANTIPATTERN_TYPE)
+    query_chunks, query_chunk_path = load_query_chunks(query_data_dir, ANTIPATTERN_TYPE)
 
     # 2 对其进行 chunk → embedding → 存储为临时 query_vectorstore
     query_embedding_path = load_query_embeddings(query_chunk_path, True)
@@ -40,34 +51,110 @@ def run_query_matching_pipeline(merge_vectorstore_dir: str, query_data_dir: str,
     score_files = match_query_to_candidate_chunks_faiss(query_embedding_path, merge_vectorstore_dir)
 
     # 7 根据不同的得分策略来得到最相似的 top_k 个结果
-    result = aggregate_topk_from_merged_match_scores(score_files, CH_CHUNK_TYPE_WEIGHT_PATH)
+    if not rerank:
+        result = aggregate_topk_from_merged_match_scores(score_files, CH_CHUNK_TYPE_WEIGHT_PATH)
+    else:
+        # 8 dense 多取 rerank_candidates 个 group，交给 cross-encoder 重排
+        from reranker.runner import rerank_dense_results
+
+        if query_chunks is None:
+            # query_chunk.json 已存在时 splitter 跳过构建，只返回路径
+            query_chunks = load_chunk_result(query_chunk_path)
+        dense_result = aggregate_topk_from_merged_match_scores(score_files, CH_CHUNK_TYPE_WEIGHT_PATH,
+                                                               max(top_k, rerank_candidates))
+        chunk_dir = Path(CHUNKS_DATA_DIR or "tmp/chunks") / ANTIPATTERN_TYPE
+        result, rerank_report = rerank_dense_results(query_chunks, dense_result, chunk_dir,
+                                                     CH_CHUNK_TYPE_WEIGHT_PATH, top_k, rerank_candidates,
+                                                     rerank_deadline_ms, relevant_ids=relevant_ids)
+        write_json_atomic(rerank_report, Path(query_embedding_path) / "rerank_report.json")
     print(" top_k 个 结果：(group_id, score): ", result)
 
     final_result = read_and_save_files_in_paths(result, query_embedding_path)
     print(f"final_result: {final_result}")
 
 
+def run_query_matching_in_memory(merge_vectorstore_dir: str, query_data_dir: str, top_k: int = 5,
+                                 antipattern_type: str = ANTIPATTERN_TYPE, save_artifacts: bool = False,
+                                 artifact_root: Union[str, Path] = "query", ablation: bool = False) -> dict:
+    """
+    in-memory 版本的 run_query_matching_pipeline：
+    query 的 chunk 和 embedding 只保存在内存中，直接交给 matcher 打分、聚合，
+    不再写入 / 回读固定的 query/query_chunk.json 与 query/vectorstore，多个 query 可以并发执行。
+
+    :param save_artifacts: 是否保存中间结果，保存时每个请求单独使用 {artifact_root}/{uuid} 目录
+    :return: {"result": top_k (group_id, score, folder_path), "final_result": ..., "artifact_dir": ...}
+    """
+    # 1. 从 query_data_dir 中提取文本/代码块（不落盘）
+    chunks, _ = load_query_chunks(query_data_dir, antipattern_type, persist=False)
+
+    # 2. 在内存中完成 embedding
+    query_stores = load_query_embeddings_in_memory(chunks, ablation)
+
+    # 3 - 5. 与 merged_vectorstore_dir 中的 candidate chunks 做相似度匹配
+    match_results = score_query_against_candidates(query_stores, merge_vectorstore_dir)
+
+    # 6. 根据 chunk_type 权重聚合得到 top_k
+    weight_path = get_chunk_type_weight_path(antipattern_type, ablation)
+    result = aggregate_topk_from_match_results(match_results.values(), weight_path, top_k)
+    print(" top_k 个 结果：(group_id, score): ", result)
+
+    final_result = read_files_in_paths(result)
+
+    artifact_dir = None
+    if save_artifacts:
+        artifact_dir = save_query_artifacts(Path(artifact_root) / uuid.uuid4().hex, chunks, query_stores,
+                                            match_results, final_result)
+
+    return {"result": result, "final_result": final_result, "artifact_dir": artifact_dir}
+
+
+def save_query_artifacts(artifact_dir: Path, chunks: dict, query_stores: dict, match_results: dict,
+                         final_result: dict) -> Path:
+    """
+    将一次 in-memory query 的中间结果写入独立目录，目录结构与原 query/ 下保持一致。
+    """
+    import faiss
+
+    artifact_dir = Path(artifact_dir)
+    artifact_dir.mkdir(parents=True, exist_ok=True)
+
+    with open(artifact_dir / "query_chunk.json", "w", encoding="utf-8") as f:
+        json.dump(chunks, f, ensure_ascii=False, indent=2)
+
+    for category, store in query_stores.items():
+        store_dir = artifact_dir / "vectorstore" / category
+        store_dir.mkdir(parents=True, exist_ok=True)
+        index = faiss.IndexFlatL2(store["embeddings"].shape[1])
+        index.add(store["embeddings"])
+        faiss.write_index(index, str(store_dir / "faiss_index.idx"))
+        with open(store_dir / "metadata.pkl", "wb") as f:
+            pickle.dump(store["metadatas"], f)
+
+    save_match_results(match_results, artifact_dir / "merged_match_scores")
+
+    with open(artifact_dir / "aggregated_results.json", "w", encoding="utf-8") as f:
+        json.dump(final_result, f, indent=2, ensure_ascii=False)
+
+    print(f"[✓] Query artifacts saved to {artifact_dir}")
+    return artifact_dir
+
+
+def get_chunk_type_weight_path(antipattern_type: str, ablation: bool = False) -> str:
+    if ablation:
+        weight_paths = {"CH": CH_CHUNK_TYPE_ABLATION_WEIGHT_PATH, "MH": MH_CHUNK_TYPE_ABLATION_WEIGHT_PATH,
+                        "AWD": AWD_CHUNK_TYPE_ABLATION_WEIGHT_PATH}
+    else:
+        weight_paths = {"CH": CH_CHUNK_TYPE_WEIGHT_PATH, "MH": MH_CHUNK_TYPE_WEIGHT_PATH,
+                        "AWD": AWD_CHUNK_TYPE_WEIGHT_PATH}
+    return weight_paths.get(antipattern_type, "")
+
+
 def batch_process_vectorstore_query(vectorstore_path, antipattern_type, ablation=False):
     if ablation:
         base_dir = match_merged_chunks_faiss_ablation(vectorstore_path, antipattern_type)
-        chunk_type_weight_path = ""
-        match antipattern_type:
-            case "CH":
-                chunk_type_weight_path = CH_CHUNK_TYPE_ABLATION_WEIGHT_PATH
-            case "MH":
-                chunk_type_weight_path = MH_CHUNK_TYPE_ABLATION_WEIGHT_PATH
-            case "AWD":
-                chunk_type_weight_path = AWD_CHUNK_TYPE_ABLATION_WEIGHT_PATH
     else:
         base_dir = match_merged_chunks_faiss(vectorstore_path, antipattern_type)
-        chunk_type_weight_path = ""
-        match antipattern_type:
-            case "CH":
-                chunk_type_weight_path = CH_CHUNK_TYPE_WEIGHT_PATH
-            case "MH":
-                chunk_type_weight_path = MH_CHUNK_TYPE_WEIGHT_PATH
-            case "AWD":
-                chunk_type_weight_path = AWD_CHUNK_TYPE_WEIGHT_PATH
+    chunk_type_weight_path = get_chunk_type_weight_path(antipattern_type, ablation)
 
     batch_process_query(base_dir, chunk_type_weight_path, antipattern_type)
 
@@ -1,54 +1,40 @@
+import asyncio
 import json
 import os
+from dataclasses import dataclass
 from pathlib import Path
 from typing import List, Union, Any
 from splitter.ch_ast_splitter.ast_extractor import extract_superclass_chunks, extract_subclass_chunks, \
     extract_awd_superclass_chunks, extract_awd_subclass_chunks
 from splitter.ch_ast_splitter.base_chunk_schema import BaseChunk
 from splitter.ch_ast_splitter.json_processor import load_case_info
-from config.settings import DATA_DIR
+from config.settings import DATA_DIR, LLM_BATCH_SUMMARIES
 from splitter.ch_ast_splitter.llm_chunk_analyzer import llm_analyze_superclass, llm_analyze_subclass, \
-    awd_llm_analyze_subclass
+    awd_llm_analyze_subclass, allm_analyze_superclass, allm_analyze_subclass, llm_analyze_ch_case, \
+    allm_analyze_ch_case
 from splitter.utils import parse_line_range
+from utils.chunk_store import write_chunk_result, find_chunk_output
 
 
-def build_chunks(base_dir: Union[str, Path], antipattern_type, group_id):
+def build_chunks(base_dir: Union[str, Path], antipattern_type, group_id, persist: bool = True):
+    """
+    :param persist: False 时只在内存中返回分块结果，不写 chunk JSON（output_path 返回 None），
+                    用于 in-memory query，避免并发 query 互相覆盖 query/query_chunk.json
+    """
     result = ''
     output_path = ''
     match antipattern_type:
         case "CH":
-            result, output_path = build_ch_chunks(base_dir, antipattern_type, group_id)
+            result, output_path = build_ch_chunks(base_dir, antipattern_type, group_id, persist)
         case "MH":
-            result, output_path = build_mh_chunks(base_dir, antipattern_type, group_id)
+            result, output_path = build_mh_chunks(base_dir, antipattern_type, group_id, persist)
         case "AWD":
-            result, output_path = build_awd_chunks(base_dir, antipattern_type, group_id)
+            result, output_path = build_awd_chunks(base_dir, antipattern_type, group_id, persist)
 
     return result, output_path
 
 
-def build_ch_chunks(base_dir: Union[str, Path], antipattern_type, group_id):
-    """
-    主函数：从一个 CH 案例文件夹中自动定位 JSON 和 Java 文件，抽取 AST 和分析块
-    :param base_dir: 指向某个具体 `{id}` 案例文件夹（包含 before/ 与 .json）
-    :param antipattern_type:
-    :param group_id:
-    :dict[str, Union[str, list, Any]]，每个父子子子块
-    """
-    base_dir = Path(base_dir)
-
-    print("enter build_chunks")
-
-    # 得到 chunk 的 metadata 内容，如果是构建 query 的chunk，即 group_id < 0，则其他内容都为-1
-    if group_id < 0:
-        antipattern_type = antipattern_type
-        project_name = -1
-        commit_number = -1
-        case_id = -1
-    else:
-        # 提取路径倒数四级
-        parts = base_dir.parts[-4:]  # 获取倒数4个路径名
-        _, project_name, commit_number, case_id = parts
-
+def get_chunk_output_path(antipattern_type, project_name, commit_number, case_id, group_id) -> Path:
     if group_id < 0:
         chunk_filename = "query_chunk.json"
         output_dir = Path("query")
@@ -56,14 +42,40 @@ def build_ch_chunks(base_dir: Union[str, Path], antipattern_type, group_id):
         # 构造输出路径：和 JSON 文件在同一目录，命名为 `{project}_{case_id}_{antipattern}_chunk.json`
         chunk_filename = f"{project_name}_{commit_number}_{case_id}_{antipattern_type}_chunk.json"
         output_dir = Path(f"tmp/chunks/{antipattern_type}")
+    return output_dir / chunk_filename
+
+
+def save_chunk_result(result: dict, output_path: Union[str, Path]) -> Union[Path, str]:
+    output_path = write_chunk_result(result, output_path)
+    print(f"分块结果已保存至: {output_path}")
+    return output_path
+
 
-    output_dir.mkdir(parents=True, exist_ok=True)  # 自动创建目录
-    output_path = output_dir / chunk_filename
+@dataclass
+class CHCaseInputs:
+    """一个 CH case 中 AST 抽取与 LLM 分析所需的全部输入"""
+    super_path: str
+    super_code: str
+    sub_path: str
+    sub_code: str
+    parent_method_loc: tuple
+    child_method_loc: tuple
+    invocation_loc: tuple
+    parent_method_code: str
+    child_method_code: str
+    invocation_code: str
 
-    if output_path.exists() and output_path.stat().st_size > 0:
-        print(f"[SKIP] {output_path} already exists and is not empty. Skip building.")
-        return None, output_path
 
+def get_case_metadata(base_dir: Path, group_id):
+    # 得到 chunk 的 metadata 内容，如果是构建 query 的chunk，即 group_id < 0，则其他内容都为-1
+    if group_id < 0:
+        return -1, -1, -1
+    # 提取路径倒数四级
+    _, project_name, commit_number, case_id = base_dir.parts[-4:]  # 获取倒数4个路径名
+    return project_name, commit_number, case_id
+
+
+def load_ch_case_inputs(base_dir: Path) -> CHCaseInputs:
     # 找到 JSON 文件（一个案例文件夹应该只有一个 *antipattern.json）
     json_files = list(base_dir.glob("*antipattern.json"))
     if not json_files:
@@ -85,29 +97,107 @@ def build_ch_chunks(base_dir: Union[str, Path], antipattern_type, group_id):
 
     # 提取位置信息（仅使用第一个调用）
     snippet = case.code_snippets[0]
-    parent_method_loc = parse_line_range(snippet.parent_method.location)
-    child_method_loc = parse_line_range(snippet.child_method.location)
-    invocation_loc = parse_line_range(snippet.invocation.location)
+    return CHCaseInputs(
+        super_path=super_path,
+        super_code=super_code,
+        sub_path=sub_path,
+        sub_code=sub_code,
+        parent_method_loc=parse_line_range(snippet.parent_method.location),
+        child_method_loc=parse_line_range(snippet.child_method.location),
+        invocation_loc=parse_line_range(snippet.invocation.location),
+        # 提取代码片段
+        parent_method_code=snippet.parent_method.code,
+        child_method_code=snippet.child_method.code,
+        invocation_code=snippet.invocation.code,
+    )
+
+
+def build_ch_chunks(base_dir: Union[str, Path], antipattern_type, group_id, persist: bool = True):
+    """
+    主函数：从一个 CH 案例文件夹中自动定位 JSON 和 Java 文件，抽取 AST 和分析块
+    :param base_dir: 指向某个具体 `{id}` 案例文件夹（包含 before/ 与 .json）
+    :param antipattern_type:
+    :param group_id:
+    :dict[str, Union[str, list, Any]]，每个父子子子块
+    """
+    base_dir = Path(base_dir)
+
+    print("enter build_chunks")
+
+    project_name, commit_number, case_id = get_case_metadata(base_dir, group_id)
+    output_path = get_chunk_output_path(antipattern_type, project_name, commit_number, case_id, group_id)
 
-    # 提取代码片段
-    parent_method_code = snippet.parent_method.code
-    child_method_code = snippet.child_method.code
-    invocation_code = snippet.invocation.code
+    existing_output = find_chunk_output(output_path) if persist else None
+    if existing_output is not None:
+        print(f"[SKIP] {existing_output} already exists and is not empty. Skip building.")
+        return None, existing_output
+
+    inputs = load_ch_case_inputs(base_dir)
 
     # ---- SuperClass 的子块 ----
     print("start SuperClass Chunk")
     super_chunks: List[BaseChunk] = []
-    super_chunks = extract_superclass_chunks(super_code, super_path, parent_method_loc, invocation_loc)
-    super_chunks.extend(llm_analyze_superclass(super_path, parent_method_code, invocation_code))
+    super_chunks = extract_superclass_chunks(inputs.super_code, inputs.super_path,
+                                             inputs.parent_method_loc, inputs.invocation_loc)
 
     # ---- SubClass 的子块 ----
     print("start SubClass Chunk")
     sub_chunks: List[BaseChunk] = []
-    sub_chunks = extract_subclass_chunks(sub_code, sub_path, child_method_loc)
-    sub_chunks.extend(llm_analyze_subclass(sub_path, child_method_code))
+    sub_chunks = extract_subclass_chunks(inputs.sub_code, inputs.sub_path, inputs.child_method_loc)
+
+    if LLM_BATCH_SUMMARIES:
+        # 一次请求得到 5 个摘要
+        super_llm, sub_llm = llm_analyze_ch_case(inputs.super_path, inputs.sub_path, inputs.parent_method_code,
+                                                 inputs.invocation_code, inputs.child_method_code)
+    else:
+        super_llm = llm_analyze_superclass(inputs.super_path, inputs.parent_method_code, inputs.invocation_code)
+        sub_llm = llm_analyze_subclass(inputs.sub_path, inputs.child_method_code)
+    super_chunks.extend(super_llm)
+    sub_chunks.extend(sub_llm)
+
+    return finish_ch_chunks(super_chunks + sub_chunks, antipattern_type, project_name, commit_number, case_id,
+                            group_id, output_path, persist)
+
+
+async def abuild_ch_chunks(base_dir: Union[str, Path], antipattern_type, group_id, persist: bool = True):
+    """
+    build_ch_chunks 的异步版本：LLM 调用并发发出（受 LLM_MAX_CONCURRENCY 全局限制），
+    AST 抽取放到线程中与 LLM 调用重叠执行；输出与同步版本完全一致（chunk 顺序不变）。
+    """
+    base_dir = Path(base_dir)
+
+    project_name, commit_number, case_id = get_case_metadata(base_dir, group_id)
+    output_path = get_chunk_output_path(antipattern_type, project_name, commit_number, case_id, group_id)
+
+    existing_output = find_chunk_output(output_path) if persist else None
+    if existing_output is not None:
+        print(f"[SKIP] {existing_output} already exists and is not empty. Skip building.")
+        return None, existing_output
 
+    inputs = await asyncio.to_thread(load_ch_case_inputs, base_dir)
+
+    ast_tasks = asyncio.gather(
+        asyncio.to_thread(extract_superclass_chunks, inputs.super_code, inputs.super_path,
+                          inputs.parent_method_loc, inputs.invocation_loc),
+        asyncio.to_thread(extract_subclass_chunks, inputs.sub_code, inputs.sub_path, inputs.child_method_loc),
+    )
+    if LLM_BATCH_SUMMARIES:
+        llm_tasks = allm_analyze_ch_case(inputs.super_path, inputs.sub_path, inputs.parent_method_code,
+                                         inputs.invocation_code, inputs.child_method_code)
+    else:
+        llm_tasks = asyncio.gather(
+            allm_analyze_superclass(inputs.super_path, inputs.parent_method_code, inputs.invocation_code),
+            allm_analyze_subclass(inputs.sub_path, inputs.child_method_code),
+        )
+    (super_ast, sub_ast), (super_llm, sub_llm) = await asyncio.gather(ast_tasks, llm_tasks)
+
+    return await asyncio.to_thread(finish_ch_chunks, super_ast + super_llm + sub_ast + sub_llm, antipattern_type,
+                                   project_name, commit_number, case_id, group_id, output_path, persist)
+
+
+def finish_ch_chunks(all_chunks: List[BaseChunk], antipattern_type, project_name, commit_number, case_id, group_id,
+                     output_path: Path, persist: bool):
     # ---- 整合所有 chunk ----
-    all_chunks = super_chunks + sub_chunks
     print(all_chunks)
 
     json_chunks = [chunk.to_dict() for chunk in all_chunks]
@@ -121,15 +211,21 @@ def build_ch_chunks(base_dir: Union[str, Path], antipattern_type, group_id):
         "chunks": json_chunks
     }
 
+    if not persist:
+        return result, None
+    return result, save_chunk_result(result, output_path)
 
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(result, f, ensure_ascii=False, indent=2)
 
-    print(f"分块结果已保存至: {output_path}")
-    return result, output_path
+async def abuild_chunks(base_dir: Union[str, Path], antipattern_type, group_id, persist: bool = True):
+    """
+    build_chunks 的异步版本：CH 使用并发 LLM 调用；MH / AWD 不调用 LLM，放到线程中执行同步版本。
+    """
+    if antipattern_type == "CH":
+        return await abuild_ch_chunks(base_dir, antipattern_type, group_id, persist)
+    return await asyncio.to_thread(build_chunks, base_dir, antipattern_type, group_id, persist)
 
 
-def build_mh_chunks(base_dir: Union[str, Path], antipattern_type, group_id):
+def build_mh_chunks(base_dir: Union[str, Path], antipattern_type, group_id, persist: bool = True):
     """
     主函数：从一个 MH 案例文件夹中自动定位 JSON 和 Java 文件，抽取 AST 和分析块
     :param base_dir: 指向某个具体 `{id}` 案例文件夹（包含 before/ 与 .json）
@@ -222,24 +318,13 @@ def build_mh_chunks(base_dir: Union[str, Path], antipattern_type, group_id):
         "chunks": chunks
     }
 
-    if group_id < 0:
-        chunk_filename = "query_chunk.json"
-        output_dir = Path("query")
-    else:
-        # 构造输出路径：和 JSON 文件在同一目录，命名为 `{project}_{case_id}_{antipattern}_chunk.json`
-        chunk_filename = f"{project_name}_{commit_number}_{case_id}_{antipattern_type}_chunk.json"
-        output_dir = Path(f"tmp/chunks/{antipattern_type}")
-    output_dir.mkdir(parents=True, exist_ok=True)  # 自动创建目录
-    output_path = output_dir / chunk_filename
+    if not persist:
+        return result, None
+    return result, save_chunk_result(
+        result, get_chunk_output_path(antipattern_type, project_name, commit_number, case_id, group_id))
 
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(result, f, ensure_ascii=False, indent=2)
 
-    print(f"分块结果已保存至: {output_path}")
-    return result, output_path
-
-
-def build_awd_chunks(base_dir: Union[str, Path], antipattern_type, group_id):
+def build_awd_chunks(base_dir: Union[str, Path], antipattern_type, group_id, persist: bool = True):
     """
     主函数：从一个 AWD 案例文件夹中自动定位 JSON 和 Java 文件，抽取 AST 和分析块
     :param base_dir: 指向某个具体 `{id}` 案例文件夹（包含 before/ 与 .json）
@@ -336,21 +421,10 @@ def build_awd_chunks(base_dir: Union[str, Path], antipattern_type, group_id):
         "chunks": json_chunks
     }
 
-    if group_id < 0:
-        chunk_filename = "query_chunk.json"
-        output_dir = Path("query")
-    else:
-        # 构造输出路径：和 JSON 文件在同一目录，命名为 `{project}_{case_id}_{antipattern}_chunk.json`
-        chunk_filename = f"{project_name}_{commit_number}_{case_id}_{antipattern_type}_chunk.json"
-        output_dir = Path(f"tmp/chunks/{antipattern_type}")
-    output_dir.mkdir(parents=True, exist_ok=True)  # 自动创建目录
-    output_path = output_dir / chunk_filename
-
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(result, f, ensure_ascii=False, indent=2)
-
-    print(f"分块结果已保存至: {output_path}")
-    return result, output_path
+    if not persist:
+        return result, None
+    return result, save_chunk_result(
+        result, get_chunk_output_path(antipattern_type, project_name, commit_number, case_id, group_id))
 
 
 if __name__ == "__main__":
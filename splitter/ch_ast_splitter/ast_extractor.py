@@ -1,20 +1,28 @@
-import os
+import hashlib
+from bisect import bisect_left, bisect_right
+import threading
 import warnings
+from collections import OrderedDict
 
-from tree_sitter import Language, Parser
 from typing import Optional
 
+from config.settings import AST_PARSE_CACHE_SIZE
+
 from splitter.ch_ast_splitter.ast_chunk_schema import ASTChunk
+from splitter.ch_ast_splitter.ast_serializer import serialize_ast
 from splitter.ch_ast_splitter.base_chunk_schema import ChunkType, AWDChunkType
 
 warnings.filterwarnings("ignore", category=FutureWarning)
 
-print("Current working directory:", os.getcwd())
+# Java parser 在第一次解析时才加载 build/my-languages.so，只导入本模块（如汇总分数）时不需要 tree-sitter
+_java_parser = None
 
-# 初始化 Java parser
-JAVA_LANGUAGE = Language('build/my-languages.so', 'java')
-parser = Parser()
-parser.set_language(JAVA_LANGUAGE)
+# 解析缓存：内容哈希 -> LineRangeIndex（含 Tree），LRU 淘汰。同一文件在一个 case 内会被多次抽取（父类 3 次、AWD client 4 次），
+# 不同 case 之间也常共享同一文件
+_parse_cache = OrderedDict()
+_parse_cache_lock = threading.Lock()
+_parser_lock = threading.Lock()  # Parser 对象不是线程安全的
+_parse_cache_stats = {"hits": 0, "misses": 0}
 
 
 def read_source_file(file_path: str) -> str:
@@ -22,40 +30,116 @@ def read_source_file(file_path: str) -> str:
         return f.read()
 
 
-def get_node_by_line_range(root_node, start_line: int, end_line: int):
+class LineRangeIndex:
+    """
+    每棵 Tree 一份的行区间索引，与 Tree 一起缓存。
+    兄弟节点按位置有序且互不重叠，其起止行号都单调不减，因此覆盖 [start_line, end_line] 的子节点
+    是一段连续区间，可以用二分直接定位，无需逐个检查子节点；各节点的子节点行号数组按需构建后复用。
     """
-    找到覆盖从 start_line 到 end_line 的最小节点，节点必须完全覆盖区间。
+
+    def __init__(self, tree):
+        self.tree = tree
+        self._children = {}
+
+    def _get_children(self, node):
+        entry = self._children.get(node.id)
+        if entry is None:
+            children = node.children
+            entry = (children,
+                     [c.start_point[0] for c in children],
+                     [c.end_point[0] for c in children])
+            self._children[node.id] = entry
+        return entry
+
+    def find(self, start_line: int, end_line: int):
+        """
+        找到完全覆盖 [start_line, end_line]（行号从 1 开始）的最小节点：在所有覆盖区间的节点中返回行跨度最小的，
+        跨度相同时取先序遍历中最先出现的；根节点也不覆盖时返回 None。
+        """
+        start_row, end_row = start_line - 1, end_line - 1
+        root = self.tree.root_node
+        if not (root.start_point[0] <= start_row and root.end_point[0] >= end_row):
+            return None
+
+        best, best_span = None, None
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            span = node.end_point[0] - node.start_point[0]
+            if best is None or span < best_span:
+                best, best_span = node, span
+            children, starts, ends = self._get_children(node)
+            lo = bisect_left(ends, end_row)
+            hi = bisect_right(starts, start_row)
+            # 逆序入栈，保证按先序顺序出栈
+            for i in range(hi - 1, lo - 1, -1):
+                stack.append(children[i])
+        return best
+
+
+def get_java_parser():
+    """返回共享的 Java Parser；Parser 不是线程安全的，解析时需持有 _parser_lock"""
+    global _java_parser
+    if _java_parser is None:
+        from tree_sitter import Language, Parser
+
+        java_parser = Parser()
+        java_parser.set_language(Language('build/my-languages.so', 'java'))
+        _java_parser = java_parser
+    return _java_parser
+
+
+def get_line_range_index(code: str) -> LineRangeIndex:
     """
-    candidates = []
+    解析 Java 源码，按内容哈希缓存并复用 Tree 及其行区间索引（Tree 只读共享，不做 edit）。
+    """
+    source = bytes(code, "utf8")
+    key = hashlib.sha1(source).hexdigest()
+    with _parse_cache_lock:
+        index = _parse_cache.get(key)
+        if index is not None:
+            _parse_cache.move_to_end(key)
+            _parse_cache_stats["hits"] += 1
+            return index
+        _parse_cache_stats["misses"] += 1
+
+    with _parser_lock:
+        index = LineRangeIndex(get_java_parser().parse(source))
+
+    with _parse_cache_lock:
+        _parse_cache[key] = index
+        _parse_cache.move_to_end(key)
+        while len(_parse_cache) > AST_PARSE_CACHE_SIZE:
+            _parse_cache.popitem(last=False)
+    return index
+
+
+def parse_code(code: str):
+    return get_line_range_index(code).tree
+
 
-    def traverse(node):
-        node_start = node.start_point[0] + 1
-        node_end = node.end_point[0] + 1
+def get_parse_cache_stats() -> dict:
+    with _parse_cache_lock:
+        return {**_parse_cache_stats, "size": len(_parse_cache)}
 
-        # 只考虑完全覆盖区间的节点
-        if node_start <= start_line and node_end >= end_line:
-            candidates.append(node)
-            for child in node.children:
-                traverse(child)
 
-    traverse(root_node)
-    if not candidates:
-        return None
-    # 返回跨度最小的节点
-    return min(candidates, key=lambda n: (n.end_point[0] - n.start_point[0]))
+def clear_parse_cache():
+    with _parse_cache_lock:
+        _parse_cache.clear()
+        _parse_cache_stats.update(hits=0, misses=0)
 
 
 def extract_ast_chunk(code: str, file_path: str, chunk_type,
                       start_line: Optional[int] = None, end_line: Optional[int] = None) -> ASTChunk:
-    tree = parser.parse(bytes(code, "utf8"))
-    root_node = tree.root_node
+    index = get_line_range_index(code)
+    root_node = index.tree.root_node
 
     print(f"root_node: {root_node}")
     print(f"start_line: {start_line}")
     print(f"end_line: {end_line}")
 
     if start_line and end_line:
-        node = get_node_by_line_range(root_node, start_line, end_line)
+        node = index.find(start_line, end_line)
     else:
         node = root_node
 
@@ -66,7 +150,7 @@ def extract_ast_chunk(code: str, file_path: str, chunk_type,
         chunk_type=chunk_type,
         level=3,
         chunk_id=chunk_type.value,
-        ast_subtree=node.sexp()  # 使用 S-expression 结构作为语法表示
+        ast_subtree=serialize_ast(node)  # 默认使用 S-expression 结构作为语法表示，可切换为 compact
     )
 
 
@@ -0,0 +1,338 @@
+import io
+import json
+from pathlib import Path
+from typing import Optional, Union
+
+from config.settings import AST_SERIALIZATION, AST_MAX_DEPTH, AST_FOLD_METHOD_BODIES, AST_ABBREVIATE_TYPES, \
+    AST_SEXP_MAX_CHARS, AST_SEXP_MAX_TOKENS
+
+# 字面量节点：对结构相似性几乎没有贡献，但在 sexp 中占大量 token
+LITERAL_NODE_TYPES = {
+    "decimal_integer_literal", "hex_integer_literal", "octal_integer_literal", "binary_integer_literal",
+    "decimal_floating_point_literal", "hex_floating_point_literal", "string_literal", "string_fragment",
+    "escape_sequence", "character_literal", "text_block", "true", "false", "null_literal",
+    "line_comment", "block_comment",
+}
+
+# 方法体折叠：只保留签名，方法体替换为单个 block 叶子
+FOLDABLE_NODE_TYPES = {"method_declaration", "constructor_declaration"}
+BODY_NODE_TYPES = {"block", "constructor_body"}
+
+# 节点类型缩写：按后缀替换，保持可读性（embedding 模型仍能理解）
+TYPE_ABBREVIATIONS = {
+    "method_invocation": "call",
+    "identifier": "id",
+    "type_identifier": "tid",
+    "formal_parameters": "params",
+    "formal_parameter": "param",
+    "argument_list": "args",
+    "field_access": "field",
+    "modifiers": "mods",
+    "scoped_type_identifier": "stid",
+    "generic_type": "gtype",
+    "type_arguments": "targs",
+}
+SUFFIX_ABBREVIATIONS = [
+    ("_declaration", "Decl"),
+    ("_declarator", "Dcl"),
+    ("_expression", "Expr"),
+    ("_statement", "Stmt"),
+    ("_body", "Body"),
+    ("_clause", "Cl"),
+    ("_type", "Ty"),
+]
+
+# sexp 截断：在截断处写入标记，再补齐未闭合的括号
+SEXP_TRUNCATION_MARKER = " ..."
+# 估算 token 数时每个 token 对应的字符数（与 MAX_CHUNK_CHARS 的估算一致）
+SEXP_CHARS_PER_TOKEN = 3
+
+# 统计 / 检索对比时默认评估的剪枝配置
+DEFAULT_VARIANTS = {
+    "compact": {},
+    "compact_depth8": {"max_depth": 8},
+    "compact_fold": {"fold_method_bodies": True},
+    "compact_fold_depth8": {"fold_method_bodies": True, "max_depth": 8},
+}
+
+
+def abbreviate_type(node_type: str) -> str:
+    if node_type in TYPE_ABBREVIATIONS:
+        return TYPE_ABBREVIATIONS[node_type]
+    for suffix, short in SUFFIX_ABBREVIATIONS:
+        if node_type.endswith(suffix):
+            return node_type[:-len(suffix)] + short
+    return node_type
+
+
+def serialize_compact(node, drop_literals: bool = True, drop_punctuation: bool = True,
+                      max_depth: Optional[int] = None, abbreviate: bool = True,
+                      fold_method_bodies: bool = False) -> str:
+    """
+    紧凑的结构化序列化，作为 node.sexp() 的替代：
+    - 不输出字段名（name: / body: 等）
+    - drop_punctuation: 跳过匿名节点（括号、分号、关键字等）
+    - drop_literals: 跳过字面量与注释节点
+    - max_depth: 超过该深度的子树只保留节点类型
+    - abbreviate: 缩写节点类型名
+    - fold_method_bodies: 非根节点的方法 / 构造器只保留签名，方法体折叠为 block
+    没有子节点的节点直接输出类型名，不加括号。
+    """
+    def label(n) -> str:
+        return abbreviate_type(n.type) if abbreviate else n.type
+
+    # 显式栈代替递归（深层 AST 如上千项的字符串拼接会超出 Python 递归深度）：
+    # 栈中是待输出的字符串或待展开的 (节点, 深度)，子节点逆序入栈以保持输出顺序
+    parts = []
+    stack = [(node, 0)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
+            continue
+        n, depth = item
+        children = [
+            c for c in n.children
+            if not (drop_punctuation and not c.is_named) and not (drop_literals and c.type in LITERAL_NODE_TYPES)
+        ]
+        if not children or (max_depth is not None and depth >= max_depth):
+            parts.append(label(n))
+            continue
+        folded = fold_method_bodies and depth > 0 and n.type in FOLDABLE_NODE_TYPES
+        parts.append("(" + label(n))
+        stack.append(")")
+        for child in reversed(children):
+            stack.append(label(child) if folded and child.type in BODY_NODE_TYPES else (child, depth + 1))
+            stack.append(" ")
+    return "".join(parts)
+
+
+def get_sexp_char_limit(max_chars: Optional[int] = None, max_tokens: Optional[int] = None) -> Optional[int]:
+    limits = [limit for limit in (max_chars, max_tokens * SEXP_CHARS_PER_TOKEN if max_tokens else None) if limit]
+    return min(limits) if limits else None
+
+
+def write_sexp(node, out, max_chars: Optional[int] = None, max_tokens: Optional[int] = None) -> bool:
+    """
+    用 TreeCursor 遍历 node，把 S-expression 逐段写入 out（任何带 write 方法的对象），不构造整棵树的字符串。
+    不限制长度时输出与 node.sexp() 逐字节一致：
+    - 只输出具名节点与 MISSING 节点，字段名写为 "field: "（含经由隐藏节点继承的字段）
+    - 有内容的 ERROR 叶子（UNEXPECTED 字符）交给 node.sexp() 处理
+    设置 max_chars / max_tokens 时，写入下一个节点会超出上限则写入 SEXP_TRUNCATION_MARKER、补齐括号并停止遍历。
+
+    :return: 是否发生了截断
+    """
+    limit = get_sexp_char_limit(max_chars, max_tokens)
+    if node.type != node.grammar_name or (not node.is_named and not node.is_missing) or node.child_count == 0:
+        # 根节点为匿名 / 别名节点时 sexp() 按文法中的原始符号输出，格式不同；叶子节点本身很短。均直接使用原生实现
+        text = node.sexp()
+        if limit is None or len(text) <= limit:
+            out.write(text)
+            return False
+        out.write(text[:max(limit - len(SEXP_TRUNCATION_MARKER), 0)] + SEXP_TRUNCATION_MARKER)
+        return True
+
+    written = 0
+    open_parens = 0
+
+    def node_head(n, field_name: Optional[str]) -> str:
+        prefix = f" {field_name}: " if field_name else " "
+        if n.is_error and n.child_count == 0 and n.end_byte > n.start_byte:
+            return prefix + n.sexp()
+        if n.is_missing:
+            return prefix + (f"(MISSING {n.type}" if n.is_named else f'(MISSING "{n.type}"')
+        return f"{prefix}({n.type}"
+
+    def fits(piece: str, extra_parens: int) -> bool:
+        # 预留截断标记与全部右括号的位置，保证截断后的结果不超过上限
+        return limit is None or \
+            written + len(piece) + len(SEXP_TRUNCATION_MARKER) + open_parens + extra_parens <= limit
+
+    def truncate() -> bool:
+        out.write(SEXP_TRUNCATION_MARKER + ")" * open_parens)
+        return True
+
+    cursor = node.walk()
+    root_head = node_head(node, None)[1:]
+    if not fits(root_head, 1):
+        return truncate()
+    out.write(root_head)
+    written += len(root_head)
+    open_parens += 1
+    # 每层记录该层节点是否输出了左括号
+    visible_stack = [True]
+    cursor.goto_first_child()
+
+    while True:
+        n = cursor.node
+        visible = n.is_named or n.is_missing
+        descend = n.child_count > 0
+        if visible:
+            head = node_head(n, cursor.field_name)
+            if not fits(head, 1):
+                return truncate()
+            out.write(head)
+            written += len(head)
+            if head.endswith(")"):
+                # UNEXPECTED 叶子已经是完整的 sexp
+                visible = descend = False
+            else:
+                open_parens += 1
+
+        if descend and cursor.goto_first_child():
+            visible_stack.append(visible)
+            continue
+        if visible:
+            out.write(")")
+            written += 1
+            open_parens -= 1
+
+        while not cursor.goto_next_sibling():
+            cursor.goto_parent()
+            if visible_stack.pop():
+                out.write(")")
+                written += 1
+                open_parens -= 1
+            if not visible_stack:
+                return False
+
+
+def serialize_sexp(node, max_chars: Optional[int] = None, max_tokens: Optional[int] = None) -> str:
+    """write_sexp 写入内存缓冲区后返回字符串；不设上限时等价于 node.sexp()"""
+    buffer = io.StringIO()
+    write_sexp(node, buffer, max_chars=max_chars, max_tokens=max_tokens)
+    return buffer.getvalue()
+
+
+def serialize_ast(node, mode: Optional[str] = None) -> str:
+    """
+    按 AST_SERIALIZATION 选择 ast_subtree 的序列化方式：
+    - sexp: tree-sitter 原生 S-expression（默认），可由 AST_SEXP_MAX_CHARS / AST_SEXP_MAX_TOKENS 限制长度
+    - compact: serialize_compact，剪枝参数由 AST_MAX_DEPTH / AST_FOLD_METHOD_BODIES / AST_ABBREVIATE_TYPES 控制
+    corpus 与 query 必须使用同一种方式，切换后需要重新构建 chunk 和向量库。
+    """
+    mode = mode or AST_SERIALIZATION
+    if mode == "sexp":
+        # 不限制长度时 C 实现的 sexp() 更快；设置了上限或 tree-sitter 版本不再提供 sexp() 时流式序列化
+        if AST_SEXP_MAX_CHARS or AST_SEXP_MAX_TOKENS or not hasattr(node, "sexp"):
+            return serialize_sexp(node, max_chars=AST_SEXP_MAX_CHARS, max_tokens=AST_SEXP_MAX_TOKENS)
+        return node.sexp()
+    if mode == "compact":
+        return serialize_compact(node, max_depth=AST_MAX_DEPTH, abbreviate=AST_ABBREVIATE_TYPES,
+                                 fold_method_bodies=AST_FOLD_METHOD_BODIES)
+    raise ValueError(f"Unsupported AST serialization: {mode}")
+
+
+def _iter_java_files(data_dir: Union[str, Path], limit: Optional[int] = None):
+    files = sorted(Path(data_dir).rglob("*.java"))
+    return files[:limit] if limit else files
+
+
+def _percentile(values, q):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def compare_serialization_token_counts(data_dir: Union[str, Path] = "data", tokenizer_name: Optional[str] = None,
+                                       variants: Optional[dict] = None, limit: Optional[int] = None,
+                                       output_path: Optional[Union[str, Path]] = None) -> dict:
+    """
+    统计 data/ 下全部 Java 文件在不同序列化方式下整文件 AST 的 token 数，
+    以及超过 embedding 模型最大长度（需要 split_ast_documents 拆分）的比例。
+
+    :param variants: {名称: serialize_compact 参数}，为空时使用默认几组剪枝配置
+    """
+    from transformers import AutoTokenizer
+    from config.settings import CODE_EMBEDDING_MODEL
+    from embeddings.embedding_utils import get_max_token_length
+    from splitter.ch_ast_splitter.ast_extractor import get_java_parser, read_source_file
+
+    parser = get_java_parser()
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name or CODE_EMBEDDING_MODEL, trust_remote_code=True)
+    max_len = get_max_token_length(tokenizer)
+    variants = variants or DEFAULT_VARIANTS
+
+    counts = {"source": [], "sexp": []}
+    counts.update({name: [] for name in variants})
+    files = _iter_java_files(data_dir, limit)
+    for path in files:
+        code = read_source_file(str(path))
+        root = parser.parse(bytes(code, "utf8")).root_node
+        counts["source"].append(len(tokenizer.encode(code)))
+        counts["sexp"].append(len(tokenizer.encode(root.sexp())))
+        for name, kwargs in variants.items():
+            counts[name].append(len(tokenizer.encode(serialize_compact(root, **kwargs))))
+
+    report = {"num_files": len(files), "max_token_length": max_len, "variants": {}}
+    for name, values in counts.items():
+        total = sum(values)
+        report["variants"][name] = {
+            "total_tokens": total,
+            "mean_tokens": total / len(values) if values else 0,
+            "p50_tokens": _percentile(values, 0.5),
+            "p95_tokens": _percentile(values, 0.95),
+            "max_tokens": max(values) if values else 0,
+            "exceed_ratio": sum(v > max_len for v in values) / len(values) if values else 0,
+            "vs_sexp": total / sum(counts["sexp"]) if sum(counts["sexp"]) else None,
+        }
+        print(f"[i] {name}: {report['variants'][name]}")
+
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"[✓] Serialization token report saved to {output_path}")
+    return report
+
+
+def compare_serialization_retrieval(data_dir: Union[str, Path] = "data", variants: Optional[dict] = None,
+                                    top_k: int = 5, limit: Optional[int] = None,
+                                    output_path: Optional[Union[str, Path]] = None) -> dict:
+    """
+    检索质量对比：对每个 Java 文件的整文件 AST 用 code embedding 模型编码，按 L2 取 top_k 近邻，
+    统计近邻与自身属于同一反模式类型（data/{type}/...）的比例（precision@k），
+    以及与 sexp 结果的近邻重合率（overlap@k）。
+    """
+    import faiss
+    import numpy as np
+    from embeddings.embedding_utils import init_code_embedding_wrapper
+    from splitter.ch_ast_splitter.ast_extractor import get_java_parser, read_source_file
+
+    variants = variants or DEFAULT_VARIANTS
+    files = _iter_java_files(data_dir, limit)
+    labels = [path.relative_to(data_dir).parts[0] for path in files]
+    parser = get_java_parser()
+    roots = [parser.parse(bytes(read_source_file(str(path)), "utf8")).root_node for path in files]
+    model = init_code_embedding_wrapper()
+
+    def neighbors_of(texts):
+        emb = np.array(model.embed_documents(texts), dtype=np.float32)
+        index = faiss.IndexFlatL2(emb.shape[1])
+        index.add(emb)
+        _, nb = index.search(emb, top_k + 1)
+        return nb[:, 1:]
+
+    def precision(nb):
+        hits = sum(labels[j] == labels[i] for i, row in enumerate(nb) for j in row if j >= 0)
+        return hits / (len(nb) * top_k) if len(nb) else None
+
+    sexp_nb = neighbors_of([root.sexp() for root in roots])
+    report = {"num_files": len(files), "top_k": top_k,
+              "variants": {"sexp": {"precision_at_k": precision(sexp_nb), "overlap_with_sexp": 1.0}}}
+    for name, kwargs in variants.items():
+        nb = neighbors_of([serialize_compact(root, **kwargs) for root in roots])
+        overlap = sum(len(set(a.tolist()) & set(b.tolist())) for a, b in zip(nb, sexp_nb)) / (len(nb) * top_k)
+        report["variants"][name] = {"precision_at_k": precision(nb), "overlap_with_sexp": overlap}
+        print(f"[i] {name}: {report['variants'][name]}")
+
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"[✓] Serialization retrieval report saved to {output_path}")
+    return report
+
+
+if __name__ == "__main__":
+    compare_serialization_token_counts("data", output_path="tmp/ast_serialization_tokens.json")
+    compare_serialization_retrieval("data", output_path="tmp/ast_serialization_retrieval.json")
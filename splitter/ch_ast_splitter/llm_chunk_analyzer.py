@@ -1,21 +1,20 @@
+import asyncio
+import json
 from pathlib import Path
 
 from utils.utils import read_code_from_file
 from .base_chunk_schema import ChunkType, AWDChunkType
 from .llm_chunk_schema import LLMChunk
-from llm.llm_client import run_llm
-from prompts.prompt_loader import load_prompt, split_prompt
+from llm.llm_client import run_llm, arun_llm
+from prompts.prompt_loader import load_split_prompt
 
 
 def llm_analyze_superclass(file_path: str, method_code: str, invocation_code: str) -> list[LLMChunk]:
     full_code = read_code_from_file(file_path)
 
-    parent_file_prompt = load_prompt("chunk_prompts/parent_file_prompt")
-    parent_file_system_prompt, parent_file_user_prompt = split_prompt(parent_file_prompt)
-    parent_method_prompt = load_prompt("chunk_prompts/parent_method_prompt")
-    parent_method_system_prompt, parent_method_user_prompt = split_prompt(parent_method_prompt)
-    invocation_prompt = load_prompt("chunk_prompts/invocation_prompt")
-    invocation_system_prompt, invocation_user_prompt = split_prompt(invocation_prompt)
+    parent_file_system_prompt, parent_file_user_prompt = load_split_prompt("chunk_prompts/parent_file_prompt")
+    parent_method_system_prompt, parent_method_user_prompt = load_split_prompt("chunk_prompts/parent_method_prompt")
+    invocation_system_prompt, invocation_user_prompt = load_split_prompt("chunk_prompts/invocation_prompt")
 
     return [
         LLMChunk(file_path=file_path,
@@ -42,10 +41,8 @@ def llm_analyze_superclass(file_path: str, method_code: str, invocation_code: st
 def llm_analyze_subclass(file_path: str, method_code: str) -> list[LLMChunk]:
     full_code = read_code_from_file(file_path)
 
-    child_file_prompt = load_prompt("chunk_prompts/child_file_prompt")
-    child_file_system_prompt, child_file_user_prompt = split_prompt(child_file_prompt)
-    child_method_prompt = load_prompt("chunk_prompts/child_method_prompt")
-    child_method_system_prompt, child_method_user_prompt = split_prompt(child_method_prompt)
+    child_file_system_prompt, child_file_user_prompt = load_split_prompt("chunk_prompts/child_file_prompt")
+    child_method_system_prompt, child_method_user_prompt = load_split_prompt("chunk_prompts/child_method_prompt")
 
     return [
         LLMChunk(file_path=file_path,
@@ -63,6 +60,152 @@ def llm_analyze_subclass(file_path: str, method_code: str) -> list[LLMChunk]:
     ]
 
 
+def _build_llm_chunk(file_path: str, chunk_type, llm_description: str) -> LLMChunk:
+    return LLMChunk(file_path=file_path,
+                    chunk_type=chunk_type,
+                    level=3,
+                    chunk_id=chunk_type.value,
+                    llm_description=llm_description
+                    )
+
+
+async def _arun_prompt(prompt_name: str, code: str) -> str:
+    system_prompt, user_prompt = load_split_prompt(prompt_name)
+    return await arun_llm(system_prompt, user_prompt, {"code": code})
+
+
+async def allm_analyze_superclass(file_path: str, method_code: str, invocation_code: str) -> list[LLMChunk]:
+    """llm_analyze_superclass 的异步版本，3 个 LLM 调用并发执行，返回顺序与同步版本一致"""
+    full_code = await asyncio.to_thread(read_code_from_file, file_path)
+    file_desc, method_desc, invocation_desc = await asyncio.gather(
+        _arun_prompt("chunk_prompts/parent_file_prompt", full_code),
+        _arun_prompt("chunk_prompts/parent_method_prompt", method_code),
+        _arun_prompt("chunk_prompts/invocation_prompt", invocation_code),
+    )
+    return [
+        _build_llm_chunk(file_path, ChunkType.PARENT_FILE_SUMMARY, file_desc),
+        _build_llm_chunk(file_path, ChunkType.PARENT_METHOD_SUMMARY, method_desc),
+        _build_llm_chunk(file_path, ChunkType.INVOCATION_SUMMARY, invocation_desc),
+    ]
+
+
+async def allm_analyze_subclass(file_path: str, method_code: str) -> list[LLMChunk]:
+    """llm_analyze_subclass 的异步版本，2 个 LLM 调用并发执行，返回顺序与同步版本一致"""
+    full_code = await asyncio.to_thread(read_code_from_file, file_path)
+    file_desc, method_desc = await asyncio.gather(
+        _arun_prompt("chunk_prompts/child_file_prompt", full_code),
+        _arun_prompt("chunk_prompts/child_method_prompt", method_code),
+    )
+    return [
+        _build_llm_chunk(file_path, ChunkType.CHILD_FILE_SUMMARY, file_desc),
+        _build_llm_chunk(file_path, ChunkType.CHILD_METHOD_SUMMARY, method_desc),
+    ]
+
+
+# 批量模式下 JSON 响应的顶层字段 -> (chunk 类型, 单独请求时使用的 prompt, 对应的代码变量)
+CH_BATCH_FIELDS = [
+    ("parent_file_summary", ChunkType.PARENT_FILE_SUMMARY, "chunk_prompts/parent_file_prompt", "parent_code"),
+    ("parent_method_summary", ChunkType.PARENT_METHOD_SUMMARY, "chunk_prompts/parent_method_prompt",
+     "parent_method_code"),
+    ("invocation_summary", ChunkType.INVOCATION_SUMMARY, "chunk_prompts/invocation_prompt", "invocation_code"),
+    ("child_file_summary", ChunkType.CHILD_FILE_SUMMARY, "chunk_prompts/child_file_prompt", "child_code"),
+    ("child_method_summary", ChunkType.CHILD_METHOD_SUMMARY, "chunk_prompts/child_method_prompt",
+     "child_method_code"),
+]
+CH_BATCH_PROMPT = "chunk_prompts/ch_case_batch_prompt"
+
+
+def parse_json_response(text: str):
+    """从 LLM 输出中取出 JSON 对象（兼容 ```json 代码块及前后多余文字），失败返回 None"""
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end <= start:
+        return None
+    try:
+        data = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _split_batch_response(response: str) -> tuple[dict, list]:
+    """返回 ({字段: 描述}, 需要单独补请求的字段)"""
+    data = parse_json_response(response)
+    if data is None:
+        print("[WARN] Batched summary response is not valid JSON, fall back to per-field requests")
+        data = {}
+
+    descriptions, missing = {}, []
+    for field, _, _, _ in CH_BATCH_FIELDS:
+        value = data.get(field)
+        if isinstance(value, (dict, list)) and value:
+            descriptions[field] = json.dumps(value, ensure_ascii=False, indent=2)
+        elif isinstance(value, str) and value.strip():
+            descriptions[field] = value
+        else:
+            missing.append(field)
+    if missing and data:
+        print(f"[WARN] Batched summary response missing {missing}, fall back to per-field requests")
+    return descriptions, missing
+
+
+def _build_ch_case_chunks(super_path: str, sub_path: str, descriptions: dict) -> tuple[list, list]:
+    chunks = {
+        field: _build_llm_chunk(super_path if field.startswith(("parent", "invocation")) else sub_path,
+                                chunk_type, descriptions[field])
+        for field, chunk_type, _, _ in CH_BATCH_FIELDS
+    }
+    super_chunks = [chunks["parent_file_summary"], chunks["parent_method_summary"], chunks["invocation_summary"]]
+    sub_chunks = [chunks["child_file_summary"], chunks["child_method_summary"]]
+    return super_chunks, sub_chunks
+
+
+def _ch_case_variables(super_path: str, sub_path: str, parent_method_code: str, invocation_code: str,
+                       child_method_code: str) -> dict:
+    return {
+        "parent_code": read_code_from_file(super_path),
+        "parent_method_code": parent_method_code,
+        "invocation_code": invocation_code,
+        "child_code": read_code_from_file(sub_path),
+        "child_method_code": child_method_code,
+    }
+
+
+def llm_analyze_ch_case(super_path: str, sub_path: str, parent_method_code: str, invocation_code: str,
+                        child_method_code: str) -> tuple[list[LLMChunk], list[LLMChunk]]:
+    """
+    一次请求得到一个 CH case 的 5 个摘要（JSON 结构化输出），解析失败的字段单独用原 prompt 补请求。
+    返回 (父类摘要块, 子类摘要块)，与 llm_analyze_superclass / llm_analyze_subclass 的结果一一对应。
+    """
+    variables = _ch_case_variables(super_path, sub_path, parent_method_code, invocation_code, child_method_code)
+    system_prompt, user_prompt = load_split_prompt(CH_BATCH_PROMPT)
+    descriptions, missing = _split_batch_response(run_llm(system_prompt, user_prompt, variables))
+
+    for field, _, prompt_name, code_key in CH_BATCH_FIELDS:
+        if field in missing:
+            field_system_prompt, field_user_prompt = load_split_prompt(prompt_name)
+            descriptions[field] = run_llm(field_system_prompt, field_user_prompt, {"code": variables[code_key]})
+
+    return _build_ch_case_chunks(super_path, sub_path, descriptions)
+
+
+async def allm_analyze_ch_case(super_path: str, sub_path: str, parent_method_code: str, invocation_code: str,
+                               child_method_code: str) -> tuple[list[LLMChunk], list[LLMChunk]]:
+    """llm_analyze_ch_case 的异步版本，补请求的字段并发执行"""
+    variables = await asyncio.to_thread(_ch_case_variables, super_path, sub_path, parent_method_code,
+                                        invocation_code, child_method_code)
+    system_prompt, user_prompt = load_split_prompt(CH_BATCH_PROMPT)
+    descriptions, missing = _split_batch_response(await arun_llm(system_prompt, user_prompt, variables))
+
+    fallback_fields = [(field, prompt_name, code_key) for field, _, prompt_name, code_key in CH_BATCH_FIELDS
+                       if field in missing]
+    fallback_descs = await asyncio.gather(*(_arun_prompt(prompt_name, variables[code_key])
+                                            for _, prompt_name, code_key in fallback_fields))
+    for (field, _, _), desc in zip(fallback_fields, fallback_descs):
+        descriptions[field] = desc
+
+    return _build_ch_case_chunks(super_path, sub_path, descriptions)
+
+
 def awd_llm_analyze_subclass(client_path, super_path, sub_path, llm_before_content):
     client_desc, super_desc, sub_desc = get_llm_descriptions_by_suffix_path(client_path, super_path, sub_path, llm_before_content)
 
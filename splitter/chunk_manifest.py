@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+from config.settings import LLM_MODEL, LLM_BATCH_SUMMARIES, AST_SERIALIZATION, AST_MAX_DEPTH, \
+    AST_FOLD_METHOD_BODIES, AST_ABBREVIATE_TYPES, AST_SEXP_MAX_CHARS, AST_SEXP_MAX_TOKENS
+from utils.chunk_store import chunk_output_exists, remove_chunk_output
+from utils.utils import write_json_atomic
+
+# 分块输出格式变化（chunk 字段、顺序等）且上面的配置无法体现时手动加 1，使所有 case 重建
+CHUNK_SPLITTER_VERSION = 1
+
+CHUNK_MANIFEST_DIR = Path("tmp/manifests")
+CHUNK_PROMPT_DIR = Path("prompts/chunk_prompts")
+
+
+def _sha1_file(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def iter_case_input_files(case_path) -> list:
+    """
+    一个 case 中参与分块的输入文件（相对 case 目录的 posix 路径）：
+    case 目录下的 *antipattern.json、before/ 下的全部文件（Java、YAML 等）、llm_function_description/before.json
+    """
+    case_path = str(case_path)
+    files = [name for name in os.listdir(case_path)
+             if name.endswith("antipattern.json") and os.path.isfile(os.path.join(case_path, name))]
+
+    before_dir = os.path.join(case_path, "before")
+    for root, _, names in os.walk(before_dir):
+        for name in names:
+            files.append(Path(os.path.relpath(os.path.join(root, name), case_path)).as_posix())
+
+    if os.path.isfile(os.path.join(case_path, "llm_function_description", "before.json")):
+        files.append("llm_function_description/before.json")
+    return sorted(files)
+
+
+def get_splitter_config(mode: str, antipattern_type: str) -> dict:
+    """影响分块结果的配置：splitter 模式、prompt 版本以及 AST 序列化 / LLM 相关设置"""
+    config = {"version": CHUNK_SPLITTER_VERSION, "mode": mode, "antipattern_type": antipattern_type}
+    if mode == "ast":
+        config["ast"] = [AST_SERIALIZATION, AST_MAX_DEPTH, AST_FOLD_METHOD_BODIES, AST_ABBREVIATE_TYPES]
+        if AST_SEXP_MAX_CHARS or AST_SEXP_MAX_TOKENS:
+            # 只在设置了上限时记录，未设置时已有 manifest 的指纹保持不变
+            config["sexp_limit"] = [AST_SEXP_MAX_CHARS, AST_SEXP_MAX_TOKENS]
+        if antipattern_type == "CH":
+            # 只有 CH 会调用 LLM 生成摘要
+            config["llm"] = [LLM_MODEL, LLM_BATCH_SUMMARIES]
+            config["prompts"] = {prompt_path.name: _sha1_file(str(prompt_path))
+                                 for prompt_path in sorted(CHUNK_PROMPT_DIR.glob("*.txt"))}
+    return config
+
+
+class ChunkManifest:
+    """
+    记录每个 case 上一次分块时的输入指纹与输出路径，保存在 tmp/manifests/{type}_{mode}_chunk_manifest.json：
+    {"config": ..., "cases": {case_key: {"fingerprint", "group_id", "output", "files": {rel: [size, mtime_ns, sha1]}}}}
+    文件的 size / mtime 未变化时复用上次的 sha1，不重新读取内容。
+    """
+
+    def __init__(self, antipattern_type: str, mode: str):
+        self.path = CHUNK_MANIFEST_DIR / f"{antipattern_type}_{mode}_chunk_manifest.json"
+        self.config = get_splitter_config(mode, antipattern_type)
+        self.config_hash = hashlib.sha1(json.dumps(self.config, sort_keys=True).encode("utf-8")).hexdigest()
+        self.cases = {}
+        if self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.cases = json.load(f).get("cases", {})
+
+    def compute_fingerprint(self, case_key: str, case_path, catalog_files: Optional[dict] = None) -> tuple[str, dict]:
+        """
+        :param catalog_files: case catalog 中登记的输入文件 {相对路径: [size, mtime_ns]}，传入时使用其文件列表，不再逐级列目录；
+                              仍对每个文件重新 stat，原地修改的文件（目录 mtime 不变）也能被发现
+        """
+        previous_files = self.cases.get(case_key, {}).get("files", {})
+        rel_paths = sorted(catalog_files) if catalog_files is not None else iter_case_input_files(case_path)
+
+        files = {}
+        for rel_path in rel_paths:
+            full_path = os.path.join(case_path, rel_path)
+            stat = os.stat(full_path)
+            previous = previous_files.get(rel_path)
+            if previous and previous[0] == stat.st_size and previous[1] == stat.st_mtime_ns:
+                digest = previous[2]
+            else:
+                digest = _sha1_file(full_path)
+            files[rel_path] = [stat.st_size, stat.st_mtime_ns, digest]
+
+        h = hashlib.sha1(self.config_hash.encode("utf-8"))
+        for rel_path, (_, _, digest) in files.items():
+            h.update(f"{rel_path}\0{digest}\n".encode("utf-8"))
+        return h.hexdigest(), files
+
+    def is_up_to_date(self, case_key: str, fingerprint: str, group_id: int) -> bool:
+        entry = self.cases.get(case_key)
+        return bool(entry) and entry["fingerprint"] == fingerprint and entry["group_id"] == group_id \
+            and chunk_output_exists(entry.get("output"))
+
+    def invalidate(self, case_key: str) -> Optional[str]:
+        """删除 case 的旧输出（之后由 splitter 重建），返回被删除的路径或 store 引用"""
+        entry = self.cases.get(case_key)
+        output = entry.get("output") if entry else None
+        if remove_chunk_output(output):
+            return output
+        return None
+
+    def update(self, case_key: str, fingerprint: str, files: dict, group_id: int, output: Optional[str]):
+        self.cases[case_key] = {"fingerprint": fingerprint, "group_id": group_id, "output": output, "files": files}
+
+    def remove_missing(self, case_keys: set) -> list:
+        """数据目录中已不存在的 case：删除其输出并移出 manifest"""
+        removed = []
+        for case_key in [k for k in self.cases if k not in case_keys]:
+            self.invalidate(case_key)
+            del self.cases[case_key]
+            removed.append(case_key)
+        return removed
+
+    def save(self):
+        write_json_atomic({"config": self.config, "cases": self.cases}, self.path)
@@ -4,6 +4,7 @@ from pathlib import Path
 from typing import Union
 
 from config.settings import MAX_CHUNK_CHARS, ANTIPATTERN_TYPE
+from utils.chunk_store import write_chunk_result
 
 max_chunk_chars = MAX_CHUNK_CHARS
 
@@ -92,11 +93,7 @@ def build_ch_chunks(base_dir: Union[str, Path], antipattern_type, group_id):
         # 构造输出路径：和 JSON 文件在同一目录，命名为 `{project}_{case_id}_{antipattern}_chunk.json`
         chunk_filename = f"{project_name}_{commit_number}_{case_id}_{antipattern_type}_chunk.json"
         output_dir = Path(f"tmp_ablation/chunks/{antipattern_type}")
-    output_dir.mkdir(parents=True, exist_ok=True)  # 自动创建目录
-    output_path = output_dir / chunk_filename
-
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(result, f, ensure_ascii=False, indent=2)
+    output_path = write_chunk_result(result, output_dir / chunk_filename)
 
     print(f"分块结果已保存至: {output_path}")
     return result, output_path
@@ -170,11 +167,7 @@ def build_mh_chunks(base_dir: Union[str, Path], antipattern_type, group_id):
         # 构造输出路径：和 JSON 文件在同一目录，命名为 `{project}_{case_id}_{antipattern}_chunk.json`
         chunk_filename = f"{project_name}_{commit_number}_{case_id}_{antipattern_type}_chunk.json"
         output_dir = Path(f"tmp_ablation/chunks/{antipattern_type}")
-    output_dir.mkdir(parents=True, exist_ok=True)  # 自动创建目录
-    output_path = output_dir / chunk_filename
-
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(result, f, ensure_ascii=False, indent=2)
+    output_path = write_chunk_result(result, output_dir / chunk_filename)
 
     print(f"分块结果已保存至: {output_path}")
     return result, output_path
@@ -253,11 +246,7 @@ def build_awd_chunks(base_dir: Union[str, Path], antipattern_type, group_id):
         # 构造输出路径：和 JSON 文件在同一目录，命名为 `{project}_{case_id}_{antipattern}_chunk.json`
         chunk_filename = f"{project_name}_{commit_number}_{case_id}_{antipattern_type}_chunk.json"
         output_dir = Path(f"tmp_ablation/chunks/{antipattern_type}")
-    output_dir.mkdir(parents=True, exist_ok=True)  # 自动创建目录
-    output_path = output_dir / chunk_filename
-
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(result, f, ensure_ascii=False, indent=2)
+    output_path = write_chunk_result(result, output_dir / chunk_filename)
 
     print(f"分块结果已保存至: {output_path}")
     return result, output_path
\ No newline at end of file
@@ -1,14 +1,305 @@
+import asyncio
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from config.settings import CHUNK_WORKERS, CHUNK_GROUP_ID_MODE, CHUNK_ASYNC_LLM, CHUNK_ASYNC_CASES, \
+    CHUNK_INCREMENTAL, CASE_CATALOG_ENABLED
+from llm.llm_cache import get_llm_cache
+from splitter.chunk_manifest import ChunkManifest
 from splitter.strategy_registry import load_splitter_by_mode
-from utils.utils import iter_case_paths
+from utils.case_catalog import get_case_catalog, list_case_paths
+from utils.chunk_store import get_chunk_store, get_chunk_store_root, is_store_ref, split_store_ref, \
+    find_chunk_output, remove_chunk_output, load_chunk_result
+from utils.utils import write_json_atomic
+
+# case manifest 放在 chunk 目录之外（embedding 阶段会遍历 tmp/chunks 下的全部 *.json）
+CASE_MANIFEST_DIR = Path("tmp/manifests")
+# 各 splitter 的分块结果目录（ast 写入 tmp/chunks，java 等消融模式写入 tmp_ablation/chunks），按优先级排列
+CHUNK_OUTPUT_BASE_DIRS = (Path("tmp/chunks"), Path("tmp_ablation/chunks"))
+
+
+def get_case_key(case_path, base_dir, antipattern_type) -> str:
+    """case 相对 data/{antipattern_type} 的 posix 路径，如 apache/kafka/commit_1000/158，与机器无关"""
+    return Path(os.path.relpath(case_path, os.path.join(base_dir, antipattern_type))).as_posix()
+
+
+def get_case_manifest_path(antipattern_type) -> Path:
+    return CASE_MANIFEST_DIR / f"{antipattern_type}_case_manifest.json"
+
+
+def load_case_manifest(antipattern_type) -> dict:
+    manifest_path = get_case_manifest_path(antipattern_type)
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_existing_group_ids(antipattern_type) -> dict:
+    """
+    已有分块结果中的 group_id：{(project_name, commit_number, case_id): group_id}。
+    读取各分块目录下的 chunk store 与 chunk JSON（store 优先，先出现的目录优先）。
+    """
+    group_ids = {}
+
+    def add(result: dict):
+        group_id = result.get("group_id")
+        if group_id is not None and group_id >= 0:
+            key = (str(result.get("project_name")), str(result.get("commit_number")), str(result.get("id")))
+            group_ids.setdefault(key, group_id)
+
+    for base_dir in CHUNK_OUTPUT_BASE_DIRS:
+        chunk_dir = base_dir / antipattern_type
+        if not chunk_dir.is_dir():
+            continue
+        for _, result in get_chunk_store(get_chunk_store_root(chunk_dir)).iter_records():
+            add(result)
+        for json_path in sorted(chunk_dir.glob("*.json")):
+            try:
+                with open(json_path, "r", encoding="utf-8") as f:
+                    add(json.load(f))
+            except Exception as e:
+                print(f"[WARN] Failed to read {json_path}: {e}")
+    return group_ids
+
+
+def seed_case_manifest(keyed: list, antipattern_type) -> dict:
+    """
+    首次使用 manifest 模式时（还没有 case manifest），沿用已有分块结果中的 group_id（如 counter 模式下的编号），
+    已有的向量库与得分文件无需重建；没有分块结果或编号冲突的 case 之后在末尾追加编号。
+    """
+    existing = load_existing_group_ids(antipattern_type)
+    manifest, used = {}, set()
+    for case_key, _ in keyed:
+        group_id = existing.get(tuple(case_key.split("/")[-3:]))
+        if group_id is not None and group_id not in used:
+            manifest[case_key] = group_id
+            used.add(group_id)
+    if manifest:
+        print(f"[i] Case manifest seeded with {len(manifest)} group_ids from existing chunk outputs")
+    return manifest
+
+
+def hash_group_id(case_key: str) -> int:
+    # 取 sha1 前 12 位十六进制（48 bit），保证为非负整数（query 使用 group_id < 0）
+    return int(hashlib.sha1(case_key.encode("utf-8")).hexdigest()[:12], 16)
+
+
+def assign_group_ids(base_dir, antipattern_type, group_id_mode: str = CHUNK_GROUP_ID_MODE) -> list:
+    """
+    为 base_dir/{antipattern_type} 下的全部 case 分配 group_id，返回 [(case_path, group_id)]：
+    - counter: 按目录遍历顺序递增（旧行为，依赖 os.listdir 顺序，跨机器不稳定）
+    - manifest（默认）: 按 case 相对路径排序编号，并保存到 tmp/manifests/{type}_case_manifest.json；
+                已有 case 保持原 group_id，新增 case 在末尾追加编号。
+                第一次运行时先沿用已有分块结果中的 group_id（见 seed_case_manifest），从 counter 切换过来无需重建
+    - hash: case 相对路径的哈希，不依赖任何状态
+    """
+    case_paths = list_case_paths(base_dir, antipattern_type)
+
+    if group_id_mode == "counter":
+        return [(case_path, group_id) for group_id, case_path in enumerate(case_paths)]
+
+    keyed = sorted((get_case_key(case_path, base_dir, antipattern_type), case_path) for case_path in case_paths)
+
+    if group_id_mode == "hash":
+        assigned = [(case_path, hash_group_id(case_key)) for case_key, case_path in keyed]
+        if len({group_id for _, group_id in assigned}) != len(assigned):
+            raise ValueError("group_id hash collision, use group_id_mode='manifest'")
+        return assigned
+
+    if group_id_mode == "manifest":
+        if get_case_manifest_path(antipattern_type).exists():
+            manifest = load_case_manifest(antipattern_type)
+        else:
+            manifest = seed_case_manifest(keyed, antipattern_type)
+        next_id = max(manifest.values(), default=-1) + 1
+        for case_key, _ in keyed:
+            if case_key not in manifest:
+                manifest[case_key] = next_id
+                next_id += 1
+        write_json_atomic(manifest, get_case_manifest_path(antipattern_type))
+        return [(case_path, manifest[case_key]) for case_key, case_path in keyed]
+
+    raise ValueError(f"Unsupported group_id_mode: {group_id_mode}")
+
+
+def check_group_id_mode(group_id_mode: str, workers: int):
+    if group_id_mode == "counter" and workers > 1:
+        raise ValueError("group_id_mode='counter' depends on os.listdir order and is not stable across runs and "
+                         "machines; use 'manifest' or 'hash' when workers > 1")
 
 
-def chunk_all_cases(base_dir, antipattern_type, mode="ast") -> list:
-    group_id = 0
+def build_case(mode, case_path, antipattern_type, group_id):
+    # 在子进程中执行：tree-sitter 解析、LLM 分析及 chunk JSON 写入；同时返回本 case 的 LLM 缓存命中统计
+    cache = get_llm_cache()
+    cache.reset_stats()
     build_chunks = load_splitter_by_mode(mode)
+    _, path = build_chunks(case_path, antipattern_type, group_id)
+    return str(path) if path else None, dict(cache.stats)
 
-    for case_path in iter_case_paths(base_dir, antipattern_type):
-        print(f"start {case_path}")
-        chunk, path = build_chunks(case_path, antipattern_type, group_id)
-        group_id += 1
-    print("chunks over")
 
+async def _achunk_cases(assigned: list, antipattern_type, max_concurrent_cases: int) -> list:
+    from splitter.ch_ast_splitter.ast_case_splitter import abuild_chunks
+
+    case_semaphore = asyncio.Semaphore(max_concurrent_cases)
+
+    async def run_case(case_path, group_id):
+        async with case_semaphore:
+            _, path = await abuild_chunks(case_path, antipattern_type, group_id)
+            print(f"[✓] {case_path} (group_id={group_id})")
+            return case_path, group_id, str(path) if path else None
+
+    return await asyncio.gather(*(run_case(case_path, group_id) for case_path, group_id in assigned),
+                                return_exceptions=True)
+
+
+def find_existing_chunk_output(mode, case_path, antipattern_type, group_id):
+    """
+    case 在默认输出位置上已有的分块结果（路径或 store 引用），没有时返回 None。
+    只有 ast splitter 在输出已存在时跳过构建，其他 splitter 总是覆盖输出，无需处理。
+    """
+    if mode != "ast":
+        return None
+    from splitter.ch_ast_splitter.ast_case_splitter import get_case_metadata, get_chunk_output_path
+
+    project_name, commit_number, case_id = get_case_metadata(Path(case_path), group_id)
+    existing_output = find_chunk_output(
+        get_chunk_output_path(antipattern_type, project_name, commit_number, case_id, group_id))
+    return str(existing_output) if existing_output is not None else None
+
+
+def adopt_existing_chunk_output(existing_output, group_id) -> bool:
+    """
+    manifest 中没有记录的 case（如升级后首次增量运行）：已有输出的 group_id 与本次分配的一致时直接沿用，
+    视为与当前输入一致，避免全部重建（CH 会重新调用 LLM）。需要强制重建时删除该输出，或修改 CHUNK_SPLITTER_VERSION。
+    """
+    try:
+        return load_chunk_result(existing_output).get("group_id") == group_id
+    except Exception as e:
+        print(f"[WARN] Failed to read {existing_output}: {e}")
+        return False
+
+
+def select_cases_to_build(manifest: ChunkManifest, assigned: list, base_dir, antipattern_type) -> tuple:
+    """
+    按输入指纹筛选需要重建的 case：指纹、group_id 未变且输出仍存在的 case 直接复用；
+    manifest 中没有记录、但默认输出位置上已有 group_id 一致的结果的 case 沿用该结果并登记到 manifest（见 adopt_existing_chunk_output）；
+    其余 case 的旧输出（manifest 记录的输出以及默认输出位置上已有的结果）被删除后重建；数据目录中已删除的 case 的输出同时清理。
+
+    :return: (待构建 [(case_path, group_id)], 可复用结果 [(case_path, group_id, chunk_path)], {case_path: (case_key, 指纹, 文件信息)})
+    """
+    todo, reused, fingerprints = [], [], {}
+    adopted = 0
+    catalog = get_case_catalog() if CASE_CATALOG_ENABLED else None
+    for case_path, group_id in assigned:
+        case_key = get_case_key(case_path, base_dir, antipattern_type)
+        catalog_files = catalog.get_required_files(case_path) if catalog else None
+        fingerprint, files = manifest.compute_fingerprint(case_key, case_path, catalog_files)
+        fingerprints[case_path] = (case_key, fingerprint, files)
+        if manifest.is_up_to_date(case_key, fingerprint, group_id):
+            reused.append((case_path, group_id, manifest.cases[case_key]["output"]))
+            continue
+
+        existing_output = find_existing_chunk_output(manifest.config["mode"], case_path, antipattern_type, group_id)
+        if case_key not in manifest.cases and existing_output and \
+                adopt_existing_chunk_output(existing_output, group_id):
+            manifest.update(case_key, fingerprint, files, group_id, existing_output)
+            reused.append((case_path, group_id, existing_output))
+            adopted += 1
+            continue
+
+        manifest.invalidate(case_key)
+        if existing_output:
+            remove_chunk_output(existing_output)
+        todo.append((case_path, group_id))
+
+    removed = manifest.remove_missing({case_key for case_key, _, _ in fingerprints.values()})
+    print(f"[i] {len(reused)} cases up to date ({adopted} adopted from existing outputs), {len(todo)} to build, "
+          f"{len(removed)} removed")
+    return todo, reused, fingerprints
+
+
+def compact_chunk_stores(results: list):
+    """重建过的 case 会在 chunk store 中留下旧记录，垃圾比例过高时压缩（此时已没有写入进程）"""
+    store_roots = {split_store_ref(path)[0] for _, _, path in results if is_store_ref(path)}
+    for store_root in sorted(store_roots):
+        store = get_chunk_store(store_root)
+        store.close()
+        store.compact_if_needed()
+
+
+def chunk_all_cases(base_dir, antipattern_type, mode="ast", workers: int = CHUNK_WORKERS,
+                    group_id_mode: str = CHUNK_GROUP_ID_MODE, async_llm: bool = CHUNK_ASYNC_LLM,
+                    incremental: bool = CHUNK_INCREMENTAL) -> list:
+    """
+    对 base_dir/{antipattern_type} 下的全部 case 分块。
+    group_id 在分发前一次性确定，workers > 1 时使用进程池并行构建，每个 case 的输出原子写入。
+    async_llm 为 True 且 mode 为 ast 时改为在单进程内用 asyncio 并发执行多个 case（忽略 workers），
+    LLM 调用总并发受 LLM_MAX_CONCURRENCY 限制，AST 抽取在线程中与 LLM 调用重叠。
+    incremental 为 True 时只重建输入文件、splitter 模式或 prompt 版本发生变化的 case（见 ChunkManifest）。
+
+    :return: [(case_path, group_id, chunk_path 或 None)]
+    """
+    check_group_id_mode(group_id_mode, workers)
+    assigned = assign_group_ids(base_dir, antipattern_type, group_id_mode)
+    print(f"[i] {len(assigned)} cases, group_id_mode={group_id_mode}, workers={workers}, async_llm={async_llm}")
+
+    manifest = None
+    todo, reused, fingerprints = assigned, [], {}
+    if incremental:
+        manifest = ChunkManifest(antipattern_type, mode)
+        todo, reused, fingerprints = select_cases_to_build(manifest, assigned, base_dir, antipattern_type)
+
+    results = []
+    failed = []
+    cache = get_llm_cache()
+    cache.reset_stats()
+    cache_stats = cache.stats
+    try:
+        if async_llm and mode == "ast":
+            for (case_path, _), outcome in zip(todo, asyncio.run(
+                    _achunk_cases(todo, antipattern_type, CHUNK_ASYNC_CASES))):
+                if isinstance(outcome, Exception):
+                    print(f"[Error] chunk {case_path} failed: {outcome}")
+                    failed.append(case_path)
+                else:
+                    results.append(outcome)
+        elif workers <= 1:
+            build_chunks = load_splitter_by_mode(mode)
+            for case_path, group_id in todo:
+                print(f"start {case_path}")
+                chunk, path = build_chunks(case_path, antipattern_type, group_id)
+                results.append((case_path, group_id, str(path) if path else None))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(build_case, mode, case_path, antipattern_type, group_id): (case_path, group_id)
+                    for case_path, group_id in todo
+                }
+                for future in as_completed(futures):
+                    case_path, group_id = futures[future]
+                    try:
+                        path, case_cache_stats = future.result()
+                        results.append((case_path, group_id, path))
+                        cache_stats = {k: cache_stats.get(k, 0) + v for k, v in case_cache_stats.items()}
+                        print(f"[✓] {case_path} (group_id={group_id})")
+                    except Exception as e:
+                        print(f"[Error] chunk {case_path} failed: {e}")
+                        failed.append(case_path)
+    finally:
+        # 中途出错时也保存已完成 case 的指纹
+        if manifest is not None:
+            for case_path, group_id, path in results:
+                case_key, fingerprint, files = fingerprints[case_path]
+                manifest.update(case_key, fingerprint, files, group_id, path)
+            manifest.save()
+
+    if failed:
+        print(f"[WARN] {len(failed)} cases failed: {failed}")
+    compact_chunk_stores(reused + results)
+    print(f"[i] LLM cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['writes']} writes")
+    print("chunks over")
+    return reused + results
@@ -1,5 +1,9 @@
-from langchain.schema import Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
 
 
 def read_limited_text(file_path: str, max_chars: int) -> str:
@@ -28,6 +32,9 @@ def parse_line_range(range_str: str) -> tuple[int, int]:
 
 # QWen3 的 Embedding Prompt 所要用到 instruct 和 query 的格式，保留此格式所进行的拆分
 def split_documents_with_instruction_context(documents: list[Document], tokenizer, max_token_length: int, chunk_overlap: int = 100) -> list[Document]:
+    from langchain.schema import Document
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
     new_documents = []
     for doc in documents:
         content = doc.page_content
@@ -70,6 +77,8 @@ def split_ast_documents(documents: list[Document], tokenizer, max_token_length:
     """
     拆分 AST 类型的文档，确保每个 chunk 不超过最大 token 数量，保留结构语义。
     """
+    from langchain.schema import Document
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
 
     new_documents = []
 
@@ -0,0 +1,74 @@
+import faulthandler
+import tempfile
+from pathlib import Path
+
+from utils.chunk_store import ChunkStore, SHARD_SUFFIX, INDEX_SUFFIX
+
+# shard 轮转曾在 put 中死锁：超时则打印各线程栈并退出，而不是一直挂起
+faulthandler.dump_traceback_later(60, exit=True)
+
+SHARD_BYTES = 200
+NUM_RECORDS = 20
+
+
+def make_result(i: int, version: int = 0) -> dict:
+    return {"group_id": i, "version": version, "chunks": [{"chunk_type": "CH", "ast_subtree": "x" * 50}]}
+
+
+def list_shards(root: Path) -> list:
+    return [p for p in root.glob(f"*{SHARD_SUFFIX}") if not p.name.endswith(INDEX_SUFFIX)]
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    root = Path(tmp) / "store"
+    store = ChunkStore(root, shard_bytes=SHARD_BYTES)
+
+    # ---------- 1️⃣ 写入超过 shard_bytes，触发多次轮转 ----------
+    for i in range(NUM_RECORDS):
+        store.put(f"case_{i}", make_result(i))
+    shards = list_shards(root)
+    print(f"[i] {NUM_RECORDS} records written into {len(shards)} shards")
+    assert len(shards) > 1, "shard rotation did not happen"
+
+    # ---------- 2️⃣ 覆盖与删除（删除同样会在已满的 shard 上触发轮转） ----------
+    for i in range(0, NUM_RECORDS, 2):
+        store.put(f"case_{i}", make_result(i, version=1))
+    for i in range(0, NUM_RECORDS, 5):
+        store.delete(f"case_{i}")
+    store.close()
+
+    deleted = {f"case_{i}" for i in range(0, NUM_RECORDS, 5)}
+    expected = {f"case_{i}": make_result(i, version=1 if i % 2 == 0 else 0)
+                for i in range(NUM_RECORDS) if f"case_{i}" not in deleted}
+
+    def check(store: ChunkStore, stage: str):
+        for key in deleted:
+            assert store.get(key) is None, f"{stage}: deleted key {key} still readable"
+        for key, result in expected.items():
+            assert store.get(key) == result, f"{stage}: get({key}) mismatch"
+        records = dict(store.iter_records())
+        assert records == expected, f"{stage}: iter_records mismatch"
+        assert store.get_by_group_id(1) == expected["case_1"], f"{stage}: get_by_group_id mismatch"
+
+    check(store, "before compact")
+    # 新实例只依赖磁盘上的索引
+    check(ChunkStore(root, shard_bytes=SHARD_BYTES), "reopened")
+    garbage_ratio = store.get_garbage_ratio()
+    print(f"[i] garbage ratio before compact: {garbage_ratio:.2f}")
+    assert garbage_ratio > 0
+
+    # ---------- 3️⃣ compact：只保留有效记录，旧 shard 被删除 ----------
+    old_shards = {p.name for p in list_shards(root)}
+    report = store.compact()
+    check(ChunkStore(root, shard_bytes=SHARD_BYTES), "after compact")
+    assert report["records"] == len(expected)
+    assert not old_shards & {p.name for p in list_shards(root)}, "old shards left after compact"
+    assert store.get_garbage_ratio() == 0.0
+
+    # compact 之后仍可继续写入
+    store.put("case_new", make_result(NUM_RECORDS))
+    store.close()
+    assert store.get("case_new") == make_result(NUM_RECORDS)
+
+faulthandler.cancel_dump_traceback_later()
+print("[✓] Chunk store check passed")
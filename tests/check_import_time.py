@@ -0,0 +1,40 @@
+import subprocess
+import sys
+import time
+
+# 在全新的解释器中导入入口模块：不应加载重量级依赖，且耗时在预算之内
+ENTRY_MODULES = ["main", "retriever.retriever_utils", "splitter.runner"]
+HEAVY_MODULES = ["faiss", "torch", "transformers", "langchain", "langchain_core", "langchain_community",
+                 "langchain_huggingface", "langchain_ollama", "langchain_text_splitters", "chromadb", "tree_sitter"]
+IMPORT_TIME_BUDGET = 1.0  # 秒
+
+CHECK_CODE = """
+import sys
+import {module}
+loaded = [name for name in {heavy!r} if name in sys.modules]
+print("LOADED:" + ",".join(loaded))
+"""
+
+failures = []
+for module in ENTRY_MODULES:
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", CHECK_CODE.format(module=module, heavy=HEAVY_MODULES)],
+                          capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        failures.append(f"{module}: import failed\n{proc.stderr}")
+        continue
+
+    lines = proc.stdout.strip().splitlines()
+    loaded = [name for name in lines[-1][len("LOADED:"):].split(",") if name]
+    print(f"[i] import {module}: {elapsed:.3f}s, heavy modules loaded: {loaded or 'none'}")
+    # 导入时不应有任何输出（除最后一行检查结果）
+    if len(lines) > 1:
+        failures.append(f"{module}: prints at import time: {lines[:-1]}")
+    if loaded:
+        failures.append(f"{module}: eagerly imports {loaded}")
+    if elapsed > IMPORT_TIME_BUDGET:
+        failures.append(f"{module}: import took {elapsed:.3f}s > {IMPORT_TIME_BUDGET}s")
+
+assert not failures, "Import time check failed:\n" + "\n".join(failures)
+print("[✓] Import time check passed")
@@ -0,0 +1,27 @@
+import glob
+import json
+
+from config.settings import CODE_EMBEDDING_MODEL, CODE_EMBEDDING_ONNX_DIR, CODE_EMBEDDING_ONNX_QUANTIZED
+from embeddings.onnx_embedding import compare_onnx_with_torch
+
+# fp32 导出应与 torch 几乎一致，int8 量化允许少量偏差
+MIN_COSINE = 0.95 if CODE_EMBEDDING_ONNX_QUANTIZED else 0.99
+NUM_TEXTS = 32
+
+# ---------- 1️⃣ 从已有 chunk 结果中取 ast_subtree 作为测试文本 ----------
+texts = []
+for path in sorted(glob.glob("tmp/chunks/**/*_chunk.json", recursive=True)):
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    texts.extend(c["ast_subtree"] for c in data["chunks"] if c.get("ast_subtree"))
+texts = texts[:NUM_TEXTS]
+print(f"[i] Loaded {len(texts)} texts")
+
+# ---------- 2️⃣ cosine 一致性 + docs/sec 对比 ----------
+report = compare_onnx_with_torch(texts, CODE_EMBEDDING_ONNX_DIR, CODE_EMBEDDING_MODEL,
+                                 quantized=CODE_EMBEDDING_ONNX_QUANTIZED)
+
+print(f"mean cosine: {report['mean_cosine']:.5f}, min cosine: {report['min_cosine']:.5f}")
+print(f"torch: {report['torch_docs_per_sec']:.2f} docs/s, onnx: {report['onnx_docs_per_sec']:.2f} docs/s")
+assert report["min_cosine"] >= MIN_COSINE, f"ONNX parity check failed: min cosine {report['min_cosine']:.5f}"
+print("[✓] ONNX parity check passed")
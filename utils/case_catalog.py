@@ -0,0 +1,212 @@
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional
+
+from config.settings import CASE_CATALOG_PATH, CASE_CATALOG_ENABLED
+
+# case 目录下参与分块的子目录；其余子目录（如 vectorstore）不进入 catalog
+CASE_INPUT_DIRS = ("before", "llm_function_description")
+
+
+def is_required_case_file(rel_path: str) -> bool:
+    """分块所需的输入文件：*antipattern.json、before/ 下全部文件、llm_function_description/before.json"""
+    if "/" not in rel_path:
+        return rel_path.endswith("antipattern.json")
+    return rel_path.startswith("before/") or rel_path == "llm_function_description/before.json"
+
+
+def _scan_dir_files(dir_path: str, rel_prefix: str, files: dict, dir_mtimes: dict):
+    """递归 scandir：收集文件的 [size, mtime_ns] 以及每个目录的 mtime"""
+    dir_mtimes[rel_prefix] = os.stat(dir_path).st_mtime_ns
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            rel_path = f"{rel_prefix}/{entry.name}"
+            if entry.is_dir(follow_symlinks=False):
+                _scan_dir_files(entry.path, rel_path, files, dir_mtimes)
+            elif entry.is_file():
+                stat = entry.stat()
+                files[rel_path] = [stat.st_size, stat.st_mtime_ns]
+
+
+def scan_case_dir(case_path: str) -> tuple[dict, dict]:
+    """
+    扫描一个 case 目录，返回 ({相对路径: [size, mtime_ns]}, {相对目录: mtime_ns})，
+    case 目录本身记为 ""。
+    """
+    files, dir_mtimes = {}, {"": os.stat(case_path).st_mtime_ns}
+    with os.scandir(case_path) as it:
+        for entry in it:
+            if entry.is_file():
+                stat = entry.stat()
+                files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+            elif entry.is_dir(follow_symlinks=False) and entry.name in CASE_INPUT_DIRS:
+                _scan_dir_files(entry.path, entry.name, files, dir_mtimes)
+    return files, dir_mtimes
+
+
+class CaseCatalog:
+    """
+    data/{antipattern_type}/{other}/project/commit/case 的持久化目录（SQLite）。
+    - 上层目录（type / other / project / commit）记录 mtime 与子目录列表，mtime 未变时不再 scandir
+    - 每个 case 记录其输入目录的 mtime 与文件列表（size, mtime_ns），所有输入目录 mtime 未变时直接复用
+    注意：目录 mtime 只在增删 / 重命名条目时变化，原地修改文件内容需由 ChunkManifest 的内容哈希发现。
+    """
+
+    def __init__(self, path=CASE_CATALOG_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, children TEXT);"
+            "CREATE TABLE IF NOT EXISTS cases ("
+            "case_path TEXT PRIMARY KEY, root TEXT, antipattern_type TEXT, other TEXT, project TEXT, "
+            "commit_number TEXT, case_id TEXT, ordinal INTEGER, dir_mtimes TEXT, files TEXT);"
+            "CREATE INDEX IF NOT EXISTS idx_cases_root ON cases(root, ordinal);"
+            "CREATE INDEX IF NOT EXISTS idx_cases_key ON cases(antipattern_type, project, commit_number, case_id);"
+        )
+        self._conn.commit()
+
+    def _list_subdirs(self, path: str, stats: dict) -> list:
+        mtime_ns = os.stat(path).st_mtime_ns
+        row = self._conn.execute("SELECT mtime_ns, children FROM dirs WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == mtime_ns:
+            return json.loads(row[1])
+        with os.scandir(path) as it:
+            children = [entry.name for entry in it if entry.is_dir()]
+        self._conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (path, mtime_ns, json.dumps(children)))
+        stats["dirs_scanned"] += 1
+        return children
+
+    @staticmethod
+    def _dirs_unchanged(case_path: str, dir_mtimes: dict) -> bool:
+        try:
+            return all(os.stat(os.path.join(case_path, rel_dir)).st_mtime_ns == mtime_ns
+                       for rel_dir, mtime_ns in dir_mtimes.items())
+        except FileNotFoundError:
+            return False
+
+    def refresh(self, base_dir, antipattern_type) -> dict:
+        """按目录 mtime 增量刷新 base_dir/{antipattern_type} 下的 case，返回扫描统计"""
+        root = os.path.abspath(os.path.join(base_dir, antipattern_type))
+        stats = {"cases": 0, "cases_scanned": 0, "dirs_scanned": 0, "cases_removed": 0}
+        with self._lock:
+            existing = {row[0]: json.loads(row[1]) for row in self._conn.execute(
+                "SELECT case_path, dir_mtimes FROM cases WHERE root = ?", (root,))}
+            seen = set()
+            ordinal = 0
+            for other in self._list_subdirs(root, stats):
+                other_path = os.path.join(root, other)
+                for project in self._list_subdirs(other_path, stats):
+                    project_path = os.path.join(other_path, project)
+                    for commit in self._list_subdirs(project_path, stats):
+                        commit_path = os.path.join(project_path, commit)
+                        for case_id in self._list_subdirs(commit_path, stats):
+                            case_path = os.path.join(commit_path, case_id)
+                            seen.add(case_path)
+                            if case_path in existing and self._dirs_unchanged(case_path, existing[case_path]):
+                                self._conn.execute("UPDATE cases SET ordinal = ? WHERE case_path = ?",
+                                                   (ordinal, case_path))
+                            else:
+                                files, dir_mtimes = scan_case_dir(case_path)
+                                # 列名写全：旧版本创建的 catalog 还带有未使用的 fingerprint 列
+                                self._conn.execute(
+                                    "INSERT OR REPLACE INTO cases (case_path, root, antipattern_type, other, project, "
+                                    "commit_number, case_id, ordinal, dir_mtimes, files) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (case_path, root, antipattern_type, other, project, commit, case_id, ordinal,
+                                     json.dumps(dir_mtimes), json.dumps(files)))
+                                stats["cases_scanned"] += 1
+                            ordinal += 1
+
+            removed = [case_path for case_path in existing if case_path not in seen]
+            self._conn.executemany("DELETE FROM cases WHERE case_path = ?", [(p,) for p in removed])
+            self._conn.commit()
+        stats["cases"] = ordinal
+        stats["cases_removed"] = len(removed)
+        return stats
+
+    def list_cases(self, base_dir, antipattern_type, refresh: bool = True) -> list:
+        """
+        与 iter_case_paths 返回相同形式、相同顺序（scandir 顺序）的 case 路径列表。
+        """
+        if refresh:
+            stats = self.refresh(base_dir, antipattern_type)
+            print(f"[i] Case catalog: {stats}")
+        root = os.path.abspath(os.path.join(base_dir, antipattern_type))
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT other, project, commit_number, case_id FROM cases WHERE root = ? ORDER BY ordinal",
+                (root,)).fetchall()
+        return [os.path.join(base_dir, antipattern_type, *row) for row in rows]
+
+    def get_case_files(self, case_path) -> Optional[dict]:
+        """
+        case 中已登记的文件 {相对路径: [size, mtime_ns]}，case 不在 catalog 中时返回 None。
+        case 的输入目录 mtime 变化（有文件增删）时只重新扫描该 case。
+        """
+        case_path = os.path.abspath(case_path)
+        with self._lock:
+            row = self._conn.execute("SELECT files, dir_mtimes FROM cases WHERE case_path = ?",
+                                     (case_path,)).fetchone()
+            if row is None:
+                return None
+            if self._dirs_unchanged(case_path, json.loads(row[1])):
+                return json.loads(row[0])
+            if not os.path.isdir(case_path):
+                self._conn.execute("DELETE FROM cases WHERE case_path = ?", (case_path,))
+                self._conn.commit()
+                return None
+            files, dir_mtimes = scan_case_dir(case_path)
+            self._conn.execute("UPDATE cases SET dir_mtimes = ?, files = ? WHERE case_path = ?",
+                               (json.dumps(dir_mtimes), json.dumps(files), case_path))
+            self._conn.commit()
+            return files
+
+    def get_required_files(self, case_path) -> Optional[dict]:
+        files = self.get_case_files(case_path)
+        if files is None:
+            return None
+        return {rel_path: meta for rel_path, meta in files.items() if is_required_case_file(rel_path)}
+
+    def find_case(self, antipattern_type, project, commit_number, case_id) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT case_path FROM cases WHERE antipattern_type = ? AND project = ? AND commit_number = ? "
+                "AND case_id = ? ORDER BY ordinal LIMIT 1",
+                (antipattern_type, str(project), str(commit_number), str(case_id))).fetchone()
+        return row[0] if row else None
+
+    def resolve_case_path(self, path_str: str) -> Optional[str]:
+        """
+        把检索结果中的 folder_path（[data/]{type}/{project}/{commit}/{id}，不含 {other} 一级）解析为真实的 case 目录。
+        """
+        parts = Path(path_str).parts
+        if len(parts) < 4:
+            return None
+        antipattern_type, project, commit_number, case_id = parts[-4:]
+        return self.find_case(antipattern_type, project, commit_number, case_id)
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_case_catalog() -> CaseCatalog:
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = CaseCatalog()
+        return _catalog
+
+
+def list_case_paths(base_dir, antipattern_type) -> list:
+    """CASE_CATALOG_ENABLED 时从 catalog 获取 case 列表，否则直接遍历目录"""
+    if CASE_CATALOG_ENABLED:
+        return get_case_catalog().list_cases(base_dir, antipattern_type)
+    from utils.utils import iter_case_paths
+    return list(iter_case_paths(base_dir, antipattern_type))
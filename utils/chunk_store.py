@@ -0,0 +1,302 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+from config.settings import CHUNK_STORE_ENABLED, CHUNK_STORE_SHARD_BYTES
+from utils.utils import write_json_atomic
+
+# chunk store 位于各类型 chunk 目录下：tmp/chunks/{type}/store、tmp_ablation/chunks/{type}/store
+CHUNK_STORE_DIRNAME = "store"
+# 分块结果在 store 中的位置记为 "{store 目录}#{key}"，key 即原 chunk JSON 的文件名（不含 .json）
+STORE_REF_SEPARATOR = "#"
+
+SHARD_SUFFIX = ".jsonl"
+INDEX_SUFFIX = ".idx.jsonl"
+
+
+def is_store_ref(output) -> bool:
+    return isinstance(output, str) and STORE_REF_SEPARATOR in output
+
+
+def make_store_ref(store_root: Union[str, Path], key: str) -> str:
+    return f"{store_root}{STORE_REF_SEPARATOR}{key}"
+
+
+def split_store_ref(ref: str) -> tuple[str, str]:
+    store_root, key = ref.rsplit(STORE_REF_SEPARATOR, 1)
+    return store_root, key
+
+
+class ChunkStore:
+    """
+    追加写入的分片 chunk store：每个 case 的分块结果是 shard 中的一行紧凑 JSON，
+    每个 shard 有一个同名的 .idx.jsonl 索引（key, group_id, offset, length, ts）。
+
+    - 每个写入进程使用自己的 shard（文件名带 pid），进程池并行分块时无需加锁；shard 超过 CHUNK_STORE_SHARD_BYTES 后轮转
+    - 同一 key 以 ts 最新的记录为准，删除记为 tombstone；旧记录在 compact() 时清理
+    - get(key) 只需一次 seek + read；iter_records() 按 shard / offset 顺序流式读取
+    """
+
+    def __init__(self, root: Union[str, Path], shard_bytes: int = CHUNK_STORE_SHARD_BYTES):
+        self.root = Path(root)
+        self.shard_bytes = shard_bytes
+        self._lock = threading.Lock()
+        self._writer = None  # (pid, shard_file, index_file, shard_path)
+        self._seq = 0
+        self._index_cache = (None, None)  # (索引文件签名, 合并后的索引)
+
+    # ---------- 写入 ----------
+
+    def _new_shard_path(self) -> Path:
+        self.root.mkdir(parents=True, exist_ok=True)
+        return self.root / f"part-{os.getpid()}-{time.time_ns()}{SHARD_SUFFIX}"
+
+    def _get_writer(self):
+        # fork 出的子进程不能复用父进程的文件句柄
+        if self._writer is None or self._writer[0] != os.getpid():
+            shard_path = self._new_shard_path()
+            index_path = shard_path.parent / (shard_path.name[:-len(SHARD_SUFFIX)] + INDEX_SUFFIX)
+            self._writer = (os.getpid(), open(shard_path, "ab"), open(index_path, "a", encoding="utf-8"),
+                            shard_path)
+        elif self._writer[1].tell() >= self.shard_bytes:
+            self._close_writer()
+            return self._get_writer()
+        return self._writer
+
+    def _close_writer(self):
+        # 调用方需已持有 self._lock（put / delete 轮转 shard 时）
+        if self._writer is not None and self._writer[0] == os.getpid():
+            self._writer[1].close()
+            self._writer[2].close()
+        self._writer = None
+
+    def _next_ts(self) -> int:
+        self._seq += 1
+        return time.time_ns() * 1000 + self._seq % 1000
+
+    def _append_index(self, index_file, entry: dict):
+        index_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        index_file.flush()
+
+    def put(self, key: str, result: dict) -> str:
+        """追加一个 case 的分块结果，返回其 store 引用"""
+        line = (json.dumps(result, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        with self._lock:
+            _, shard_file, index_file, shard_path = self._get_writer()
+            offset = shard_file.tell()
+            shard_file.write(line)
+            shard_file.flush()
+            self._append_index(index_file, {"key": key, "group_id": result.get("group_id"),
+                                            "shard": shard_path.name, "offset": offset, "length": len(line),
+                                            "ts": self._next_ts()})
+        return make_store_ref(self.root, key)
+
+    def delete(self, key: str):
+        with self._lock:
+            _, _, index_file, _ = self._get_writer()
+            self._append_index(index_file, {"key": key, "deleted": True, "ts": self._next_ts()})
+
+    def close(self):
+        with self._lock:
+            self._close_writer()
+
+    # ---------- 读取 ----------
+
+    def _index_paths(self) -> list:
+        return sorted(self.root.glob(f"*{INDEX_SUFFIX}")) if self.root.exists() else []
+
+    def _iter_index_entries(self, index_paths: list) -> Iterator[dict]:
+        for index_path in index_paths:
+            with open(index_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    # 写入中断时最后一行可能不完整
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+
+    def load_index(self) -> dict:
+        """{key: 最新的索引项}（不含已删除的 key）；索引文件未变化时直接返回缓存"""
+        index_paths = self._index_paths()
+        signature = tuple((p.name, p.stat().st_size, p.stat().st_mtime_ns) for p in index_paths)
+        cached_signature, cached_index = self._index_cache
+        if cached_signature == signature:
+            return cached_index
+
+        latest = {}
+        for entry in self._iter_index_entries(index_paths):
+            current = latest.get(entry["key"])
+            if current is None or entry["ts"] > current["ts"]:
+                latest[entry["key"]] = entry
+        index = {key: entry for key, entry in latest.items() if not entry.get("deleted")}
+        self._index_cache = (signature, index)
+        return index
+
+    def _read_entry(self, entry: dict) -> dict:
+        with open(self.root / entry["shard"], "rb") as f:
+            f.seek(entry["offset"])
+            return json.loads(f.read(entry["length"]))
+
+    def get(self, key: str, index: Optional[dict] = None) -> Optional[dict]:
+        entry = (index if index is not None else self.load_index()).get(key)
+        return self._read_entry(entry) if entry else None
+
+    def get_by_group_id(self, group_id: int, index: Optional[dict] = None) -> Optional[dict]:
+        index = index if index is not None else self.load_index()
+        for entry in index.values():
+            if entry.get("group_id") == group_id:
+                return self._read_entry(entry)
+        return None
+
+    def exists(self, key: str) -> bool:
+        return key in self.load_index()
+
+    def iter_refs(self, index: Optional[dict] = None) -> list:
+        """按 shard / offset 顺序排列的 store 引用，顺序读取时磁盘访问连续"""
+        index = index if index is not None else self.load_index()
+        entries = sorted(index.values(), key=lambda e: (e["shard"], e["offset"]))
+        return [make_store_ref(self.root, entry["key"]) for entry in entries]
+
+    def iter_records(self, index: Optional[dict] = None) -> Iterator[tuple[str, dict]]:
+        """按 shard 顺序流式读取所有有效记录，产出 (key, result)"""
+        index = index if index is not None else self.load_index()
+        live = {(entry["shard"], entry["offset"]): entry["key"] for entry in index.values()}
+        for shard in sorted({entry["shard"] for entry in index.values()}):
+            with open(self.root / shard, "rb") as f:
+                offset = 0
+                for line in f:
+                    key = live.get((shard, offset))
+                    if key is not None:
+                        yield key, json.loads(line)
+                    offset += len(line)
+
+    # ---------- 压缩 ----------
+
+    def get_garbage_ratio(self) -> float:
+        """已被覆盖 / 删除的记录占 shard 总字节数的比例"""
+        total = sum(p.stat().st_size for p in self.root.glob(f"*{SHARD_SUFFIX}")
+                    if not p.name.endswith(INDEX_SUFFIX)) if self.root.exists() else 0
+        if total == 0:
+            return 0.0
+        live = sum(entry["length"] for entry in self.load_index().values())
+        return 1 - live / total
+
+    def compact(self) -> dict:
+        """
+        把有效记录顺序重写到新的 shard 中，再删除旧的 shard 与索引。
+        需在没有其他进程写入时调用。
+        """
+        self.close()
+        index = self.load_index()
+        old_files = [p for p in self.root.glob("part-*")] if self.root.exists() else []
+
+        compacted = ChunkStore(self.root, self.shard_bytes)
+        count = 0
+        for key, result in self.iter_records(index):
+            compacted.put(key, result)
+            count += 1
+        compacted.close()
+
+        new_files = {p.name for p in self.root.glob("part-*")} - {p.name for p in old_files}
+        for path in old_files:
+            if path.name not in new_files:
+                path.unlink()
+        print(f"[✓] Compacted chunk store {self.root}: {count} records")
+        return {"records": count, "removed_files": len(old_files)}
+
+    def compact_if_needed(self, min_garbage_ratio: float = 0.5) -> Optional[dict]:
+        if self.get_garbage_ratio() >= min_garbage_ratio:
+            return self.compact()
+        return None
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_chunk_store(root: Union[str, Path]) -> ChunkStore:
+    root = str(root)
+    with _stores_lock:
+        if root not in _stores:
+            _stores[root] = ChunkStore(root)
+        return _stores[root]
+
+
+def get_chunk_store_root(chunk_dir: Union[str, Path]) -> Path:
+    return Path(chunk_dir) / CHUNK_STORE_DIRNAME
+
+
+def write_chunk_result(result: dict, output_path: Union[str, Path]) -> Union[Path, str]:
+    """
+    保存一个 case 的分块结果：CHUNK_STORE_ENABLED 时追加到 output_path 所在目录的 chunk store 中并返回 store 引用，
+    否则按原方式原子写入 output_path。query（group_id < 0）始终写文件。
+    """
+    output_path = Path(output_path)
+    group_id = result.get("group_id")
+    if CHUNK_STORE_ENABLED and group_id is not None and group_id >= 0:
+        return get_chunk_store(get_chunk_store_root(output_path.parent)).put(output_path.stem, result)
+    return write_json_atomic(result, output_path)
+
+
+def load_chunk_result(location: Union[str, Path]) -> dict:
+    """按 store 引用或 chunk JSON 路径读取分块结果"""
+    if is_store_ref(location):
+        store_root, key = split_store_ref(location)
+        result = get_chunk_store(store_root).get(key)
+        if result is None:
+            raise FileNotFoundError(f"Chunk result not found in store: {location}")
+        return result
+    with open(location, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def chunk_output_exists(location: Optional[str]) -> bool:
+    if not location:
+        return False
+    if is_store_ref(location):
+        store_root, key = split_store_ref(location)
+        return get_chunk_store(store_root).exists(key)
+    return os.path.exists(location)
+
+
+def find_chunk_output(output_path: Union[str, Path]) -> Optional[Union[Path, str]]:
+    """
+    已存在的分块结果位置：CHUNK_STORE_ENABLED 且 store 中有该 case 时返回 store 引用，
+    否则 output_path 存在且非空时返回 output_path，都没有时返回 None。
+    """
+    output_path = Path(output_path)
+    if CHUNK_STORE_ENABLED:
+        store_root = get_chunk_store_root(output_path.parent)
+        if get_chunk_store(store_root).exists(output_path.stem):
+            return make_store_ref(store_root, output_path.stem)
+    if output_path.exists() and output_path.stat().st_size > 0:
+        return output_path
+    return None
+
+
+def remove_chunk_output(location: Optional[str]) -> bool:
+    if not chunk_output_exists(location):
+        return False
+    if is_store_ref(location):
+        store_root, key = split_store_ref(location)
+        get_chunk_store(store_root).delete(key)
+    else:
+        os.remove(location)
+    return True
+
+
+def import_chunk_jsons(chunk_dir: Union[str, Path]) -> int:
+    """把 chunk_dir 下已有的 chunk JSON 导入 chunk store（不删除原文件），返回导入的条数"""
+    chunk_dir = Path(chunk_dir)
+    store = get_chunk_store(get_chunk_store_root(chunk_dir))
+    count = 0
+    for json_path in sorted(chunk_dir.glob("*.json")):
+        with open(json_path, "r", encoding="utf-8") as f:
+            store.put(json_path.stem, json.load(f))
+        count += 1
+    store.close()
+    print(f"[✓] Imported {count} chunk JSON files into {store.root}")
+    return count
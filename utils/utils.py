@@ -1,6 +1,8 @@
 import glob
+import json
 import os
 import shutil
+import tempfile
 from pathlib import Path
 
 
@@ -106,11 +108,38 @@ def exist_chunk_json(case_path, antipattern_type):
     检查 case_path 中是否存在以 {antipattern_type}_chunk.json 命名的文件。
     如果存在，返回该文件的完整路径；否则返回 None。
     """
-    pattern = os.path.join(case_path, f"*{antipattern_type}_chunk.json")
-    matches = glob.glob(pattern)
+    from config.settings import CASE_CATALOG_ENABLED
+    from utils.case_catalog import get_case_catalog
+
+    files = get_case_catalog().get_case_files(case_path) if CASE_CATALOG_ENABLED else None
+    if files is not None:
+        # case 已登记在 catalog 中时直接查文件列表，不再 glob
+        matches = [os.path.join(case_path, name) for name in files
+                   if "/" not in name and name.endswith(f"{antipattern_type}_chunk.json")]
+    else:
+        matches = glob.glob(os.path.join(case_path, f"*{antipattern_type}_chunk.json"))
     return matches[0] if matches else None
 
 
+def write_json_atomic(data, output_path, indent: int = 2):
+    """
+    原子写入 JSON：先写入同目录下的临时文件，再 os.replace 覆盖目标文件，
+    并行构建或中途被中断时不会留下写了一半的 JSON。
+    """
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{output_path.name}.", suffix=".tmp", dir=output_path.parent)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=indent)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return output_path
+
+
 def iter_case_paths(base_dir, antipattern_type):
     """
     遍历 data/{antipattern_type}/{other}/project/commit/case 下的所有 case 路径。